@@ -11,7 +11,18 @@ ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if ROOT_DIR not in sys.path:
     sys.path.insert(0, ROOT_DIR)
 
-from src.core.math_engine import balance_equation, hint_stoichiometry
+from src.config import MODES, QUIZ_SIZE
+from src.core.math_engine import hint_stoichiometry, try_balance, try_stoichiometry
+from src.core.memory import ConversationMemory
+from src.core.quiz_bank import (
+    MAX_QUIZ_SIZE,
+    QuizBank,
+    parse_explain_request,
+    parse_quiz_request,
+    render_answer_key,
+    render_quiz,
+)
+from src.core.quiz_parser import question_text
 from src.core.rag import RAGEngine, StreamOutput
 from src.core.instructions import GREETING_MESSAGE
 
@@ -89,17 +100,39 @@ def get_rag_engine():
 
 engine: RAGEngine = get_rag_engine()
 
+# Ngân hàng câu hỏi lắp đề tại chỗ (không gọi Gemini), nạp một lần cho mọi phiên
+@st.cache_resource
+def get_quiz_bank():
+    return QuizBank(embedder_name=engine.embedder.name)
+
+quiz_bank: QuizBank = get_quiz_bank()
+
 # Quản lý Session State  
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "turns" not in st.session_state:
     st.session_state.turns = []
+if "memory" not in st.session_state:
+    # Lịch sử gửi kèm prompt (giới hạn token, tự tóm tắt khi dài)
+    st.session_state.memory = ConversationMemory()
 if "current_mode" not in st.session_state:
     st.session_state.current_mode = "Bình thường"
+if "grade_filter" not in st.session_state:
+    st.session_state.grade_filter = "Tất cả"
 if "uploaded_file_data" not in st.session_state:
     st.session_state.uploaded_file_data = None
 if "current_file_id" not in st.session_state:
      st.session_state.current_file_id = None
+if "quiz" not in st.session_state:
+    # Đề vừa lắp từ ngân hàng, để trả lời "giải thích câu N" / xem đáp án
+    st.session_state.quiz = []
+
+
+def _quiz_text(questions) -> str:
+    """Lưu đề vào phiên và trả về nội dung tin nhắn."""
+    st.session_state.quiz = questions
+    return (render_quiz(questions) + "\n\n---\n_Gõ \"giải thích câu N\" để xem lời giải, "
+            "hoặc bấm \"Xem đáp án\" ở thanh bên._")
 
 
 # Giao diện Sidebar (Thanh bên)  
@@ -110,15 +143,42 @@ with st.sidebar:
 
     # Chọn chế độ học
     st.markdown("### 🧠 Chế độ học")
-    modes = [
-        "Bình thường", "🐢 Học chậm (Chi tiết)", "🚀 Nâng cao (Học sinh giỏi)",
-        "⚡ Ôn thi cấp tốc", "💪 Thực hành", "🎮 Giải trí (Sắp có)"
-    ]
+    modes = MODES
     st.session_state.current_mode = st.selectbox(
         "Chọn chế độ học:", modes,
         index=modes.index(st.session_state.current_mode), key="mode_select"
     )
 
+    # Chỉ tra cứu tài liệu của một lớp (tránh lẫn bài lớp 10 vào câu hỏi lớp 12)
+    grades = ["Tất cả", "Lớp 10", "Lớp 11", "Lớp 12"]
+    st.session_state.grade_filter = st.selectbox(
+        "Tài liệu tham khảo:", grades,
+        index=grades.index(st.session_state.grade_filter), key="grade_select"
+    )
+
+    # Đề trắc nghiệm lắp sẵn từ ngân hàng câu hỏi (tức thì, không gọi Gemini)
+    st.markdown("### 📝 Đề trắc nghiệm")
+    if len(quiz_bank):
+        sidebar_grade = None if st.session_state.grade_filter == "Tất cả" else int(st.session_state.grade_filter.split()[-1])
+        quiz_topic = st.selectbox("Chủ đề:", ["Tất cả"] + quiz_bank.topics(sidebar_grade), key="quiz_topic")
+        quiz_size = st.number_input("Số câu:", min_value=1, max_value=MAX_QUIZ_SIZE, value=QUIZ_SIZE, key="quiz_size")
+        if st.button("Tạo đề", key="quiz_make"):
+            questions = quiz_bank.assemble(int(quiz_size), grade=sidebar_grade,
+                                           topics=None if quiz_topic == "Tất cả" else [quiz_topic])
+            if questions:
+                quiz_message = _quiz_text(questions)
+                st.session_state.messages.append({
+                    "role": "assistant", "content": quiz_message,
+                    "footnote": f"📝 Đề {len(questions)} câu từ ngân hàng câu hỏi ({quiz_topic}).",
+                })
+                st.session_state.memory.add(f"Tạo đề {len(questions)} câu ({quiz_topic})", quiz_message)
+            else:
+                st.caption("Không có câu hỏi phù hợp bộ lọc.")
+        if st.session_state.quiz and st.button("Xem đáp án", key="quiz_key"):
+            st.session_state.messages.append({"role": "assistant", "content": render_answer_key(st.session_state.quiz)})
+    else:
+        st.caption("Chưa có ngân hàng câu hỏi (chạy `python -m src.processing.build_quiz_bank`).")
+
     st.markdown(" ")
 
     # Tải ảnh lên
@@ -152,7 +212,9 @@ with st.sidebar:
     st.markdown("### Mẹo sử dụng")
     st.markdown(
         "- Gõ `A + B -> C` để cân bằng phương trình.\n"
+        "- Gõ 'Tính số mol của 5,6 g Fe' để tính ngay (M, n, m, V, C_M).\n"
         "- Tải ảnh lên rồi gõ 'Giải bài này'.\n"
+        "- Gõ 'cho mình đề 10 câu về liên kết hoá học' để lấy đề có sẵn đáp án ngay.\n"
         "- Hỏi lý thuyết, bài tập, khái niệm.\n"
         "- Đưa ngữ cảnh hỏi vào sẽ giúp chatbot phản hồi tốt hơn.\n"
     )
@@ -236,11 +298,74 @@ if prompt:
     response_metadata = {}
     full_response_text = ""
 
-    # Ưu tiên 1: Cân bằng phương trình (chỉ khi không có ảnh)
-    if (("->" in prompt) or ("→" in prompt)) and not pending_file_obj:
+    grade = st.session_state.grade_filter
+    filters = {"grade": int(grade.split()[-1])} if grade != "Tất cả" else None
+    balanced = None
+    quiz = []
+    explain_q = None
+    if not pending_file_obj:
+        # "giải thích câu N" về đề vừa tạo, hoặc xin đề mới: trả lời từ ngân hàng câu hỏi
+        explain_index = parse_explain_request(prompt) if st.session_state.quiz else None
+        if explain_index and explain_index <= len(st.session_state.quiz):
+            explain_q = st.session_state.quiz[explain_index - 1]
+        quiz_request = parse_quiz_request(prompt) if explain_q is None and len(quiz_bank) else None
+        if quiz_request:
+            query_vector = engine.embed(quiz_request.query) if quiz_request.query and quiz_bank.vectors is not None else None
+            quiz = quiz_bank.assemble(
+                quiz_request.size,
+                grade=quiz_request.grade or (filters or {}).get("grade"),
+                topics=[quiz_request.topic] if quiz_request.topic else None,
+                kinds=quiz_request.kinds,
+                query_vector=query_vector,
+            )
+    calculated = None
+    if not pending_file_obj and not quiz and explain_q is None:
+        # Bài tính M / n / m / V / C_M của một chất: giải tại chỗ (micro giây), không cần tài liệu hay Gemini
+        calculated = try_stoichiometry(prompt)
+    if not pending_file_obj and not quiz and explain_q is None and calculated is None:
+        # Truy hồi tài liệu chạy nền ngay, song song với thử cân bằng phương trình bên dưới
+        engine.prefetch(prompt, filters, memory=st.session_state.memory)
+        if ("->" in prompt) or ("→" in prompt):
+            balanced = try_balance(prompt.replace("→", "->"))
+
+    # Ưu tiên 1: Đề từ ngân hàng câu hỏi / lời giải câu trong đề vừa tạo
+    if quiz:
+        response_text = _quiz_text(quiz)
+        full_response_text = response_text
+        footnote = f"📝 Đề {len(quiz)} câu từ ngân hàng câu hỏi."
+        with st.chat_message("assistant", avatar=assistant_avatar):
+            st.markdown(response_text)
+            st.caption(footnote)
+        st.session_state.messages.append({"role": "assistant", "content": response_text, "footnote": footnote})
+        st.session_state.memory.add(prompt, response_text)
+        response_metadata = {"strategy": "quiz_bank", "sources": sorted({q.source for q in quiz})}
+
+    elif explain_q is not None:
+        try:
+            # Lời giải kèm đề được dùng ngay; chỉ câu thiếu lời giải mới gọi Gemini
+            with st.spinner("ChemA đang giải câu này... 🤔"):
+                explanation = engine.explain_question(explain_q)
+            response_text = (question_text(explain_q).replace("\n", "  \n")
+                             + "\n\n**Lời giải:**  \n" + explanation.replace("\n", "  \n"))
+            full_response_text = response_text
+            with st.chat_message("assistant", avatar=assistant_avatar):
+                st.markdown(response_text)
+            st.session_state.messages.append({"role": "assistant", "content": response_text})
+            st.session_state.memory.add(prompt, response_text)
+            response_metadata = {"strategy": "quiz_explain", "sources": [explain_q.source]}
+        except Exception as e:
+            error_message = f"Không lấy được lời giải: {e}"
+            full_response_text = error_message
+            with st.chat_message("assistant", avatar=assistant_avatar):
+                st.error(error_message)
+            st.session_state.messages.append({"role": "assistant", "content": error_message})
+            response_metadata = {"strategy": "quiz_explain_error", "error": str(e)}
+
+    # Ưu tiên 2: Cân bằng phương trình (chỉ khi không có ảnh và cân bằng được)
+    elif balanced is not None:
         strategy = "balance"
         try:
-            response_text = balance_equation(prompt.replace("→", "->"))
+            response_text = balanced
             full_response_text = response_text
             with st.chat_message("assistant", avatar=assistant_avatar):
                 st.markdown(response_text)
@@ -250,6 +375,7 @@ if prompt:
 
             assistant_message = {"role": "assistant", "content": response_text}
             st.session_state.messages.append(assistant_message)
+            st.session_state.memory.add(prompt, response_text)
             response_metadata = {"strategy": strategy}
 
         except Exception as e:
@@ -262,7 +388,20 @@ if prompt:
             st.session_state.messages.append(assistant_message)
             response_metadata = {"strategy": strategy, "error": str(e)}
 
-    # Ưu tiên 2: Xử lý RAG hoặc Multimodal (Ảnh) bằng Streaming
+    # Ưu tiên 3: Máy tính hoá học (số mol, khối lượng, thể tích, nồng độ của một chất)
+    elif calculated is not None:
+        response_text = calculated
+        full_response_text = response_text
+        with st.chat_message("assistant", avatar=assistant_avatar):
+            st.markdown(response_text)
+            st.caption("🧮 Tính bằng máy tính hoá học (nguyên tử khối theo SGK).")
+            with st.expander("Gợi ý tính nhanh"):
+                st.markdown(hint_stoichiometry())
+        st.session_state.messages.append({"role": "assistant", "content": response_text})
+        st.session_state.memory.add(prompt, response_text)
+        response_metadata = {"strategy": "stoichiometry"}
+
+    # Ưu tiên 4: Xử lý RAG hoặc Multimodal (Ảnh) bằng Streaming
     else:
         try:
             spinner_msg = f"ChemA ({st.session_state.current_mode.split('(')[0].strip()}) đang xử lý... 🤔"
@@ -272,21 +411,37 @@ if prompt:
                     file_to_process = io.BytesIO(pending_file_obj.getvalue())
                     file_to_process.name = pending_file_obj.name
 
-                stream_generator = engine.answer_stream(
+                # Báo vị trí khi nhiều bạn hỏi cùng lúc và phải xếp hàng chờ quota Gemini
+                queue_note = st.empty()
+
+                def _show_queue(position: int) -> None:
+                    if position > 0:
+                        queue_note.caption(f"⏳ Nhiều bạn đang hỏi cùng lúc, bạn đang ở vị trí {position} trong hàng chờ...")
+                    else:
+                        queue_note.empty()
+
+                # Chạy trên event loop nền dùng chung: chờ Gemini/backoff 429 không giữ thread
+                stream = engine.answer_stream_sync(
                     prompt,
                     uploaded_file=file_to_process,
-                    mode=st.session_state.current_mode
+                    mode=st.session_state.current_mode,
+                    filters=filters,
+                    memory=st.session_state.memory,
+                    on_queue=_show_queue,
                 )
 
                 with st.chat_message("assistant", avatar=assistant_avatar):
-                    stream_output = st.write_stream(stream_generator)
+                    streamed_text = st.write_stream(stream)
+                # st.write_stream chỉ trả về phần văn bản; metadata nằm ở stream.output
+                stream_output = stream.output or streamed_text
 
                 if isinstance(stream_output, StreamOutput):
                     full_response_text = stream_output.final_text
                     response_metadata = {
                         "strategy": stream_output.strategy,
                         "top_score": stream_output.top_score,
-                        "sources": stream_output.sources
+                        "sources": stream_output.sources,
+                        "timings": stream_output.timings,
                     }
                 elif isinstance(stream_output, str):
                      full_response_text = stream_output
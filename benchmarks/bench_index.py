@@ -0,0 +1,125 @@
+"""
+So sánh các kiểu index FAISS (Flat, IVF, HNSW, IVF-PQ) trên vector thật của kho tài liệu:
+thời gian build, recall@k so với tìm kiếm chính xác và độ trễ p50/p99 cho từng truy vấn.
+
+Chạy:
+    python -m benchmarks.bench_index                     # dùng indexes/faiss.index hiện có
+    python -m benchmarks.bench_index --synthetic 50000 768
+    python -m benchmarks.bench_index --specs "Flat;HNSW32;IVF256,Flat" --nprobe 8 --ef-search 128
+"""
+import argparse
+import math
+import time
+from typing import List
+
+import faiss
+import numpy as np
+
+from src.core.vector_index import apply_search_params, make_index, train
+
+INDEX_PATH = "indexes/faiss.index"
+
+
+def load_corpus_vectors(path: str = INDEX_PATH) -> np.ndarray:
+    """Lấy lại toàn bộ vector từ index đã build (reconstruct theo id)."""
+    index = faiss.read_index(path)
+    if isinstance(index, faiss.IndexIDMap2):
+        ids = faiss.vector_to_array(index.id_map)
+    else:
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return index.reconstruct_n(0, index.ntotal)
+        # IVF nhận thẳng id (vid): lấy id từ các danh sách đảo, cần direct map để reconstruct
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        lists = ivf.invlists
+        ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            faiss.rev_swig_ptr(lists.get_ids(l), lists.list_size(l)).copy()
+            for l in range(ivf.nlist) if lists.list_size(l)
+        ])
+    return np.asarray(index.reconstruct_batch(ids), dtype=np.float32)
+
+
+def synthetic_vectors(n: int, d: int, seed: int = 0) -> np.ndarray:
+    """Dữ liệu giả có cụm (giống embedding thật hơn là nhiễu đều)."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(n // 100, 1), d)).astype(np.float32)
+    X = centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, d)).astype(np.float32)
+    faiss.normalize_L2(X)
+    return X
+
+
+def make_queries(X: np.ndarray, n: int, noise: float = 0.05, seed: int = 1) -> np.ndarray:
+    """Câu hỏi mô phỏng: vector trong kho cộng nhiễu nhỏ rồi chuẩn hoá lại."""
+    rng = np.random.default_rng(seed)
+    Q = X[rng.choice(len(X), n, replace=len(X) < n)].copy()
+    Q += noise * rng.standard_normal(Q.shape).astype(np.float32) / math.sqrt(X.shape[1])
+    faiss.normalize_L2(Q)
+    return Q
+
+
+def default_specs(n: int, d: int) -> List[str]:
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    specs = ["Flat", f"IVF{nlist},Flat", "HNSW32"]
+    m = next((m for m in (96, 64, 48, 32, 16, 8) if d % m == 0), None)
+    if m is not None and n >= 256:
+        specs.append(f"IVF{nlist},PQ{m}")
+    return specs
+
+
+def run(X: np.ndarray, Q: np.ndarray, specs: List[str], k: int, nprobe: int, ef_search: int) -> None:
+    n, d = X.shape
+    ids = np.arange(n, dtype=np.int64)
+    exact = faiss.IndexFlatIP(d)
+    exact.add(X)
+    _, truth = exact.search(Q, k)
+
+    print(f"{n} vector {d}-D, {len(Q)} truy vấn, k={k}, nprobe={nprobe}, efSearch={ef_search}\n")
+    print(f"{'spec':<22}{'build (s)':>10}{'recall@' + str(k):>11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'MB':>8}")
+    for spec in specs:
+        t0 = time.perf_counter()
+        try:
+            index = make_index(spec, d)
+            if not index.is_trained:
+                train(index, spec, X)
+        except ValueError as e:
+            print(f"{spec:<22}bỏ qua: {e}")
+            continue
+        index.add_with_ids(X, ids)
+        build_s = time.perf_counter() - t0
+        apply_search_params(index, nprobe, ef_search)
+
+        _, found = index.search(Q, k)
+        recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+        lat = []
+        for q in Q:
+            t0 = time.perf_counter()
+            index.search(q[None, :], k)
+            lat.append((time.perf_counter() - t0) * 1000)
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+        print(f"{spec:<22}{build_s:>10.2f}{recall:>11.3f}{np.percentile(lat, 50):>10.3f}"
+              f"{np.percentile(lat, 99):>10.3f}{size_mb:>8.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark recall/độ trễ của các kiểu index FAISS")
+    parser.add_argument("--index", default=INDEX_PATH, help="Index hiện có để lấy vector kho")
+    parser.add_argument("--synthetic", nargs=2, type=int, metavar=("N", "D"),
+                        help="Dùng N vector giả D chiều thay vì index hiện có")
+    parser.add_argument("--specs", help="Danh sách spec cách nhau bởi ';' (mặc định tự chọn theo kích thước)")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    args = parser.parse_args(argv)
+
+    X = synthetic_vectors(*args.synthetic) if args.synthetic else load_corpus_vectors(args.index)
+    Q = make_queries(X, args.queries)
+    specs = args.specs.split(";") if args.specs else default_specs(*X.shape)
+    run(X, Q, specs, args.k, args.nprobe, args.ef_search)
+
+
+if __name__ == "__main__":
+    main()
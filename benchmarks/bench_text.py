@@ -0,0 +1,164 @@
+"""
+So sánh cleanup_response hiện tại với chuỗi re.sub cũ (giữ nguyên bên dưới làm mốc):
+kiểm tra kết quả giống hệt từng byte trên kho văn bản rồi đo thông lượng (MB/s).
+Kiểm tra luôn StreamingCleaner: cắt văn bản thành chunk ngẫu nhiên như khi stream Gemini,
+kết quả ghép lại phải giống cleanup_response trên cả văn bản.
+
+Chạy:
+    python -m benchmarks.bench_text                       # chunks.jsonl + mẫu câu trả lời kèm sẵn
+    python -m benchmarks.bench_text --corpus answers.jsonl --repeat 20
+"""
+import argparse
+import json
+import random
+import re
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from src.core.text_utils import StreamingCleaner, cleanup_response
+
+CHUNKS_PATH = "data/processed/chunks.jsonl"
+# Trường chứa văn bản trong các bản ghi jsonl (chunks.jsonl, lịch sử hội thoại, log Gemini)
+TEXT_FIELDS = ("answer", "final_text", "response", "text", "content")
+
+# Câu trả lời kiểu Gemini (LaTeX, chỉ số, đề trắc nghiệm dính dòng, markdown rác)
+SAMPLE_ANSWERS = [
+    "**Axit sunfuric** $H_2SO_4$ là axit mạnh.<br>Phản ứng: $Fe + H_2SO_4 \\rightarrow FeSO_4 + H_2\\uparrow$\n"
+    "Ion $SO_4^{2-}$ tạo kết tủa trắng với $Ba^{2+}$: $Ba^{2+} + SO_4^{2-} \\to BaSO_4\\downarrow$.",
+    "I. TRẮC NGHIỆM (4,0 điểm)- Chọn đáp án đúng:\nCâu 1: Chất nào là chất béo no? A. Triolein. B. Trilinolein. "
+    "C. Tristearin. D. Glyceryl triacrylat.\nCâu 2: Khi thủy phân chất béo trong môi trường kiềm,sản phẩm luôn có:"
+    " A. Muối của axit béo và etylen glicol. B. Axit béo và glixerol.C. Muối của axit béo và glixerol. D. Axit béo.",
+    "Cân bằng: $N_2 + 3H_2 \\rightleftharpoons 2NH_3$ ($\\Delta H < 0$).\n* Tăng áp suất → cân bằng chuyển dịch sang phải.\n"
+    "* Nhiệt độ $\\geq 450^oC$ làm giảm hiệu suất.\n```python\nn = m / M\n```\nVới $\\alpha$, $\\beta$: $\\text{mol}$ = 0,5.",
+    "Bước 1: Tính số mol.n = m/M = 5,6/56 = 0,1 mol.\nBước 2: $V = n \\times 24,79 = 2,479$ L.\n\n\n\t**Đáp số**: 2,479 L.",
+]
+
+
+def legacy_cleanup(text: str) -> str:
+    """Bản cũ: 26 lần re.sub cho ký hiệu, mỗi bước một lượt quét, regex không biên dịch sẵn."""
+    from src.core import text_utils as tu
+
+    if not text:
+        return text
+    text = tu._RE_BR.sub("\n", text)
+    text = tu._RE_TEX_TEXT.sub(r"\1", text)
+    text = text.replace("$", "")
+    text = tu._RE_CODE_LANG.sub("```\n", text)
+    text = re.sub(r"(?<!\S)\*{1,2}(?!\S)", "", text)
+    for pattern, repl in tu._LATEX_SYMBOLS.items():
+        text = re.sub(pattern, repl, text)
+    text = tu._RE_SUPER_CURLY.sub(lambda m: m.group(1).translate(tu._SUPERS), text)
+    text = tu._RE_SUPER_SIMPLE.sub(lambda m: m.group(1).translate(tu._SUPERS), text)
+    text = tu._RE_SUB_CURLY.sub(lambda m: m.group(1).translate(tu._SUBS), text)
+    text = tu._RE_SUB_SIMPLE.sub(lambda m: m.group(1).translate(tu._SUBS), text)
+    text = re.sub(r"([.,:;?!])([^\s\n])", r"\1 \2", text)
+    text = re.sub(r"([^\s])\.([A-ZÀ-Ỹ])", r"\1. \2", text)
+    text = tu._RE_SECTION_HEAD.sub("\n\n", text.strip())
+    text = tu._RE_QUESTION.sub(r"\n\n\1 ", text)
+    text = tu._RE_CHOICES.sub(r"\n\1. ", text)
+    text = tu._RE_WS_BEFORE_NL.sub("\n", text)
+    text = tu._RE_MULTI_NL.sub("\n\n", text)
+    text = re.sub(r"([A-Za-z0-9₀-₉⁰-⁹\)])→", r"\1 → ", text)
+    text = re.sub(r"→([A-Za-z0-9₀-₉⁰-⁹\()])", r" → \1", text)
+    return text.replace("\t", " ")
+
+
+def load_corpus(paths: List[str]) -> List[str]:
+    """Đọc văn bản từ file .jsonl (trường answer/text/...) hoặc file văn bản thường."""
+    texts: List[str] = []
+    for path in paths:
+        p = Path(path)
+        if not p.exists():
+            print(f"Bỏ qua {path}: không tồn tại")
+            continue
+        if p.suffix != ".jsonl":
+            texts.append(p.read_text(encoding="utf-8", errors="ignore"))
+            continue
+        with p.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                text = next((record[k] for k in TEXT_FIELDS if isinstance(record.get(k), str)), None)
+                if text:
+                    texts.append(text)
+    return texts
+
+
+def throughput(fn: Callable[[str], str], texts: List[str], repeat: int) -> float:
+    """MB/s (UTF-8) của `fn` trên cả kho, lấy lần chạy nhanh nhất."""
+    size = sum(len(t.encode("utf-8")) for t in texts) / 2**20
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for t in texts:
+            fn(t)
+        best = min(best, time.perf_counter() - t0)
+    return size / best
+
+
+def split_chunks(text: str, rng: random.Random, max_len: int) -> List[str]:
+    out, i = [], 0
+    while i < len(text):
+        j = i + rng.randint(1, max_len)
+        out.append(text[i:j])
+        i = j
+    return out
+
+
+def stream_clean(chunks: List[str]) -> str:
+    cleaner = StreamingCleaner(do_exam_layout=True)
+    return "".join(cleaner.feed(c) for c in chunks) + cleaner.flush()
+
+
+def check(texts: List[str], seed: int, max_chunk: int) -> Dict[str, int]:
+    """Số văn bản cho kết quả khác mốc (in ví dụ đầu tiên)."""
+    rng = random.Random(seed)
+    mismatches = {"fused": 0, "streaming": 0}
+    for text in texts:
+        want = legacy_cleanup(text)
+        got = {"fused": cleanup_response(text), "streaming": stream_clean(split_chunks(text, rng, max_chunk))}
+        for name, out in got.items():
+            if out != want:
+                if not mismatches[name]:
+                    print(f"[{name}] khác mốc:\n  vào : {text[:200]!r}\n  mốc : {want[:200]!r}\n  ra  : {out[:200]!r}")
+                mismatches[name] += 1
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark cleanup_response so với chuỗi re.sub cũ")
+    parser.add_argument("--corpus", nargs="*", default=[CHUNKS_PATH],
+                        help="File .jsonl (trường answer/text/...) hoặc văn bản; mặc định chunks.jsonl")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-chunk", type=int, default=40, help="Độ dài tối đa một chunk khi giả lập stream")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    texts = load_corpus(args.corpus) + SAMPLE_ANSWERS
+    size_mb = sum(len(t.encode("utf-8")) for t in texts) / 2**20
+    print(f"{len(texts)} văn bản, {size_mb:.2f} MB\n")
+
+    mismatches = check(texts, args.seed, args.max_chunk)
+    for name, n in mismatches.items():
+        print(f"{name:<10} {'giống hệt mốc' if not n else f'{n} văn bản KHÁC mốc'}")
+
+    rng = random.Random(args.seed)
+    streams = [split_chunks(t, rng, args.max_chunk) for t in texts]
+    legacy = throughput(legacy_cleanup, texts, args.repeat)
+    fused = throughput(cleanup_response, texts, args.repeat)
+    t0 = time.perf_counter()
+    for chunks in streams:
+        stream_clean(chunks)
+    streaming = size_mb / (time.perf_counter() - t0)
+    print(f"\n{'':<12}{'MB/s':>8}{'x':>7}")
+    for name, mbps in (("cũ", legacy), ("hiện tại", fused), ("streaming", streaming)):
+        print(f"{name:<12}{mbps:>8.2f}{mbps / legacy:>7.2f}")
+    if any(mismatches.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
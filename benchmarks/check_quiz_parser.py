@@ -0,0 +1,137 @@
+"""
+Các bố cục đề đã từng bị tách sai, kèm đáp án (hoặc đề bài và phương án) mong đợi
+cho từng (phần, câu).
+Sửa quiz_parser thì chạy lại:
+    python -m benchmarks.check_quiz_parser        # thoát mã 1 nếu có bố cục sai
+"""
+from typing import Dict, List, Tuple
+
+from src.core.quiz_parser import parse_quiz
+from src.core.text_utils import Question
+
+# (tên, văn bản đề, {(số phần, số câu): đáp án})
+CASES: List[Tuple[str, str, Dict[Tuple[int, int], str]]] = [
+    (
+        # Bảng đáp án riêng cho từng phần (đề THPT): "phan i" không được khớp "phan ii ..."
+        "đáp án PHẦN I / PHẦN II tách bảng",
+        """PHẦN I. Câu trắc nghiệm nhiều phương án lựa chọn
+Câu 1. Kim loại nào dẫn điện tốt nhất?
+A. Fe B. Cu C. Ag D. Au
+Câu 2. Chất nào là chất béo?
+A. Tristearin B. Glixerol C. Etanol D. Glucozơ
+PHẦN II. Câu trắc nghiệm đúng sai
+Câu 1. Cho các phát biểu về sắt:
+a) Sắt là kim loại.
+b) Sắt không tác dụng với dung dịch HCl.
+PHẦN III. Câu trắc nghiệm trả lời ngắn
+Câu 1. Số nguyên tử oxygen trong phân tử glucose là bao nhiêu?
+ĐÁP ÁN PHẦN I
+| Câu | Đáp án |
+| 1 | C |
+| 2 | A |
+ĐÁP ÁN PHẦN II
+| Câu | Lệnh hỏi | Đáp án (Đ/S) |
+| 1 | a | Đ |
+| 1 | b | S |
+ĐÁP ÁN PHẦN III
+| Câu | Đáp án |
+| 1 | 6 |
+""",
+        {(0, 1): "C", (0, 2): "A", (1, 1): "ĐS", (2, 1): "6"},
+    ),
+    (
+        # Tiêu đề đáp án ghi số phần khác cách viết với tiêu đề phần đề
+        "La Mã ở đề, số thường ở đáp án",
+        """I. TRẮC NGHIỆM
+Câu 1. Nguyên tố nào là kim loại kiềm?
+A. Na B. Mg C. Al D. Fe
+II. TRẮC NGHIỆM ĐÚNG SAI
+Câu 1. Về nhôm:
+a) Nhôm là kim loại nhẹ.
+b) Nhôm tan trong nước ở điều kiện thường.
+ĐÁP ÁN PHẦN 2
+| Câu | Lệnh hỏi | Đáp án (Đ/S) |
+| 1 | a | Đ |
+| 1 | b | S |
+ĐÁP ÁN PHẦN 1
+| Câu | Đáp án |
+| 1 | A |
+""",
+        {(0, 1): "A", (1, 1): "ĐS"},
+    ),
+]
+
+# (tên, văn bản đề, {(số phần, số câu): (đề bài, các khoá phương án/ý)})
+LAYOUT_CASES: List[Tuple[str, str, Dict[Tuple[int, int], Tuple[str, str]]]] = [
+    (
+        # Các ý a), b) là một phần đề bài khi sau đó là phương án A-D; phần đúng/sai giữ các ý
+        "đếm phát biểu đúng có phương án A-D",
+        """I. TRẮC NGHIỆM
+Câu 1. Cho các phát biểu sau:
+a) Nhôm là kim loại nhẹ.
+b) Đồng dẫn điện tốt hơn bạc.
+Số phát biểu đúng là
+A. 0 B. 1 C. 2 D. 3
+Câu 2. Cho các nhận định sau:
+a. Glucozơ có phản ứng tráng bạc.
+b. Saccarozơ bị thuỷ phân trong môi trường axit. Số nhận định đúng là
+A. 0
+B. 1
+C. 2
+D. 3
+II. TRẮC NGHIỆM ĐÚNG SAI
+Câu 1. Về sắt:
+a) Sắt là kim loại.
+b) Sắt không tác dụng với dung dịch HCl.
+""",
+        {
+            (0, 1): ("Cho các phát biểu sau: a) Nhôm là kim loại nhẹ. b) Đồng dẫn điện tốt hơn bạc. "
+                     "Số phát biểu đúng là", "ABCD"),
+            (0, 2): ("Cho các nhận định sau: a) Glucozơ có phản ứng tráng bạc. b) Saccarozơ bị thuỷ "
+                     "phân trong môi trường axit. Số nhận định đúng là", "ABCD"),
+            (1, 1): ("Về sắt:", "ab"),
+        },
+    ),
+]
+
+
+def _by_position(text: str) -> Dict[Tuple[int, int], Question]:
+    """Câu hỏi theo (số thứ tự phần, số câu)."""
+    sections: List[str] = []
+    out: Dict[Tuple[int, int], Question] = {}
+    for q in parse_quiz(text):
+        if q.section not in sections:
+            sections.append(q.section)
+        out[(sections.index(q.section), q.index)] = q
+    return out
+
+
+def check() -> List[str]:
+    """Các dòng mô tả chỗ sai (rỗng nếu mọi bố cục đều đúng)."""
+    errors = []
+    for name, text, expected in CASES:
+        got = {key: q.answer for key, q in _by_position(text).items()}
+        for key, want in expected.items():
+            if got.get(key) != want:
+                errors.append(f"[{name}] phần {key[0] + 1} câu {key[1]}: mong {want!r}, nhận {got.get(key)!r}")
+    for name, text, expected in LAYOUT_CASES:
+        questions = _by_position(text)
+        for key, want in expected.items():
+            q = questions.get(key)
+            got = (q.stem, "".join(q.choices)) if q else None
+            if got != want:
+                errors.append(f"[{name}] phần {key[0] + 1} câu {key[1]}: mong {want!r}, nhận {got!r}")
+    return errors
+
+
+def main():
+    errors = check()
+    for line in errors:
+        print(line)
+    print(f"{len(CASES) + len(LAYOUT_CASES)} bố cục đề: {'đúng hết' if not errors else f'{len(errors)} chỗ SAI'}")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
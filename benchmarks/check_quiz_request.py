@@ -0,0 +1,49 @@
+"""
+Các tin nhắn từng bị nhận nhầm là xin đề (app trả về đề từ ngân hàng thay vì trả lời),
+kèm vài yêu cầu thật phải nhận ra. Sửa _RE_QUIZ_REQUEST / _RE_NOT_QUIZ thì chạy lại:
+    python -m benchmarks.check_quiz_request        # thoát mã 1 nếu có tin nhắn nhận sai
+"""
+from typing import List, Optional, Tuple
+
+from src.config import QUIZ_SIZE
+from src.core.quiz_bank import parse_quiz_request
+
+# (tin nhắn, số câu mong đợi; None = không phải xin đề)
+CASES: List[Tuple[str, Optional[int]]] = [
+    ("Cho mình hỏi câu 3 trong đề thi thử THPT năm 2023 là gì?", None),
+    ("Cho 2 câu sau, câu nào đúng: (1) Fe là kim loại; (2) Cu tan trong HCl", None),
+    ("Cho các chất sau: Fe, Cu, Al. Chọn chất đúng trong 4 câu phát biểu sau", None),
+    ("Cho 2,7 gam Al tác dụng với dung dịch HCl dư, tính thể tích khí H2", None),
+    ("Phản ứng này tạo ra vấn đề gì cho môi trường", None),
+    ("Giải đề thi thử THPT 2023 câu 5", None),
+    ("Cho mình đề 10 câu về liên kết hoá học", 10),
+    ("tạo đề 5 câu về axit sunfuric", 5),
+    ("tạo quiz bảng tuần hoàn", QUIZ_SIZE),
+    ("ra 5 câu trắc nghiệm đúng sai lớp 10", 5),
+    ("Soạn giúp mình bài kiểm tra 15 câu chương este", 15),
+    ("xin đề ôn tập chương nitơ lớp 11", QUIZ_SIZE),
+]
+
+
+def check() -> List[str]:
+    """Các dòng mô tả tin nhắn nhận sai (rỗng nếu đúng hết)."""
+    errors = []
+    for text, want in CASES:
+        request = parse_quiz_request(text)
+        got = request.size if request else None
+        if got != want:
+            errors.append(f"{text!r}: mong {want!r}, nhận {got!r}")
+    return errors
+
+
+def main():
+    errors = check()
+    for line in errors:
+        print(line)
+    print(f"{len(CASES)} tin nhắn: {'đúng hết' if not errors else f'{len(errors)} tin nhắn SAI'}")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Các câu hỏi try_stoichiometry từng giải tại chỗ ra đáp số sai (phải để Gemini trả lời),
+kèm vài câu một chất vẫn phải giải tại chỗ. Sửa nhận dạng trong math_engine thì chạy lại:
+    python -m benchmarks.check_stoichiometry        # thoát mã 1 nếu có câu sai
+"""
+from typing import List, Optional, Tuple
+
+from src.core.math_engine import try_stoichiometry
+
+# (câu hỏi, dòng đáp số mong đợi; None = không giải tại chỗ)
+CASES: List[Tuple[str, Optional[str]]] = [
+    # Số mol ion khác số mol chất: Cl- trong CaCl2 0,5M là 0,2 chứ không phải 0,1
+    ("Tính số mol ion Cl- trong 200 ml dung dịch CaCl2 0,5M", None),
+    ("Tính số mol Fe3+ có trong 0,1 mol Fe2(SO4)3", None),
+    ("Tính số mol nguyên tử O trong 0,1 mol H2SO4", None),
+    # Nước không phải chất khí: không đổi V <-> n qua 24,79 L/mol
+    ("Tính thể tích của 9 gam nước H2O", None),
+    ("Tính số mol của 100 ml nước H2O", None),
+    ("Tính thể tích không khí chứa 0,2 mol O2", None),
+    ("Tính số mol của 5,6 gam Fe", "**Đáp số:** số mol n = 0,1 mol"),
+    ("Tính thể tích của 6,4 gam O2 (đktc)", "**Đáp số:** thể tích khí V = 4,48 L"),
+    ("Tính khối lượng của 3,7185 lít khí NH3", "**Đáp số:** khối lượng m = 2,55 g"),
+    ("Tính phân tử khối của H2SO4", "**Đáp số:** khối lượng mol M = 98 g/mol"),
+    ("Tính C_M khi hoà tan 5,85 g NaCl thành 200 ml dung dịch", "**Đáp số:** nồng độ mol C_M = 0,5 M"),
+]
+
+
+def check() -> List[str]:
+    """Các dòng mô tả câu giải sai (rỗng nếu đúng hết)."""
+    errors = []
+    for question, want in CASES:
+        answer = try_stoichiometry(question)
+        got = answer.splitlines()[-1] if answer else None
+        if got != want:
+            errors.append(f"{question!r}: mong {want!r}, nhận {got!r}")
+    return errors
+
+
+def main():
+    errors = check()
+    for line in errors:
+        print(line)
+    print(f"{len(CASES)} câu hỏi: {'đúng hết' if not errors else f'{len(errors)} câu SAI'}")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
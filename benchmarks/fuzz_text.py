@@ -0,0 +1,139 @@
+"""
+Kiểm thử ngẫu nhiên StreamingCleaner: cắt văn bản thành các mảnh ngẫu nhiên (kể cả mảnh rỗng,
+mảnh 1 ký tự) như khi stream Gemini, kết quả ghép feed() + flush() phải giống hệt
+cleanup_response trên cả văn bản, với mọi tổ hợp 6 tuỳ chọn do_*.
+
+Văn bản gồm các mẫu dễ vỡ khi cắt (LaTeX, ^{2-}, "Câu 1:" xuống dòng, phương án A./B.,
+tiêu đề La Mã, mũi tên, markdown) ghép ngẫu nhiên, cộng SAMPLE_ANSWERS và chunks.jsonl.
+Với văn xuôi nhiều câu (có hoặc không xuống dòng, gạch đầu dòng "- "/"* ", tiêu đề "#"),
+phần bị giữ lại sau mỗi feed() còn phải ngắn hơn câu dài nhất cộng vài ký tự.
+Sửa _LAYOUT_STARTERS, điều kiện điểm cắt an toàn hay regex trong text_utils thì chạy lại:
+    python -m benchmarks.fuzz_text                 # 20000 lượt, thoát mã 1 nếu có khác biệt
+    python -m benchmarks.fuzz_text --cases 100000 --seed 7
+"""
+import argparse
+import itertools
+import random
+from typing import Dict, List, Tuple
+
+from benchmarks.bench_text import CHUNKS_PATH, SAMPLE_ANSWERS, load_corpus
+from src.core.text_utils import StreamingCleaner, cleanup_response
+
+OPTIONS = ("do_symbols", "do_supersubs", "do_sanitize_md", "do_fix_spacing", "do_exam_layout", "do_arrow_space")
+# Mọi tổ hợp bật/tắt của 6 tuỳ chọn
+COMBINATIONS: List[Dict[str, bool]] = [dict(zip(OPTIONS, bits)) for bits in itertools.product((True, False), repeat=6)]
+
+FRAGMENTS = [
+    "\n", "\n", "\n\n", " ", "  ", "\t", "<br>", "<br/>", "$", "**", "* ", "```python\n", "```\n",
+    "Câu", "Câu ", "câu", "Câu 1", "Câu 12:", ":", "Câu 3.", "\nCâu 2:", "câu 4:", "\ncâu 5 :", "1", " 2", "34",
+    "A.", "B. ", "C.", "D.", "c.", "\nA. ", "\nD. ", "I.", "II. ", "IV.", "\nIII. ", "\nXL.", "\nL. ",
+    "Câu\n", "Câu 2\n", "Câu$", "Câu 3 **", "Câu<br>", "\n12:", "\n7 :",
+    "PHẦN I", "TRẮC NGHIỆM (4,0 điểm)", "- ", ".", ",", ";", "?", "!",
+    "H_2SO_4", "SO_4^{2-}", "Fe^{3+}", "^{", "}", "{", "_{10}", "^2", "x_1", "\\text{mol}",
+    "\\rightarrow", "\\to", "\\rightleftharpoons", "\\Delta", "\\alpha", "\\geq", "→", "->",
+    "Fe", "Cu", "NaOH", "0,5", "24,79", "mol", "Axit", "chất béo", "Ví dụ", "1)", "(", ")",
+    "Đáp án", "Xét", "Lời giải", "n = m/M", "V = n × 24,79", "LAVA", "Xanh", "Bước 1:",
+    ". ", "! ", "? ", "; ", ": ", "* ", "** ", "*$ ", "# ", "> ", "A$.", "C$âu 6:", "Cho ", "Các ",
+]
+
+# Văn xuôi: mỗi câu mở đầu bằng một từ dưới đây, sau tiền tố xuống dòng / markdown
+PROSE_STARTS = ["Cho", "Các", "Dung dịch", "Bước 1:", "Ion", "Vậy", "Xét", "Lời giải", "Khi",
+                "Ta có", "Nước", "Số mol", "Đáp án", "Chất", "Ví dụ", "**Lưu ý:**", "(1)"]
+PROSE_WORDS = ["NaOH", "0,5M", "mol", "dung dịch", "tác dụng", "với", "thu được", "khí", "H₂",
+               "(đktc)", "Fe^{3+}", "kết tủa", "là", "24,79", "nên", "→", "$x$", "A", "C"]
+PROSE_PREFIXES = ["", "", "", "\n", "\n\n", "\n- ", "\n* ", "\n* **", "\n# ", "\n## ", "\n> "]
+# Số ký tự đầu câu phải xem để biết có cắt được không (tiền tố dài nhất + 2)
+HELD_SLACK = 8
+
+
+def random_text(rng: random.Random, max_fragments: int = 40) -> str:
+    return "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, max_fragments)))
+
+
+def random_prose(rng: random.Random, max_sentences: int = 40) -> Tuple[str, int]:
+    """Văn xuôi nhiều câu và số ký tự được phép giữ lại sau mỗi feed()."""
+    parts = []
+    for _ in range(rng.randint(1, max_sentences)):
+        words = [rng.choice(PROSE_STARTS)] + [rng.choice(PROSE_WORDS) for _ in range(rng.randint(0, 15))]
+        parts.append(rng.choice(PROSE_PREFIXES) + " ".join(words) + rng.choice(".!?;:") + " ")
+    return "".join(parts), max(map(len, parts)) + HELD_SLACK
+
+
+def random_window(text: str, rng: random.Random, size: int = 1500) -> str:
+    """Một đoạn ngẫu nhiên của văn bản thật (cắt chunk 1 ký tự trên cả file thì quá chậm)."""
+    start = rng.randint(0, max(0, len(text) - size))
+    return text[start:start + rng.randint(1, size)]
+
+
+def random_split(text: str, rng: random.Random) -> List[str]:
+    """Cắt tại các vị trí ngẫu nhiên; đôi khi chèn mảnh rỗng hoặc dồn cả văn bản vào một mảnh."""
+    if rng.random() < 0.05:
+        return [text]
+    max_len = rng.choice((1, 2, 3, 8, 40))
+    out, i = [], 0
+    while i < len(text):
+        if rng.random() < 0.05:
+            out.append("")
+        j = i + rng.randint(1, max_len)
+        out.append(text[i:j])
+        i = j
+    return out
+
+
+def stream_clean(chunks: List[str], options: Dict[str, bool]) -> Tuple[str, int]:
+    """Kết quả ghép feed() + flush() và số ký tự giữ lại nhiều nhất sau một lần feed()."""
+    cleaner = StreamingCleaner(**options)
+    out, held = [], 0
+    for chunk in chunks:
+        out.append(cleaner.feed(chunk))
+        held = max(held, cleaner.held)
+    return "".join(out) + cleaner.flush(), held
+
+
+def fuzz(texts: List[str], cases: int, seed: int) -> List[Tuple[str, List[str], Dict[str, bool], str, str, str]]:
+    """
+    Trả về các trường hợp chunked ≠ cả văn bản hoặc giữ lại quá nhiều:
+    (văn bản, mảnh, tuỳ chọn, mong đợi, nhận được, mô tả phần giữ lại).
+    """
+    rng = random.Random(seed)
+    failures = []
+    for case in range(cases):
+        limit = None
+        pick = rng.random()
+        if texts and pick < 0.2:
+            text = random_window(rng.choice(texts), rng)
+        elif pick < 0.3:
+            text, limit = random_prose(rng)
+        else:
+            text = random_text(rng)
+        options = COMBINATIONS[case % len(COMBINATIONS)]
+        chunks = random_split(text, rng)
+        want = cleanup_response(text, **options)
+        got, held = stream_clean(chunks, options)
+        if got != want or (limit is not None and held > limit):
+            failures.append((text, chunks, options, want, got, f"giữ lại tối đa {held} ký tự (cho phép {limit})"))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kiểm thử ngẫu nhiên StreamingCleaner so với cleanup_response")
+    parser.add_argument("--cases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", nargs="*", default=[CHUNKS_PATH],
+                        help="Văn bản thật trộn vào (mặc định chunks.jsonl nếu có)")
+    args = parser.parse_args(argv)
+
+    texts = load_corpus(args.corpus) + SAMPLE_ANSWERS
+    failures = fuzz(texts, args.cases, args.seed)
+    print(f"{args.cases} lượt, {len(COMBINATIONS)} tổ hợp tuỳ chọn: "
+          f"{'chunked giống hệt cả văn bản' if not failures else f'{len(failures)} lượt KHÁC'}")
+    if failures:
+        text, chunks, options, want, got, held = min(failures, key=lambda f: len(f[0]))
+        off = [name for name, on in options.items() if not on]
+        print(f"Ví dụ ngắn nhất (tắt: {', '.join(off) or 'không'}, {held}):\n"
+              f"  vào   : {text!r}\n  mảnh  : {chunks!r}\n  mong  : {want!r}\n  nhận  : {got!r}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import json
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -17,11 +18,84 @@ GEMINI_API_KEY = get_secret("GOOGLE_API_KEY")
 GEMINI_MODEL = get_secret("GEMINI_MODEL", "gemini-1.5-flash-8b")
 EMBED_MODEL = get_secret("EMBED_MODEL", "text-embedding-004")
 
+# Backend nhúng: "gemini" (API) hoặc "local" (sentence-transformers chạy trên CPU, không cần mạng)
+EMBED_BACKEND = get_secret("EMBED_BACKEND", "gemini")
+LOCAL_EMBED_MODEL = get_secret("LOCAL_EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+LOCAL_EMBED_DEVICE = get_secret("LOCAL_EMBED_DEVICE", "cpu")
+
 # Retrieval
 TOP_K = int(get_secret("TOP_K", 4))
 CHUNK_SIZE = int(get_secret("CHUNK_SIZE", 900))
 CHUNK_OVERLAP = int(get_secret("CHUNK_OVERLAP", 200))
 MIN_SIMILARITY = float(get_secret("MIN_SIMILARITY", 0.32))
+# Truy hồi lai (BM25 + vector): số ứng viên mỗi nhánh và hằng số k của reciprocal rank fusion
+HYBRID_CANDIDATES = int(get_secret("HYBRID_CANDIDATES", 20))
+RRF_K = int(get_secret("RRF_K", 60))
+# Re-rank: over-fetch RERANK_CANDIDATES ứng viên rồi chọn top-k đa dạng bằng MMR;
+# RERANK_CROSS_ENCODER (tên model sentence-transformers, để trống = tắt) chấm lại độ liên quan
+RERANK_ENABLED = str(get_secret("RERANK_ENABLED", "true")).lower() in ("1", "true", "yes")
+RERANK_CANDIDATES = int(get_secret("RERANK_CANDIDATES", 20))
+MMR_LAMBDA = float(get_secret("MMR_LAMBDA", 0.7))
+RERANK_CROSS_ENCODER = get_secret("RERANK_CROSS_ENCODER", "")
+
+# Chế độ học (sidebar) -> ngân sách token cho phần tài liệu tham khảo trong prompt.
+# Ghi đè bằng JSON, vd. MODE_CONTEXT_BUDGETS='{"Bình thường": 1500}'
+CONTEXT_TOKEN_BUDGET = int(get_secret("CONTEXT_TOKEN_BUDGET", 1800))
+MODE_CONTEXT_BUDGETS = {
+    "Bình thường": CONTEXT_TOKEN_BUDGET,
+    "🐢 Học chậm (Chi tiết)": 2400,
+    "🚀 Nâng cao (Học sinh giỏi)": 3000,
+    "⚡ Ôn thi cấp tốc": 1200,
+    "💪 Thực hành": 2000,
+    "🎮 Giải trí (Sắp có)": 1000,
+}
+try:
+    MODE_CONTEXT_BUDGETS.update({k: int(v) for k, v in json.loads(get_secret("MODE_CONTEXT_BUDGETS", "") or "{}").items()})
+except (ValueError, AttributeError):
+    print("Cảnh báo: MODE_CONTEXT_BUDGETS không phải JSON hợp lệ, dùng giá trị mặc định.")
+MODES = list(MODE_CONTEXT_BUDGETS)
+
+# Giới hạn gọi Gemini trong process (embed + generate dùng chung): request/phút và token/phút.
+# Đặt theo quota của API key; 0 = không giới hạn
+GEMINI_RPM = float(get_secret("GEMINI_RPM", 60))
+GEMINI_TPM = float(get_secret("GEMINI_TPM", 1000000))
+# Mở sẵn kết nối tới Gemini khi đã rảnh quá số giây này (0 = tắt)
+GEMINI_PREWARM_IDLE = float(get_secret("GEMINI_PREWARM_IDLE", 120))
+
+# Hội thoại nhiều lượt: lịch sử gửi kèm prompt giữ dưới HISTORY_TOKEN_BUDGET token; vượt ngưỡng thì
+# các lượt cũ (trừ HISTORY_RECENT_TURNS lượt gần nhất) được tóm tắt còn ~HISTORY_SUMMARY_TOKENS token
+HISTORY_TOKEN_BUDGET = int(get_secret("HISTORY_TOKEN_BUDGET", 1200))
+HISTORY_RECENT_TURNS = int(get_secret("HISTORY_RECENT_TURNS", 2))
+HISTORY_ANSWER_TOKENS = int(get_secret("HISTORY_ANSWER_TOKENS", 300))
+HISTORY_SUMMARY_TOKENS = int(get_secret("HISTORY_SUMMARY_TOKENS", 300))
+# Viết lại câu hỏi tiếp nối ("còn câu 2 thì sao?") thành câu độc lập trước khi truy hồi
+QUERY_REWRITE_ENABLED = str(get_secret("QUERY_REWRITE_ENABLED", "true")).lower() in ("1", "true", "yes")
+
+# Số câu mặc định của đề lắp từ ngân hàng câu hỏi (data/processed/quiz_bank.jsonl)
+QUIZ_SIZE = int(get_secret("QUIZ_SIZE", 10))
+
+# Cache embedding câu hỏi trong process (số mục, thời hạn tính bằng giây)
+QUERY_CACHE_SIZE = int(get_secret("QUERY_CACHE_SIZE", 2048))
+QUERY_CACHE_TTL = float(get_secret("QUERY_CACHE_TTL", 3600))
+
+# Cache câu trả lời theo ngữ nghĩa (tắt mặc định)
+ANSWER_CACHE_ENABLED = str(get_secret("ANSWER_CACHE_ENABLED", "false")).lower() in ("1", "true", "yes")
+ANSWER_CACHE_THRESHOLD = float(get_secret("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_SIZE = int(get_secret("ANSWER_CACHE_SIZE", 500))
+
+# Embedding pipeline (build_index)
+EMBED_BATCH_SIZE = int(get_secret("EMBED_BATCH_SIZE", 100))
+EMBED_WORKERS = int(get_secret("EMBED_WORKERS", 4))
+EMBED_MAX_RETRIES = int(get_secret("EMBED_MAX_RETRIES", 5))
+EMBED_CACHE_DIR = get_secret("EMBED_CACHE_DIR", "indexes/embed_cache")
+# Số embedding câu hỏi tối đa giữ trên đĩa cho mỗi task_type (vượt thì bỏ một nửa cũ nhất)
+EMBED_CACHE_MAX_QUERIES = int(get_secret("EMBED_CACHE_MAX_QUERIES", 20000))
+INDEX_STREAM_BATCH = int(get_secret("INDEX_STREAM_BATCH", 1000))
+
+# Vector index: Flat | IVF<nlist>,Flat | HNSW<M> | IVF<nlist>,PQ<m>, và tham số lúc tìm kiếm
+INDEX_SPEC = get_secret("INDEX_SPEC", "Flat")
+FAISS_NPROBE = int(get_secret("FAISS_NPROBE", 16))
+FAISS_EF_SEARCH = int(get_secret("FAISS_EF_SEARCH", 64))
 
 # Persistence
 MONGO_URI = get_secret("MONGO_URI", "")
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from src.config import ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD
+from src.core import metrics
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    text: str
+    sources: List[dict] = field(default_factory=list)
+    strategy: str = ""
+    top_score: float = 0.0
+
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời theo ngữ nghĩa: mỗi chế độ học có một FAISS index nhỏ chứa
+    embedding các câu hỏi đã trả lời. Câu hỏi mới có cosine ≥ `threshold` với một
+    câu đã lưu (cùng chế độ) sẽ nhận lại câu trả lời cũ. Vượt `maxsize` thì bỏ mục
+    ít dùng nhất (LRU) khỏi cả index.
+    """
+
+    def __init__(self, maxsize: int = ANSWER_CACHE_SIZE, threshold: float = ANSWER_CACHE_THRESHOLD):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._indexes: Dict[str, faiss.IndexIDMap2] = {}
+        self._entries: "OrderedDict[int, Tuple[str, CachedAnswer]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, mode: str, vec: np.ndarray) -> Optional[CachedAnswer]:
+        with self._lock:
+            index = self._indexes.get(mode)
+            if index is None or index.ntotal == 0 or index.d != vec.shape[-1]:
+                metrics.incr("answer_cache.miss")
+                return None
+            scores, ids = index.search(vec.reshape(1, -1).astype(np.float32), 1)
+            entry_id, score = int(ids[0][0]), float(scores[0][0])
+            if entry_id < 0 or score < self.threshold:
+                metrics.incr("answer_cache.miss")
+                return None
+            self._entries.move_to_end(entry_id)
+            # Đọc trong lúc giữ khoá: `store` ở luồng khác có thể loại mục này ngay sau đó
+            answer = self._entries[entry_id][1]
+        metrics.incr("answer_cache.hit")
+        return answer
+
+    def store(self, mode: str, vec: np.ndarray, answer: CachedAnswer) -> None:
+        if self.maxsize <= 0:
+            return
+        vec = vec.reshape(1, -1).astype(np.float32)
+        with self._lock:
+            index = self._indexes.get(mode)
+            if index is None or index.d != vec.shape[1]:
+                index = faiss.IndexIDMap2(faiss.IndexFlatIP(vec.shape[1]))
+                self._indexes[mode] = index
+            entry_id = self._next_id
+            self._next_id += 1
+            index.add_with_ids(vec, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (mode, answer)
+            while len(self._entries) > self.maxsize:
+                old_id, (old_mode, _) = self._entries.popitem(last=False)
+                old_index = self._indexes.get(old_mode)
+                if old_index is not None:
+                    old_index.remove_ids(np.array([old_id], dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional
+
+# Một event loop chạy nền cho cả process: mọi lời gọi async (Gemini, embedding) của các
+# phiên Streamlit đều chạy trên loop này thay vì mỗi phiên giữ một thread chờ mạng/backoff.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Event loop nền dùng chung (tạo lần đầu khi cần, chạy trong một daemon thread)."""
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="chema-async-loop", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def _check_caller(loop: asyncio.AbstractEventLoop) -> None:
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    if running is loop:
+        raise RuntimeError("Không gọi wrapper đồng bộ từ bên trong event loop nền (sẽ tự khoá); dùng await.")
+
+
+def run(coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+    """Chạy coroutine trên loop nền và chờ kết quả từ thread hiện tại."""
+    loop = get_loop()
+    _check_caller(loop)
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+def iterate(agen: AsyncIterator[Any], timeout: Optional[float] = None) -> Iterator[Any]:
+    """
+    Duyệt async generator từ code đồng bộ: từng phần tử được lấy trên loop nền.
+    Người đọc dừng sớm (vd. phiên Streamlit bị dừng) thì async generator được đóng trên loop.
+    """
+    loop = get_loop()
+    _check_caller(loop)
+    try:
+        while True:
+            try:
+                item = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result(timeout)
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        try:
+            asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result(timeout)
+        except Exception as e:
+            print(f"Lỗi khi đóng async stream: {e}")
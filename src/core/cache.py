@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from src.core import metrics
+
+
+class LRUCache:
+    """
+    LRU có hạn dùng (TTL), an toàn giữa các thread.
+    `name` dùng làm tiền tố cho bộ đếm `<name>.hit` / `<name>.miss` trong metrics.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, name: str = "cache"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                metrics.incr(f"{self.name}.miss")
+                return None
+            self._data.move_to_end(key)
+        metrics.incr(f"{self.name}.hit")
+        return item[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi trùng khoá đang chạy đồng thời: chỉ lời gọi đầu tiên thực thi `fn`,
+    các lời gọi sau chờ và nhận cùng kết quả (hoặc cùng exception).
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                self._inflight[key] = fut
+        if not leader:
+            metrics.incr(f"{self.name}.coalesced")
+            return fut.result()
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return fut.result()
+
+
+class AsyncSingleFlight:
+    """
+    Bản asyncio của SingleFlight cho các coroutine chạy trên cùng một event loop:
+    lời gọi trùng khoá chờ chung một task thay vì gọi API lần nữa.
+    Người chờ bị huỷ không huỷ task đang chạy cho những người chờ khác.
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._inflight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._inflight.get(key)
+        if fut is not None:
+            metrics.incr(f"{self.name}.coalesced")
+            return await asyncio.shield(fut)
+        fut = asyncio.ensure_future(fn())
+        self._inflight[key] = fut
+        fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(fut)
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.core.doc_meta import source_metadata
+
+CHUNK_STORE_DIR = "indexes/chunks"
+
+# Các cột chuỗi lặp lại nhiều (mã hoá từ điển: mỗi hàng lưu một mã int32)
+_CODED_COLUMNS = ("source", "section", "doc_type")
+# Các cột số nhỏ (0 = không xác định)
+_INT_COLUMNS = {"grade": np.int8, "lesson": np.int16}
+
+
+class _BlobWriter:
+    """Ghi nối tiếp các chuỗi UTF-8 vào một blob và ghi nhớ offset."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path + ".bin", "wb")
+        self.offsets = array("q", [0])
+
+    def add(self, text: str) -> None:
+        data = text.encode("utf-8")
+        self._f.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self) -> None:
+        self._f.close()
+        np.save(self.path + ".offsets.npy", np.frombuffer(self.offsets, dtype=np.int64))
+
+    def abort(self) -> None:
+        self._f.close()
+
+
+class _Blob:
+    """Đọc chuỗi thứ i từ blob đã memory-map, không nạp cả file vào RAM."""
+
+    def __init__(self, path: str):
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        size = os.path.getsize(path + ".bin")
+        self.data = np.memmap(path + ".bin", dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+
+    def __getitem__(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self.data[start:end].tobytes().decode("utf-8")
+
+
+class ChunkStoreWriter:
+    """
+    Ghi chunk store theo luồng (mỗi lần một bản ghi). Thứ tự hàng = thứ tự add,
+    trùng với thứ tự dòng trong meta.jsonl.
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_DIR):
+        self.path = path
+        self._tmp = path + ".tmp"
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        os.makedirs(self._tmp)
+        self._text = _BlobWriter(os.path.join(self._tmp, "text"))
+        self._ids = _BlobWriter(os.path.join(self._tmp, "ids"))
+        self._vids = array("q")
+        self._codes = {c: array("i") for c in _CODED_COLUMNS}
+        self._ints = {c: array("i") for c in _INT_COLUMNS}
+        self._tables: Dict[str, Dict[str, int]] = {c: {} for c in _CODED_COLUMNS}
+
+    def add(self, rec: dict, vid: int) -> None:
+        self._text.add(rec.get("text", ""))
+        self._ids.add(rec["id"])
+        self._vids.append(vid)
+        # chunks.jsonl cũ chưa có grade/lesson/doc_type: suy ra từ đường dẫn nguồn
+        if "doc_type" not in rec:
+            rec = {**source_metadata(rec.get("source", "")), **rec}
+        for col in _CODED_COLUMNS:
+            table = self._tables[col]
+            value = rec.get(col, "")
+            self._codes[col].append(table.setdefault(value, len(table)))
+        for col in _INT_COLUMNS:
+            self._ints[col].append(int(rec.get(col) or 0))
+
+    def close(self) -> None:
+        """Ghi các cột còn lại rồi thay thế store cũ một cách nguyên tử (đổi tên thư mục)."""
+        self._text.close()
+        self._ids.close()
+        vids = np.frombuffer(self._vids, dtype=np.int64)
+        np.save(os.path.join(self._tmp, "vid.npy"), vids)
+        order = np.argsort(vids, kind="stable")
+        np.save(os.path.join(self._tmp, "vid_order.npy"), order)
+        np.save(os.path.join(self._tmp, "vid_sorted.npy"), vids[order])
+        for col in _CODED_COLUMNS:
+            np.save(os.path.join(self._tmp, f"{col}.npy"), np.frombuffer(self._codes[col], dtype=np.int32))
+        for col, dtype in _INT_COLUMNS.items():
+            np.save(os.path.join(self._tmp, f"{col}.npy"), np.frombuffer(self._ints[col], dtype=np.int32).astype(dtype))
+        with open(os.path.join(self._tmp, "strings.json"), "w", encoding="utf-8") as f:
+            json.dump({c: list(self._tables[c]) for c in _CODED_COLUMNS}, f, ensure_ascii=False)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        """Bỏ dở: đóng file và xoá thư mục tạm, store cũ giữ nguyên."""
+        self._text.abort()
+        self._ids.abort()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+
+class ChunkStore:
+    """
+    Kho chunk chỉ đọc: text và id nằm trong blob memory-map, metadata ở dạng cột numpy.
+    Mở store là O(1) (chỉ map file), trang dữ liệu được chia sẻ giữa các process
+    qua page cache, và chỉ các hàng được truy hồi mới thực sự được đọc.
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_DIR):
+        self.path = path
+        self._text = _Blob(os.path.join(path, "text"))
+        self._ids = _Blob(os.path.join(path, "ids"))
+        self.vids = np.load(os.path.join(path, "vid.npy"), mmap_mode="r")
+        self._vid_order = np.load(os.path.join(path, "vid_order.npy"), mmap_mode="r")
+        self._vid_sorted = np.load(os.path.join(path, "vid_sorted.npy"), mmap_mode="r")
+        self.columns = {c: np.load(os.path.join(path, f"{c}.npy"), mmap_mode="r") for c in _CODED_COLUMNS}
+        self.int_columns = {c: np.load(os.path.join(path, f"{c}.npy"), mmap_mode="r") for c in _INT_COLUMNS}
+        with open(os.path.join(path, "strings.json"), "r", encoding="utf-8") as f:
+            self._tables: Dict[str, List[str]] = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.vids)
+
+    def rows_for_vids(self, vids: Iterable[int]) -> np.ndarray:
+        """Đổi id FAISS (vid) sang số hàng; -1 nếu không có."""
+        vids = np.asarray(list(vids), dtype=np.int64)
+        if len(self) == 0 or vids.size == 0:
+            return np.full(vids.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(self._vid_sorted, vids)
+        pos = np.clip(pos, 0, len(self) - 1)
+        rows = np.asarray(self._vid_order[pos], dtype=np.int64)
+        rows[np.asarray(self._vid_sorted[pos]) != vids] = -1
+        return rows
+
+    def text(self, row: int) -> str:
+        return self._text[row]
+
+    def chunk_id(self, row: int) -> str:
+        return self._ids[row]
+
+    def value(self, column: str, row: int) -> str:
+        return self._tables[column][int(self.columns[column][row])]
+
+    def meta(self, row: int) -> dict:
+        return {
+            "id": self.chunk_id(row),
+            "source": self.value("source", row),
+            "section": self.value("section", row),
+            "grade": int(self.int_columns["grade"][row]),
+            "lesson": int(self.int_columns["lesson"][row]),
+            "doc_type": self.value("doc_type", row),
+        }
+
+    def filter_mask(self, filters: Optional[dict]) -> Optional[np.ndarray]:
+        """
+        Mặt nạ bool các hàng thoả bộ lọc, vd. {"grade": 12}, {"grade": [11, 12], "doc_type": "theory"}.
+        Tính trên cột numpy, không đọc text. None nếu không có bộ lọc nào.
+        Cột không hỗ trợ -> ValueError.
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v not in (None, "", [], ())}
+        if not filters:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        for col, wanted in filters.items():
+            values = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            if col in self.int_columns:
+                mask &= np.isin(self.int_columns[col], [int(v) for v in values])
+            elif col in self.columns:
+                codes = [i for i, s in enumerate(self._tables[col]) if s in set(values)]
+                mask &= np.isin(self.columns[col], codes)
+            else:
+                raise ValueError(f"Không hỗ trợ lọc theo cột {col!r}")
+        return mask
+
+    @classmethod
+    def build_from_jsonl(cls, chunks_path: str, meta_path: str, path: str = CHUNK_STORE_DIR) -> "ChunkStore":
+        """
+        Dựng store từ chunks.jsonl + meta.jsonl (hai file cùng thứ tự dòng).
+        Meta cũ không có 'vid' (index phẳng theo vị trí) thì vid = số thứ tự dòng.
+        """
+        writer = ChunkStoreWriter(path)
+        with open(chunks_path, "r", encoding="utf-8") as cf, open(meta_path, "r", encoding="utf-8") as mf:
+            for row, (cline, mline) in enumerate(zip(cf, mf)):
+                rec, meta = json.loads(cline), json.loads(mline)
+                if rec["id"] != meta["id"]:
+                    raise ValueError(f"chunks.jsonl và meta.jsonl lệch nhau tại dòng {row}: {rec['id']} != {meta['id']}")
+                writer.add(rec, meta.get("vid", row))
+        writer.close()
+        return cls(path)
+
+
+def open_chunk_store(chunks_path: str, meta_path: str, path: str = CHUNK_STORE_DIR) -> ChunkStore:
+    """Mở store; nếu chưa có (index build bằng phiên bản cũ) thì dựng một lần từ jsonl."""
+    try:
+        return ChunkStore(path)
+    except FileNotFoundError:
+        print(f"Chưa có chunk store tại {path}, đang dựng từ {chunks_path}...")
+        return ChunkStore.build_from_jsonl(chunks_path, meta_path, path)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence
+
+from src.core.lexical_index import query_terms, tokenize
+from src.core.text_utils import estimate_tokens
+
+# Kích thước một đoạn (passage) khi cắt chunk để chọn phần liên quan nhất
+PASSAGE_TOKENS = 80
+# Dòng ngắn hơn thế này (vd. "A. 2") không dùng để khử trùng lặp
+_MIN_DEDUPE_CHARS = 24
+# Mỗi nguồn xếp sau bị giảm trọng số: nguồn được truy hồi cao hơn được ưu tiên hơn
+_RANK_DECAY = 0.15
+
+
+@dataclass
+class _Passage:
+    source: int
+    order: int
+    lines: List[str]
+    tokens: int
+    score: float = 0.0
+
+
+@dataclass
+class PackedContext:
+    """Khối tài liệu tham khảo đã cắt theo ngân sách token."""
+    block: str
+    sources: List[dict]
+    source_tokens: Dict[str, int] = field(default_factory=dict)
+    total_tokens: int = 0
+
+
+def _normalize_line(line: str) -> str:
+    return " ".join(line.lower().split())
+
+
+def split_passages(text: str, max_tokens: int = PASSAGE_TOKENS) -> List[List[str]]:
+    """Gom các dòng liên tiếp thành đoạn tối đa ~max_tokens token (một dòng dài vẫn là một đoạn)."""
+    passages: List[List[str]] = []
+    current: List[str] = []
+    size = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        n = estimate_tokens(line)
+        if current and size + n > max_tokens:
+            passages.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += n
+    if current:
+        passages.append(current)
+    return passages
+
+
+def _truncate(lines: List[str], budget: int) -> List[str]:
+    """Cắt đoạn (theo từ) cho vừa `budget` token, dùng khi đoạn tốt nhất vẫn quá dài."""
+    out: List[str] = []
+    for line in lines:
+        n = estimate_tokens(line)
+        if n <= budget:
+            out.append(line)
+            budget -= n
+            continue
+        words = line.split()
+        kept: List[str] = []
+        for w in words:
+            cost = estimate_tokens(w)
+            if cost > budget:
+                break
+            kept.append(w)
+            budget -= cost
+        if kept:
+            out.append(" ".join(kept) + " …")
+        break
+    return out
+
+
+def pack_context(question: str, contexts: Sequence[dict], budget: int) -> PackedContext:
+    """
+    Ghép tài liệu tham khảo cho prompt trong giới hạn `budget` token:
+    - cắt mỗi chunk thành đoạn, chấm điểm đoạn theo mức trùng từ khoá/công thức với câu hỏi
+      (trọng số IDF trong chính tập đoạn, giảm dần theo thứ hạng nguồn);
+    - chọn tham lam các đoạn điểm cao cho tới khi hết ngân sách;
+    - bỏ các dòng đã xuất hiện ở đoạn đã chọn (chunk gối đầu nhau, đề thi lặp lại);
+    - mỗi nguồn giữ đúng thứ tự gốc của các đoạn được chọn.
+    Nguồn không còn đoạn nào bị loại khỏi prompt và khỏi `sources`.
+    """
+    passages: List[_Passage] = []
+    for s, ctx in enumerate(contexts):
+        for o, lines in enumerate(split_passages(ctx.get("text", ""))):
+            passages.append(_Passage(s, o, lines, estimate_tokens("\n".join(lines))))
+    if not passages or budget <= 0:
+        return PackedContext(block="", sources=[])
+
+    # IDF cục bộ: từ có trong mọi đoạn (vd. "câu", "phản ứng") gần như không được điểm
+    terms = set(query_terms(question))
+    passage_terms = [Counter(t for t in tokenize("\n".join(p.lines)) if t in terms) for p in passages]
+    df = Counter(t for c in passage_terms for t in c)
+    n = len(passages)
+    for p, counts in zip(passages, passage_terms):
+        overlap = sum(math.log(1 + n / df[t]) * (1 + math.log(c)) for t, c in counts.items())
+        p.score = overlap / math.sqrt(max(p.tokens, 1)) / (1 + _RANK_DECAY * p.source)
+
+    header_tokens = [estimate_tokens(f"Nguồn {i + 1} (score: 0.00):") for i in range(len(contexts))]
+    # Đoạn đầu của nguồn xếp cao hơn thắng khi hoà điểm (vd. câu hỏi không có từ khoá nào khớp)
+    ranked = sorted(passages, key=lambda p: (-p.score, p.source, p.order))
+    chosen: Dict[int, List[_Passage]] = {}
+    seen_lines = set()
+    remaining = budget
+    for p in ranked:
+        lines = [l for l in p.lines
+                 if len(l) < _MIN_DEDUPE_CHARS or _normalize_line(l) not in seen_lines]
+        if not lines:
+            continue
+        cost = estimate_tokens("\n".join(lines)) + (0 if p.source in chosen else header_tokens[p.source])
+        if cost > remaining:
+            # Luôn gửi ít nhất một phần đoạn tốt nhất, kể cả khi nó dài hơn ngân sách
+            if chosen:
+                continue
+            lines = _truncate(lines, remaining - header_tokens[p.source])
+            if not lines:
+                break
+            cost = remaining
+        chosen.setdefault(p.source, []).append(_Passage(p.source, p.order, lines, cost))
+        seen_lines.update(_normalize_line(l) for l in lines if len(l) >= _MIN_DEDUPE_CHARS)
+        remaining -= cost
+        if remaining <= 0:
+            break
+
+    parts: List[str] = []
+    sources: List[dict] = []
+    source_tokens: Dict[str, int] = {}
+    for s in sorted(chosen):
+        ctx = contexts[s]
+        picked = sorted(chosen[s], key=lambda p: p.order)
+        body: List[str] = []
+        for prev, p in zip([None] + picked[:-1], picked):
+            if prev is not None and p.order != prev.order + 1:
+                body.append("…")
+            body.extend(p.lines)
+        text = "\n".join(body)
+        parts.append(f"Nguồn {len(sources) + 1} (score: {ctx.get('score', 0.0):.2f}):\n{text}")
+        source_tokens[ctx.get("id", str(s))] = sum(p.tokens for p in picked)
+        sources.append(ctx)
+    return PackedContext(
+        block="\n\n---\n\n".join(parts),
+        sources=sources,
+        source_tokens=source_tokens,
+        total_tokens=sum(source_tokens.values()),
+    )
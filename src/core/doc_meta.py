@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import re
+import unicodedata
+from typing import Dict, Union
+
+# Loại tài liệu: "theory" = bài học/giáo án, "quiz" = đề, bài tập, ôn tập, kiểm tra
+DOC_TYPES = ("theory", "quiz")
+
+_RE_GRADE_DIR = re.compile(r"^lop\s*(\d{1,2})$")
+_RE_GRADE_NAME = re.compile(r"(?:hoa|lop|khoi)\s*_?\s*(10|11|12)\b")
+_RE_LESSON = re.compile(r"\bbai\s*_?\s*(\d{1,3})")
+_RE_QUIZ_NAME = re.compile(r"kiem\s*tra|on\s*tap|ontap|luyen\s*tap|de\s*thi|trac\s*nghiem|ma\s*tran")
+
+# Lớp mặc định cho thư mục không theo dạng lopNN, khi tên file không ghi lớp
+# (bộ đề trong quizz/ hiện đều là Hoá 10: CTST, CD, KNTT)
+FOLDER_DEFAULT_GRADE = {"quizz": 10}
+
+# Chủ đề (chương) theo từ khoá trong tên bài / câu hỏi đã bỏ dấu, xét theo thứ tự
+# (vd. "bảng tuần hoàn các nguyên tố hoá học" phải khớp "tuan hoan" trước "nguyen to hoa hoc").
+# "ôn tập chương N" theo đánh số chương của sách KNTT lớp 10.
+TOPICS = (
+    ("Nhập môn hoá học", r"nhap mon"),
+    ("Nhóm halogen", r"halogen|halide|hydrohalic|nhom viia|on tap chuong 7"),
+    ("Tốc độ phản ứng", r"toc do phan ung|on tap chuong 6"),
+    ("Năng lượng hoá học", r"enthalpy|enthapy|nhiet phan ung|on tap chuong 5"),
+    ("Phản ứng oxi hoá - khử", r"oxi hoa|oxy hoa|on tap chuong 4"),
+    ("Liên kết hoá học", r"octet|lien ket|van ?der waals|on tap chuong 3"),
+    ("Bảng tuần hoàn", r"tuan hoan|xu huong bien doi|on tap chuong 2"),
+    ("Cấu tạo nguyên tử", r"nguyen tu|nguyen to hoa hoc|orbital|electron"),
+    ("Cân bằng hoá học", r"can bang hoa hoc|hang so can bang"),
+    ("Nitơ - photpho", r"nito|nitrogen|photpho|phosphorus|amoniac|ammonia"),
+    ("Hiđrocacbon", r"hidrocacbon|hydrocarbon|ankan|alkane|anken|alkene|ankin|alkyne|aren|benzen"),
+    ("Este - lipit", r"este|ester|lipit|lipid|chat beo"),
+    ("Cacbohiđrat", r"cacbohidrat|carbohydrate|glucoz|saccaroz|tinh bot|xenluloz|cellulose"),
+    ("Amin - amino axit - protein", r"amin|amino|peptit|peptide|protein"),
+    ("Polime", r"polime|polymer"),
+    ("Kim loại", r"kim loai|dien phan|an mon"),
+)
+_RE_TOPICS = [(name, re.compile(rf"\b(?:{pattern})")) for name, pattern in TOPICS]
+
+
+def _fold(text: str) -> str:
+    text = text.replace("đ", "d").replace("Đ", "D")
+    text = "".join(ch for ch in unicodedata.normalize("NFD", text) if not unicodedata.combining(ch))
+    return text.lower()
+
+
+def source_metadata(source: str) -> Dict[str, Union[int, str]]:
+    """
+    Suy ra metadata từ đường dẫn tương đối trong data/raw, vd.
+    'lop12\\\\1,2,3. BAI 1 ESTER-LIPID.docx' -> {grade: 12, lesson: 1, doc_type: 'theory'}.
+    grade/lesson = 0 khi không xác định được.
+    """
+    parts = re.split(r"[\\/]", source)
+    folder = _fold(parts[0]) if len(parts) > 1 else ""
+    name = _fold(parts[-1])
+
+    grade = FOLDER_DEFAULT_GRADE.get(folder, 0)
+    m = _RE_GRADE_DIR.match(folder) or _RE_GRADE_NAME.search(name)
+    if m:
+        grade = int(m.group(1))
+    m = _RE_LESSON.search(name)
+    lesson = int(m.group(1)) if m else 0
+    doc_type = "quiz" if folder.startswith("quiz") or _RE_QUIZ_NAME.search(name) else "theory"
+    return {"grade": grade, "lesson": lesson, "doc_type": doc_type}
+
+
+def detect_topic(text: str) -> str:
+    """Chủ đề (tên trong TOPICS) của tên file đề hoặc câu yêu cầu, "" nếu không nhận ra."""
+    folded = " ".join(re.sub(r"[^\w\s]", " ", _fold(text)).split())
+    for name, pattern in _RE_TOPICS:
+        if pattern.search(folded):
+            return name
+    return ""
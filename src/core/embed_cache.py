@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from src.config import EMBED_CACHE_DIR, EMBED_MODEL
+
+
+def text_hash(text: str) -> str:
+    """Khoá nội dung của một đoạn văn bản (sha1 hex)."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Khoá độc quyền giữa các process (build_index, các worker Streamlit) trên file `path`."""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _file_id(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+class _Namespace:
+    """
+    Một vùng cache cho cặp (model, task_type):
+    - vectors.f32: ma trận float32 ghi nối tiếp, đọc qua np.memmap
+    - keys.txt: mỗi dòng là hash của text, số dòng = chỉ số hàng trong ma trận
+    Nhiều process có thể ghi cùng lúc: mỗi lần ghi giữ khoá file `.lock`, đọc lại số hàng
+    từ đĩa rồi mới nối thêm. Vector được ghi trước, khoá ghi sau, nên một lần ghi dở chỉ để
+    lại hàng "mồ côi", được cắt bỏ ở lần ghi kế tiếp.
+    Với `max_rows`, khi vượt ngưỡng chỉ giữ lại `max_rows // 2` hàng ghi gần nhất (FIFO);
+    file được thay mới nên process khác nhận ra qua inode và đọc lại.
+    """
+
+    def __init__(self, path: str, max_rows: int = 0):
+        self.path = path
+        self.max_rows = max_rows
+        self.vec_path = os.path.join(path, "vectors.f32")
+        self.key_path = os.path.join(path, "keys.txt")
+        self.info_path = os.path.join(path, "info.json")
+        self.lock_path = os.path.join(path, ".lock")
+        self.dim: Optional[int] = None
+        self._reset(None)
+        if os.path.isdir(path):
+            with _file_lock(self.lock_path):
+                self._sync()
+
+    def _reset(self, vec_id: Optional[Tuple[int, int]]) -> None:
+        self.rows: Dict[str, int] = {}
+        self.n_rows = 0          # số dòng đã đọc trong keys.txt
+        self._key_bytes = 0      # vị trí đã đọc tới trong keys.txt (chỉ các dòng trọn vẹn)
+        self._vec_id = vec_id    # inode của vectors.f32 mà `rows` ứng với
+        self._mm: Optional[np.memmap] = None
+        self._mm_rows = 0
+
+    def _sync(self) -> int:
+        """
+        Đọc thêm các khoá do process khác ghi; gọi khi đang giữ khoá file.
+        Trả về số vector đang có trong vectors.f32.
+        """
+        if self.dim is None:
+            try:
+                with open(self.info_path, "r", encoding="utf-8") as f:
+                    self.dim = int(json.load(f)["dim"])
+            except (FileNotFoundError, ValueError, KeyError):
+                return 0
+        vec_id = _file_id(self.vec_path)
+        if vec_id != self._vec_id:
+            # File đã bị thay (nén bớt) hoặc lần đầu đọc: nạp lại từ đầu
+            self._reset(vec_id)
+        n_vec = os.path.getsize(self.vec_path) // (4 * self.dim) if vec_id else 0
+        try:
+            with open(self.key_path, "rb") as f:
+                f.seek(self._key_bytes)
+                data = f.read()
+        except FileNotFoundError:
+            return n_vec
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if self.n_rows < n_vec:
+                self.rows[line.decode("ascii").strip()] = self.n_rows
+            self.n_rows += 1
+        self._key_bytes += end
+        return n_vec
+
+    def _matrix(self, need_rows: int) -> Optional[np.memmap]:
+        """memmap chỉ đọc; mở lại khi file đã lớn hơn lần map trước. None nếu file đã bị thay."""
+        if self._mm is None or need_rows > self._mm_rows:
+            with open(self.vec_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                if (st.st_dev, st.st_ino) != self._vec_id:
+                    return None
+                n = st.st_size // (4 * self.dim)
+                self._mm = np.memmap(f, dtype=np.float32, mode="r", shape=(n, self.dim))
+            self._mm_rows = n
+        return self._mm
+
+    def get(self, keys: Sequence[str]) -> Tuple[Optional[np.ndarray], List[int]]:
+        """Trả về (ma trận các vector tìm thấy, vị trí tương ứng trong `keys`)."""
+        found = [(i, self.rows[k]) for i, k in enumerate(keys) if k in self.rows]
+        if not found:
+            return None, []
+        positions = [i for i, _ in found]
+        rows = np.fromiter((r for _, r in found), dtype=np.int64, count=len(found))
+        mm = self._matrix(int(rows.max()) + 1)
+        if mm is None:
+            # Process khác vừa nén cache: đọc lại, lần này coi như trượt
+            with _file_lock(self.lock_path):
+                self._sync()
+            return None, []
+        return np.asarray(mm[rows], dtype=np.float32), positions
+
+    def put(self, keys: Sequence[str], vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        os.makedirs(self.path, exist_ok=True)
+        with _file_lock(self.lock_path):
+            n_vec = self._sync()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self.info_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Vector {vectors.shape[1]}-D không khớp cache {self.dim}-D tại {self.path}")
+
+            new: Dict[str, np.ndarray] = {}
+            for k, v in zip(keys, vectors):
+                if k not in self.rows:
+                    new.setdefault(k, v)
+            if not new:
+                return
+            if self.n_rows > n_vec:
+                # keys.txt dài hơn vectors.f32 (file vector bị cắt): bỏ các khoá không có vector
+                if not self._rewrite(sorted(self.rows, key=self.rows.get)):
+                    return
+                n_vec = self.n_rows
+            row_bytes = 4 * self.dim
+            if n_vec > self.n_rows:
+                # Bỏ các hàng mồ côi từ lần ghi dở trước để chỉ số hàng khớp với keys.txt
+                with open(self.vec_path, "r+b") as f:
+                    f.truncate(self.n_rows * row_bytes)
+                self._mm = None
+            if os.path.exists(self.key_path) and os.path.getsize(self.key_path) > self._key_bytes:
+                # Dòng khoá ghi dở (không có "\n")
+                with open(self.key_path, "r+b") as f:
+                    f.truncate(self._key_bytes)
+            start = self.n_rows
+            with open(self.vec_path, "ab") as f:
+                f.write(np.stack(list(new.values())).tobytes())
+            payload = "".join(k + "\n" for k in new).encode("ascii")
+            with open(self.key_path, "ab") as f:
+                f.write(payload)
+            for offset, k in enumerate(new):
+                self.rows[k] = start + offset
+            self.n_rows = start + len(new)
+            self._key_bytes += len(payload)
+            if self._vec_id is None:
+                self._vec_id = _file_id(self.vec_path)
+            if self.max_rows and self.n_rows > self.max_rows:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Chỉ giữ `max_rows // 2` hàng mới nhất; gọi khi đang giữ khoá file."""
+        order = sorted(self.rows, key=self.rows.get)
+        before = self.n_rows
+        self._rewrite(order[len(order) - self.max_rows // 2:])
+        print(f"Cache embedding {self.path}: nén {before} -> {self.n_rows} hàng")
+
+    def _rewrite(self, keep: List[str]) -> bool:
+        """Ghi lại vectors.f32/keys.txt chỉ với các khoá `keep` (file mới, inode mới)."""
+        rows = np.fromiter((self.rows[k] for k in keep), dtype=np.int64, count=len(keep))
+        data = np.empty((0, self.dim), dtype=np.float32)
+        if len(rows):
+            with open(self.vec_path, "rb") as f:
+                mm = np.memmap(f, dtype=np.float32, mode="r")
+                data = np.array(mm.reshape(-1, self.dim)[rows])
+                del mm
+        self._mm = None
+        try:
+            with open(self.vec_path + ".tmp", "wb") as f:
+                f.write(data.tobytes())
+            with open(self.key_path + ".tmp", "wb") as f:
+                f.write("".join(k + "\n" for k in keep).encode("ascii"))
+            os.replace(self.vec_path + ".tmp", self.vec_path)
+            os.replace(self.key_path + ".tmp", self.key_path)
+        except OSError as e:
+            # Windows không cho thay file đang được process khác map; để lần ghi sau thử lại
+            print(f"Không nén được cache embedding {self.path}: {e}")
+            return False
+        self._reset(_file_id(self.vec_path))
+        self._sync()
+        return True
+
+
+class EmbeddingCache:
+    """
+    Cache embedding trên đĩa, định danh theo nội dung: (model, task_type, sha1(text)).
+    build_index dùng vùng mặc định, nên build lại sau khi sửa một file chỉ phải gọi API cho
+    các chunk thực sự thay đổi. RAGEngine ghi câu hỏi người dùng vào vùng riêng (`scope`)
+    có giới hạn `max_rows` hàng mỗi task_type, để cache không phình theo số câu hỏi.
+    """
+
+    def __init__(self, root: str = EMBED_CACHE_DIR, model: str = EMBED_MODEL,
+                 scope: str = "", max_rows: int = 0):
+        self.root = root
+        self.model = model
+        self.scope = scope
+        self.max_rows = max_rows
+        self._spaces: Dict[str, _Namespace] = {}
+        self._lock = threading.Lock()
+
+    def _space(self, task_type: str) -> _Namespace:
+        ns = self._spaces.get(task_type)
+        if ns is None:
+            slug = re.sub(r"[^\w.\-]+", "_", self.model)
+            ns = _Namespace(os.path.join(self.root, slug, self.scope, task_type), self.max_rows)
+            self._spaces[task_type] = ns
+        return ns
+
+    def get_many(self, texts: Sequence[str], task_type: str) -> Tuple[Optional[np.ndarray], List[int]]:
+        """Tra cache cho nhiều text. Trả về (vectors tìm thấy, vị trí của chúng trong `texts`)."""
+        keys = [text_hash(t) for t in texts]
+        with self._lock:
+            return self._space(task_type).get(keys)
+
+    def put_many(self, texts: Sequence[str], task_type: str, vectors: np.ndarray) -> None:
+        """Ghi thêm vector cho các text chưa có trong cache."""
+        if len(texts) == 0:
+            return
+        keys = [text_hash(t) for t in texts]
+        with self._lock:
+            self._space(task_type).put(keys, vectors)
+
+    def get(self, text: str, task_type: str) -> Optional[np.ndarray]:
+        vectors, _ = self.get_many([text], task_type)
+        return None if vectors is None else vectors[0]
+
+    def put(self, text: str, task_type: str, vector: np.ndarray) -> None:
+        self.put_many([text], task_type, np.asarray(vector, dtype=np.float32).reshape(1, -1))
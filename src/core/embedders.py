@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.config import EMBED_BACKEND, EMBED_MODEL, LOCAL_EMBED_DEVICE, LOCAL_EMBED_MODEL
+
+# Task type theo cách gọi của Gemini; backend khác tự quy đổi (vd. tiền tố "query: " của E5)
+TASK_DOCUMENT = "RETRIEVAL_DOCUMENT"
+TASK_QUERY = "RETRIEVAL_QUERY"
+
+# Số chiều đã biết của các model Gemini (để kiểm tra index mà không cần gọi API)
+_GEMINI_DIMS = {
+    "text-embedding-004": 768,
+    "models/text-embedding-004": 768,
+    "embedding-001": 768,
+    "models/embedding-001": 768,
+}
+
+
+class Embedder(ABC):
+    """
+    Giao diện chung cho các backend nhúng văn bản.
+    `name` định danh không gian vector (dùng làm khoá cache và ghi vào index_info.json):
+    hai embedder khác `name` cho ra vector không so sánh được với nhau.
+    """
+
+    backend = ""
+    name = ""
+    # Số batch nên chạy song song khi build index (None = không giới hạn)
+    max_workers: Optional[int] = None
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None
+
+    @abstractmethod
+    def embed(self, texts: Sequence[str], task: str) -> np.ndarray:
+        """Nhúng một batch, trả về ma trận float32 (len(texts), dim) chưa chuẩn hoá."""
+
+    async def aembed(self, texts: Sequence[str], task: str) -> np.ndarray:
+        """Bản async của `embed`; mặc định chạy `embed` trong thread pool của event loop."""
+        return await asyncio.to_thread(self.embed, texts, task)
+
+
+class GeminiEmbedder(Embedder):
+    """Gọi `genai.embed_content` (cần GOOGLE_API_KEY và genai.configure trước đó)."""
+
+    backend = "gemini"
+
+    def __init__(self, model: str = EMBED_MODEL):
+        self.model = model
+        # Giữ tên model làm định danh để cache/index build trước đây vẫn dùng được
+        self.name = model
+
+    @property
+    def dim(self) -> Optional[int]:
+        return _GEMINI_DIMS.get(self.model)
+
+    def embed(self, texts: Sequence[str], task: str) -> np.ndarray:
+        import google.generativeai as genai
+
+        result = genai.embed_content(model=self.model, content=list(texts), task_type=task)
+        return np.asarray(result["embedding"], dtype=np.float32).reshape(len(texts), -1)
+
+    async def aembed(self, texts: Sequence[str], task: str) -> np.ndarray:
+        import google.generativeai as genai
+
+        result = await genai.embed_content_async(model=self.model, content=list(texts), task_type=task)
+        return np.asarray(result["embedding"], dtype=np.float32).reshape(len(texts), -1)
+
+
+class LocalEmbedder(Embedder):
+    """
+    Model sentence-transformers chạy trên CPU, nạp một lần cho cả process.
+    Không cần mạng sau lần tải model đầu tiên. Cần `pip install sentence-transformers`.
+    """
+
+    backend = "local"
+    # torch đã tự song song trong một lần encode; chạy nhiều batch cùng lúc chỉ tranh CPU
+    max_workers = 1
+
+    def __init__(self, model: str = LOCAL_EMBED_MODEL, device: str = LOCAL_EMBED_DEVICE, batch_size: int = 32):
+        self.model_name = model
+        self.device = device
+        self.batch_size = batch_size
+        self.name = f"local/{model}"
+        self._model = None
+        self._lock = threading.Lock()
+        # Họ E5 cần tiền tố phân biệt câu hỏi / tài liệu
+        self._prefixes = {TASK_QUERY: "query: ", TASK_DOCUMENT: "passage: "} if "e5" in model.lower() else {}
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError(
+                            "EMBED_BACKEND=local cần thư viện sentence-transformers: pip install sentence-transformers"
+                        ) from e
+                    print(f"Đang nạp model embedding cục bộ {self.model_name} ({self.device})...")
+                    self._model = SentenceTransformer(self.model_name, device=self.device)
+        return self._model
+
+    @property
+    def dim(self) -> Optional[int]:
+        return int(self._load().get_sentence_embedding_dimension())
+
+    def embed(self, texts: Sequence[str], task: str) -> np.ndarray:
+        prefix = self._prefixes.get(task, "")
+        vectors = self._load().encode(
+            [prefix + t for t in texts],
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+
+_BACKENDS = {"gemini": GeminiEmbedder, "local": LocalEmbedder}
+_instances: Dict[str, Embedder] = {}
+_instances_lock = threading.Lock()
+
+
+def get_embedder(backend: str = EMBED_BACKEND) -> Embedder:
+    """Embedder dùng chung trong process theo backend cấu hình (EMBED_BACKEND)."""
+    backend = backend.lower()
+    if backend not in _BACKENDS:
+        raise ValueError(f"EMBED_BACKEND không hỗ trợ: {backend!r}. Dùng: {', '.join(_BACKENDS)}.")
+    with _instances_lock:
+        if backend not in _instances:
+            _instances[backend] = _BACKENDS[backend]()
+        return _instances[backend]
+
+
+def check_index_compatible(info: Optional[dict], embedder: Embedder, index_dim: int) -> None:
+    """
+    Từ chối index build bằng embedder/số chiều khác embedder hiện tại (ValueError).
+    Index cũ chưa có index_info.json được coi là build bằng Gemini EMBED_MODEL.
+    """
+    info = info or {}
+    built_by = info.get("embedder") or info.get("embed_model") or EMBED_MODEL
+    if built_by != embedder.name:
+        raise ValueError(
+            f"Index được build bằng embedder '{built_by}' nhưng đang cấu hình '{embedder.name}'. "
+            f"Đổi EMBED_BACKEND/model cho khớp hoặc chạy lại build_index."
+        )
+    expected: List[int] = [d for d in (info.get("dim"), embedder.dim) if d]
+    if any(int(d) != index_dim for d in expected):
+        raise ValueError(f"Số chiều không khớp: index {index_dim}-D, embedder/manifest {expected}.")
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import heapq
+import json
+import math
+import os
+import re
+import shutil
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+LEXICAL_INDEX_DIR = "indexes/lexical"
+# Tăng khi đổi cách tách token, để chỉ mục cũ được dựng lại khi mở
+TOKENIZER_VERSION = 2
+
+# Ký hiệu nguyên tố, dùng để nhận ra công thức hoá học (H2SO4, C17H35COO, Fe2(SO4)3, ...)
+ELEMENTS = frozenset("""
+H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr
+Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb
+Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr Rf
+Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og
+""".split())
+
+# Chữ số dưới/trên dạng Unicode (H₂SO₄, Fe³⁺) -> chữ số thường
+_DIGITS = str.maketrans("₀₁₂₃₄₅₆₇₈₉₍₎⁰¹²³⁴⁵⁶⁷⁸⁹", "0123456789()0123456789")
+
+# Một "mảnh" văn bản: chữ/số cùng ngoặc (để giữ nguyên Fe2(SO4)3, (C6H10O5)n)
+_RE_PIECE = re.compile(r"(?:[^\W_]|[()\[\]])*[^\W_](?:[^\W_]|[()\[\]])*")
+_RE_WORD = re.compile(r"[^\W_]+")
+_RE_FORMULA = re.compile(r"(?:[A-Z][a-z]?\d*|[(\[]|[)\]]\d*)+n?")
+_RE_SYMBOL = re.compile(r"[A-Z][a-z]?")
+# Nhóm trong ngoặc không lồng nhóm khác: (C17H35COO)3C3H5 -> C17H35COO
+_RE_GROUP = re.compile(r"[(\[]([^()\[\]]+)[)\]]")
+# Kim loại đứng cuối công thức muối (C17H35COONa, C6H5ONa): phần trước nó là gốc axit
+_RE_CATION = re.compile(r"([A-Z][a-z]?)\d*$")
+_METALS = frozenset("Li Na K Rb Cs Be Mg Ca Sr Ba Al Zn Fe Cu Ag Pb Mn Cr Ni Co Sn Hg".split())
+# Hệ số phía trước (2H2) và trạng thái phía sau (H2O(l), CO2(k))
+_RE_COEF = re.compile(r"^\d+(?=[A-Z(])")
+_RE_STATE = re.compile(r"\((?:g|l|s|r|k|aq|dd)\)$")
+
+# Tiền tố của token đã bỏ dấu (axít -> ~axit), để câu hỏi gõ không dấu vẫn khớp
+_FOLD = "~"
+
+
+def fold_diacritics(word: str) -> str:
+    """Bỏ dấu tiếng Việt: 'phản ứng' -> 'phan ung', 'đ' -> 'd'."""
+    word = word.replace("đ", "d").replace("Đ", "D")
+    return "".join(ch for ch in unicodedata.normalize("NFD", word) if not unicodedata.combining(ch))
+
+
+def _strip_unbalanced(piece: str) -> str:
+    """Bỏ ngoặc thừa ở hai đầu do cắt mảnh giữa câu: '(H2SO4' / 'H2)'."""
+    while piece[:1] in "([" and piece.count("(") + piece.count("[") > piece.count(")") + piece.count("]"):
+        piece = piece[1:]
+    while piece[-1:] in ")]" and piece.count(")") + piece.count("]") > piece.count("(") + piece.count("["):
+        piece = piece[:-1]
+    return piece
+
+
+def as_formula(piece: str) -> str:
+    """Trả về công thức chuẩn hoá nếu `piece` là công thức hoá học, ngược lại chuỗi rỗng."""
+    piece = _RE_STATE.sub("", _RE_COEF.sub("", _strip_unbalanced(piece)))
+    if not piece or not _RE_FORMULA.fullmatch(piece):
+        return ""
+    depth = 0
+    for ch in piece:
+        if ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+            if depth < 0:
+                return ""
+    if depth != 0:
+        return ""
+    symbols = _RE_SYMBOL.findall(piece)
+    if not symbols or any(s not in ELEMENTS for s in symbols):
+        return ""
+    return piece
+
+
+def formula_parts(formula: str) -> List[str]:
+    """
+    Các gốc bên trong một công thức, để tìm 'C17H35COO' thấy cả '(C17H35COO)3C3H5' lẫn
+    'C17H35COONa': nhóm trong ngoặc và gốc axit của muối (bỏ kim loại đứng cuối).
+    """
+    parts = [group for group in _RE_GROUP.findall(formula) if as_formula(group)]
+    m = _RE_CATION.search(formula)
+    if m and m.group(1) in _METALS:
+        residue = formula[:m.start()]
+        if residue.endswith("O") and len(_RE_SYMBOL.findall(residue)) >= 2 and as_formula(residue):
+            parts.append(residue)
+    return [p for p in dict.fromkeys(parts) if p != formula]
+
+
+def _pieces(text: str) -> Iterable[str]:
+    return _RE_PIECE.findall(unicodedata.normalize("NFC", text).translate(_DIGITS))
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Token cho tài liệu: từ viết thường (giữ dấu), bản bỏ dấu có tiền tố '~' khi khác,
+    và công thức hoá học giữ nguyên hoa/thường (Co ≠ CO) kèm các gốc của nó (`formula_parts`).
+    """
+    tokens: List[str] = []
+    for piece in _pieces(text):
+        formula = as_formula(piece)
+        if formula:
+            tokens.append(formula)
+            tokens.extend(formula_parts(formula))
+        for word in _RE_WORD.findall(piece.lower()):
+            tokens.append(word)
+            folded = fold_diacritics(word)
+            if folded != word:
+                tokens.append(_FOLD + folded)
+    return tokens
+
+
+def query_terms(query: str) -> List[str]:
+    """
+    Token cho câu hỏi. Công thức chỉ khớp công thức (phân biệt hoa/thường); từ có dấu
+    chỉ khớp đúng từ đó; từ gõ không dấu khớp cả từ không dấu lẫn mọi từ có dấu cùng mặt chữ.
+    """
+    terms: List[str] = []
+    for piece in _pieces(query):
+        formula = as_formula(piece)
+        if formula:
+            terms.append(formula)
+            continue
+        for word in _RE_WORD.findall(piece.lower()):
+            terms.append(word)
+            if fold_diacritics(word) == word:
+                terms.append(_FOLD + word)
+    return list(dict.fromkeys(terms))
+
+
+def query_formulas(query: str) -> List[str]:
+    """Các công thức hoá học xuất hiện trong câu hỏi."""
+    return list(dict.fromkeys(f for f in map(as_formula, _pieces(query)) if f))
+
+
+def is_formula_query(query: str) -> bool:
+    """Câu hỏi chỉ gồm công thức (vd. 'H2SO4', 'C17H35COONa', 'Fe + CuSO4'), không có chữ thường."""
+    pieces = list(_pieces(query))
+    return bool(pieces) and all(as_formula(p) for p in pieces)
+
+
+class LexicalIndexWriter:
+    """
+    Ghi chỉ mục BM25 theo luồng, mỗi lần một tài liệu. Thứ tự tài liệu = thứ tự hàng
+    của chunk store, nên kết quả tìm kiếm là số hàng dùng trực tiếp với ChunkStore.
+    """
+
+    def __init__(self, path: str = LEXICAL_INDEX_DIR):
+        self.path = path
+        self._tmp = path + ".tmp"
+        self._vocab: Dict[str, int] = {}
+        self._terms = array("i")
+        self._rows = array("i")
+        self._tfs = array("i")
+        self._doc_len = array("i")
+
+    def add(self, text: str) -> None:
+        row = len(self._doc_len)
+        tokens = tokenize(text)
+        for term, tf in Counter(tokens).items():
+            self._terms.append(self._vocab.setdefault(term, len(self._vocab)))
+            self._rows.append(row)
+            self._tfs.append(tf)
+        self._doc_len.append(len(tokens))
+
+    def close(self) -> None:
+        """Sắp postings theo term (CSR) rồi thay thế chỉ mục cũ bằng đổi tên thư mục."""
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        os.makedirs(self._tmp)
+        terms = np.frombuffer(self._terms, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")
+        offsets = np.zeros(len(self._vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self._vocab)), out=offsets[1:])
+        np.save(os.path.join(self._tmp, "offsets.npy"), offsets)
+        np.save(os.path.join(self._tmp, "rows.npy"), np.frombuffer(self._rows, dtype=np.int32)[order])
+        np.save(os.path.join(self._tmp, "tf.npy"), np.frombuffer(self._tfs, dtype=np.int32)[order])
+        np.save(os.path.join(self._tmp, "doc_len.npy"), np.frombuffer(self._doc_len, dtype=np.int32))
+        with open(os.path.join(self._tmp, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(list(self._vocab), f, ensure_ascii=False)
+        with open(os.path.join(self._tmp, "info.json"), "w", encoding="utf-8") as f:
+            json.dump({"tokenizer": TOKENIZER_VERSION}, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        """Bỏ dở: xoá thư mục tạm (nếu close đã bắt đầu ghi), chỉ mục cũ giữ nguyên."""
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+
+class LexicalIndex:
+    """Chỉ mục BM25 chỉ đọc; postings được memory-map giống chunk store."""
+
+    def __init__(self, path: str = LEXICAL_INDEX_DIR, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1, self.b = k1, b
+        self._offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self._rows = np.load(os.path.join(path, "rows.npy"), mmap_mode="r")
+        self._tf = np.load(os.path.join(path, "tf.npy"), mmap_mode="r")
+        self.doc_len = np.asarray(np.load(os.path.join(path, "doc_len.npy")), dtype=np.float32)
+        self._avgdl = float(self.doc_len.mean()) if len(self.doc_len) else 1.0
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            self.vocab: Dict[str, int] = {t: i for i, t in enumerate(json.load(f))}
+        try:
+            with open(os.path.join(path, "info.json"), "r", encoding="utf-8") as f:
+                self.tokenizer = int(json.load(f).get("tokenizer", 1))
+        except FileNotFoundError:
+            self.tokenizer = 1
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def postings(self, term: str) -> np.ndarray:
+        """Các hàng chứa `term`."""
+        tid = self.vocab.get(term)
+        if tid is None:
+            return np.zeros(0, dtype=np.int32)
+        return np.asarray(self._rows[int(self._offsets[tid]):int(self._offsets[tid + 1])])
+
+    def search(self, query: str, top_k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Trả về (số hàng, điểm BM25) theo điểm giảm dần; chỉ gồm hàng có điểm > 0.
+        `mask` (bool theo hàng) giới hạn tập tài liệu trước khi chọn top-k.
+        """
+        n = len(self)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in query_terms(query):
+            tid = self.vocab.get(term)
+            if tid is None:
+                continue
+            start, end = int(self._offsets[tid]), int(self._offsets[tid + 1])
+            rows = np.asarray(self._rows[start:end])
+            tf = np.asarray(self._tf[start:end], dtype=np.float32)
+            df = end - start
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[rows] / self._avgdl)
+            scores[rows] += idf * tf * (self.k1 + 1.0) / (tf + norm)
+        if mask is not None:
+            scores[~mask] = 0.0
+        hits = np.flatnonzero(scores)
+        if hits.size > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return hits, scores[hits]
+
+    @classmethod
+    def build(cls, texts: Iterable[str], path: str = LEXICAL_INDEX_DIR) -> "LexicalIndex":
+        writer = LexicalIndexWriter(path)
+        for text in texts:
+            writer.add(text)
+        writer.close()
+        return cls(path)
+
+
+def open_lexical_index(store, path: str = LEXICAL_INDEX_DIR) -> LexicalIndex:
+    """Mở chỉ mục BM25; dựng lại từ chunk store nếu chưa có, lệch số hàng với store hoặc tách token kiểu cũ."""
+    try:
+        index = LexicalIndex(path)
+        if len(index) == len(store) and index.tokenizer == TOKENIZER_VERSION:
+            return index
+        print(f"Chỉ mục từ khoá tại {path} lệch với chunk store, đang dựng lại...")
+    except FileNotFoundError:
+        print(f"Chưa có chỉ mục từ khoá tại {path}, đang dựng từ chunk store...")
+    return LexicalIndex.build((store.text(row) for row in range(len(store))), path)
+
+
+def keyword_scan(texts: Iterable[Tuple[int, str]], query: str, top_k: int) -> List[Tuple[int, float]]:
+    """
+    Quét tuần tự các cặp (hàng, text), không cần chỉ mục: điểm = số lần xuất hiện các token
+    của câu hỏi, chia căn độ dài chunk. Dùng khi chỉ mục BM25 không có. Trả về (hàng, điểm) giảm dần.
+    """
+    terms = set(query_terms(query))
+    if not terms:
+        return []
+    scored = []
+    for row, text in texts:
+        tokens = tokenize(text)
+        hits = sum(1 for t in tokens if t in terms)
+        if hits:
+            scored.append((row, hits / math.sqrt(len(tokens))))
+    return heapq.nlargest(top_k, scored, key=lambda rs: rs[1])
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Gộp nhiều danh sách xếp hạng: điểm = Σ 1 / (k + hạng). Trả về (mục, điểm) giảm dần."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            fused[int(item)] = fused.get(int(item), 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda kv: -kv[1])
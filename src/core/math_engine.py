@@ -1,8 +1,18 @@
+import re
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
 from chempy import balance_stoichiometry
 
-def balance_equation(equation: str) -> str:
+def try_balance(equation: str) -> Optional[str]:
     """
     Input: "Fe + O2 -> Fe2O3"
+    Trả về phương trình đã cân bằng, hoặc None nếu không cân bằng được
+    (vd. câu hỏi có "->" nhưng không phải phương trình).
     """
     try:
         left, right = equation.split("->")
@@ -13,12 +23,334 @@ def balance_equation(equation: str) -> str:
         r = " + ".join([f"{v} {k}" for k, v in prod.items()])
         return f"Cân bằng: {l} -> {r}"
     except Exception:
-        return "Chưa cân bằng được, hãy kiểm tra công thức hoặc nhập dạng 'A + B -> C + D'."
+        return None
+
+def balance_equation(equation: str) -> str:
+    """
+    Input: "Fe + O2 -> Fe2O3"
+    """
+    return try_balance(equation) or "Chưa cân bằng được, hãy kiểm tra công thức hoặc nhập dạng 'A + B -> C + D'."
 
 def hint_stoichiometry():
     return (
         "Gợi ý nhanh:\n"
         "- n = m / M (mol = khối lượng / khối lượng mol)\n"
-        "- V = n * 24.79 (L ở ĐKTC)\n"
+        "- V = n * 24.79 (L ở đkc; 22.4 L ở đktc)\n"
         "- C_M = n / V (mol/L)"
     )
+
+
+# ---- Bảng tuần hoàn: ký hiệu theo số hiệu nguyên tử Z (chỉ số 0 bỏ trống) ----
+SYMBOLS = ("",) + tuple("""
+H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr
+Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb
+Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr Rf
+Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og
+""".split())
+_Z = {symbol: z for z, symbol in enumerate(SYMBOLS) if symbol}
+
+# Nguyên tử khối chuẩn IUPAC (nguyên tố không bền: số khối đồng vị bền nhất)
+IUPAC_MASSES = np.array([0.0] + [float(x) for x in """
+1.008 4.0026 6.94 9.0122 10.81 12.011 14.007 15.999 18.998 20.180 22.990 24.305 26.982 28.085 30.974 32.06
+35.45 39.95 39.098 40.078 44.956 47.867 50.942 51.996 54.938 55.845 58.933 58.693 63.546 65.38 69.723 72.630
+74.922 78.971 79.904 83.798 85.468 87.62 88.906 91.224 92.906 95.95 98 101.07 102.91 106.42 107.87 112.41
+114.82 118.71 121.76 127.60 126.90 131.29 132.91 137.33 138.91 140.12 140.91 144.24 145 150.36 151.96 157.25
+158.93 162.50 164.93 167.26 168.93 173.05 174.97 178.49 180.95 183.84 186.21 190.23 192.22 195.08 196.97 200.59
+204.38 207.2 208.98 209 210 222 223 226 227 232.04 231.04 238.03 237 244 243 247 247 251 252 257 258 259 266
+267 268 269 270 277 278 281 282 285 286 289 290 293 294 294
+""".split()])
+
+# Nguyên tử khối làm tròn theo SGK/đề thi Việt Nam (Fe = 56, Cl = 35,5...), để đáp số khớp đáp án
+SCHOOL_MASSES = IUPAC_MASSES.copy()
+for _symbol, _mass in {
+    "H": 1, "He": 4, "Li": 7, "Be": 9, "B": 11, "C": 12, "N": 14, "O": 16, "F": 19, "Ne": 20,
+    "Na": 23, "Mg": 24, "Al": 27, "Si": 28, "P": 31, "S": 32, "Cl": 35.5, "Ar": 40, "K": 39, "Ca": 40,
+    "Cr": 52, "Mn": 55, "Fe": 56, "Co": 59, "Ni": 59, "Cu": 64, "Zn": 65, "As": 75, "Se": 79, "Br": 80,
+    "Rb": 85.5, "Sr": 88, "Ag": 108, "Sn": 119, "I": 127, "Cs": 133, "Ba": 137, "Au": 197, "Hg": 201, "Pb": 207,
+}.items():
+    SCHOOL_MASSES[_Z[_symbol]] = _mass
+MASS_TABLES = {"school": SCHOOL_MASSES, "iupac": IUPAC_MASSES}
+
+# Thể tích mol khí (L/mol): đkc (25 °C, 1 bar, chương trình mới) và đktc (0 °C, 1 atm)
+MOLAR_VOLUMES = {"đkc": 24.79, "đktc": 22.4}
+# Chất khí ở điều kiện thường: V = n·Vm chỉ áp dụng cho các chất này, hoặc khi đề nói rõ "khí"
+GASES = frozenset("""
+H2 O2 O3 N2 F2 Cl2 He Ne Ar Kr Xe Rn CO CO2 SO2 NO NO2 N2O NH3 H2S HCl HBr HI
+CH4 C2H6 C3H8 C4H10 C2H4 C3H6 C2H2 CH3NH2
+""".split())
+
+# ---- Đọc công thức: nhóm lồng nhau (), [], {}; hydrat CuSO4·5H2O; polime (C6H10O5)n ----
+_SUBSCRIPTS = str.maketrans("₀₁₂₃₄₅₆₇₈₉", "0123456789")
+_RE_TOKEN = re.compile(r"([A-Z][a-z]?)(\d*)|([(\[{])|([)\]}])(\d*)")
+_RE_HYDRATE_DOT = re.compile(r"[.·•*∙]")
+_RE_PART_COEF = re.compile(r"(\d*)(.+)")
+_RE_STATE_SUFFIX = re.compile(r"\((?:g|l|s|r|k|aq|dd)\)$")
+_CLOSE = {"(": ")", "[": "]", "{": "}"}
+
+
+def _parse_group(body: str, formula: str) -> Counter:
+    stack = [Counter()]
+    closers: List[str] = []
+    pos = 0
+    while pos < len(body):
+        m = _RE_TOKEN.match(body, pos)
+        if not m:
+            raise ValueError(f"Không đọc được công thức {formula!r} (ở ký tự {body[pos]!r})")
+        pos = m.end()
+        if m.group(1):
+            z = _Z.get(m.group(1))
+            if z is None:
+                raise ValueError(f"Không có nguyên tố {m.group(1)!r} trong công thức {formula!r}")
+            stack[-1][z] += int(m.group(2) or 1)
+        elif m.group(3):
+            stack.append(Counter())
+            closers.append(_CLOSE[m.group(3)])
+        else:
+            if not closers or closers.pop() != m.group(4):
+                raise ValueError(f"Ngoặc không khớp trong công thức {formula!r}")
+            inner = stack.pop()
+            k = int(m.group(5) or 1)
+            for z, count in inner.items():
+                stack[-1][z] += count * k
+    if closers:
+        raise ValueError(f"Thiếu ngoặc đóng trong công thức {formula!r}")
+    return stack[0]
+
+
+@lru_cache(maxsize=4096)
+def _parse(formula: str) -> Tuple[Tuple[int, int], ...]:
+    """((Z, số nguyên tử), ...) theo thứ tự xuất hiện; cache vì cùng công thức được hỏi lặp lại."""
+    text = _RE_STATE_SUFFIX.sub("", formula.translate(_SUBSCRIPTS).replace(" ", ""))
+    if text.startswith("(") and text.endswith(")n"):
+        # Polime: tính theo một mắt xích
+        text = text[:-1].replace("-", "")
+    total: Counter = Counter()
+    for part in _RE_HYDRATE_DOT.split(text):
+        m = _RE_PART_COEF.fullmatch(part)
+        if not m:
+            raise ValueError(f"Không đọc được công thức {formula!r}")
+        k = int(m.group(1) or 1)
+        for z, count in _parse_group(m.group(2), formula).items():
+            total[z] += count * k
+    return tuple(total.items())
+
+
+def parse_formula(formula: str) -> Dict[str, int]:
+    """'Fe2(SO4)3' -> {'Fe': 2, 'S': 3, 'O': 12}; 'CuSO4.5H2O' -> {'Cu': 1, 'S': 1, 'O': 9, 'H': 10}."""
+    return {SYMBOLS[z]: count for z, count in _parse(formula)}
+
+
+@lru_cache(maxsize=4096)
+def molar_mass(formula: str, table: str = "school") -> float:
+    """Khối lượng mol (g/mol); ValueError nếu công thức sai hoặc có nguyên tố lạ."""
+    composition = _parse(formula)
+    zs = np.fromiter((z for z, _ in composition), dtype=np.intp, count=len(composition))
+    counts = np.fromiter((c for _, c in composition), dtype=np.float64, count=len(composition))
+    return float(counts @ MASS_TABLES[table][zs])
+
+
+def _fmt(x: float, digits: int = 5) -> str:
+    """Số kiểu Việt Nam (dấu phẩy thập phân), tối đa `digits` chữ số có nghĩa."""
+    text = f"{x:.{digits}g}" if abs(x) < 10 ** digits else f"{x:.0f}"
+    if "e" in text:
+        text = f"{x:.8f}".rstrip("0").rstrip(".")
+    return text.replace(".", ",")
+
+
+def _mass_sum(formula: str, table: str = "school") -> str:
+    """'40 + 12 + 3×16' cho CaCO3."""
+    masses = MASS_TABLES[table]
+    return " + ".join(_fmt(masses[z], 6) if c == 1 else f"{c}×{_fmt(masses[z], 6)}" for z, c in _parse(formula))
+
+
+# ---- Giải n / m / V / C_M ----
+QUANTITY_UNITS = {"M": "g/mol", "n": "mol", "m": "g", "V": "L", "C_M": "M", "V_dd": "L"}
+QUANTITY_NAMES = {
+    "M": "Khối lượng mol", "n": "Số mol", "m": "Khối lượng", "V": "Thể tích khí",
+    "C_M": "Nồng độ mol", "V_dd": "Thể tích dung dịch",
+}
+
+
+@dataclass
+class Amount:
+    """Các đại lượng của một chất và các bước tính theo thứ tự."""
+    formula: str = ""
+    values: Dict[str, float] = field(default_factory=dict)
+    steps: List[str] = field(default_factory=list)
+    condition: str = "đkc"
+
+
+def solve_amount(formula: str = "", targets: Sequence[str] = ("n",), condition: str = "đkc",
+                 table: str = "school", **given: Optional[float]) -> Amount:
+    """
+    Tính các đại lượng `targets` (M, n, m, V, C_M, V_dd) từ các đại lượng đã biết (`given`, đơn vị
+    g, mol, L, mol/L) qua n = m/M, V = n·Vm, n = C_M·V_dd. ValueError nếu không đủ dữ kiện.
+    """
+    result = Amount(formula=formula, condition=condition,
+                    values={k: float(v) for k, v in given.items() if v is not None})
+    values, steps = result.values, result.steps
+    vm = MOLAR_VOLUMES[condition]
+    name = f"({formula})" if formula else ""
+
+    def need_M() -> float:
+        if "M" not in values:
+            if not formula:
+                raise ValueError("Cần công thức chất để tính khối lượng mol.")
+            values["M"] = molar_mass(formula, table)
+            total = _fmt(values["M"], 6)
+            terms = _mass_sum(formula, table)
+            steps.append(f"M{name} = {terms} = {total} g/mol" if terms != total else f"M{name} = {total} g/mol")
+        return values["M"]
+
+    def need_n() -> float:
+        if "n" in values:
+            return values["n"]
+        if "m" in values:
+            M = need_M()
+            values["n"] = values["m"] / M
+            steps.append(f"n = m / M = {_fmt(values['m'])} / {_fmt(M, 6)} = {_fmt(values['n'])} mol")
+        elif "V" in values:
+            values["n"] = values["V"] / vm
+            steps.append(f"n = V / {_fmt(vm)} = {_fmt(values['V'])} / {_fmt(vm)} = {_fmt(values['n'])} mol ({condition})")
+        elif "C_M" in values and "V_dd" in values:
+            values["n"] = values["C_M"] * values["V_dd"]
+            steps.append(f"n = C_M × V = {_fmt(values['C_M'])} × {_fmt(values['V_dd'])} = {_fmt(values['n'])} mol")
+        else:
+            raise ValueError("Chưa đủ dữ kiện để tính số mol (cần m, V khí, hoặc C_M và thể tích dung dịch).")
+        return values["n"]
+
+    for target in targets:
+        if target in given and given[target] is not None:
+            continue
+        if target == "M":
+            need_M()
+        elif target == "n":
+            need_n()
+        elif target == "m":
+            n, M = need_n(), need_M()
+            values["m"] = n * M
+            steps.append(f"m = n × M = {_fmt(n)} × {_fmt(M, 6)} = {_fmt(values['m'])} g")
+        elif target == "V":
+            n = need_n()
+            values["V"] = n * vm
+            steps.append(f"V = n × {_fmt(vm)} = {_fmt(n)} × {_fmt(vm)} = {_fmt(values['V'])} L ({condition})")
+        elif target == "C_M":
+            if "V_dd" not in values:
+                raise ValueError("Cần thể tích dung dịch để tính nồng độ mol.")
+            n = need_n()
+            values["C_M"] = n / values["V_dd"]
+            steps.append(f"C_M = n / V = {_fmt(n)} / {_fmt(values['V_dd'])} = {_fmt(values['C_M'])} M")
+        elif target == "V_dd":
+            if "C_M" not in values:
+                raise ValueError("Cần nồng độ mol để tính thể tích dung dịch.")
+            n = need_n()
+            values["V_dd"] = n / values["C_M"]
+            steps.append(f"V = n / C_M = {_fmt(n)} / {_fmt(values['C_M'])} = {_fmt(values['V_dd'])} L")
+        else:
+            raise ValueError(f"Đại lượng không hỗ trợ: {target!r}")
+    return result
+
+
+# ---- Nhận dạng câu hỏi tính toán một chất (không gọi Gemini) ----
+# Số + đơn vị: "5,6 g", "0,1 mol", "200 ml", "2,479 lít", "0,5M", "1 mol/l"
+_RE_QUANTITY = re.compile(
+    r"(?<![\w,.])(\d+(?:[.,]\d+)?)\s*"
+    r"(mol/l|mol/L|mol/lít|kg|mg|gam|g|mol|ml|mL|cm3|lít|lit|dm3|l|L|M)(?![^\W_])"
+)
+_UNITS = {
+    "g": ("m", 1.0), "gam": ("m", 1.0), "kg": ("m", 1000.0), "mg": ("m", 0.001),
+    "mol": ("n", 1.0),
+    "l": ("vol", 1.0), "L": ("vol", 1.0), "lít": ("vol", 1.0), "lit": ("vol", 1.0), "dm3": ("vol", 1.0),
+    "ml": ("vol", 0.001), "mL": ("vol", 0.001), "cm3": ("vol", 0.001),
+    "M": ("C_M", 1.0), "mol/l": ("C_M", 1.0), "mol/L": ("C_M", 1.0), "mol/lít": ("C_M", 1.0),
+}
+# Công thức đứng riêng (không dính chữ có dấu, không phải ion Fe3+ / SO4^2-, không phải C_M)
+_RE_SUBSTANCE = re.compile(
+    r"(?<![^\W_])(?:[A-Z][a-z]?|[(\[])[A-Za-z0-9()\[\]]*(?:[.·•*∙]\d*[A-Z(\[][A-Za-z0-9()\[\]]*)?"
+    r"(?![^\W_]|[_+\-^⁺⁻])"
+)
+# Chữ cái hay dùng làm tên đại lượng, không coi là nguyên tố khi đứng một mình
+_VARIABLE_LETTERS = frozenset({"V"})
+# Đại lượng cần tính: (tên, cụm từ hỏi, tên biến như "tính V", "V = ?"; biến phân biệt hoa/thường: m ≠ M)
+_TARGET_PATTERNS = (
+    ("M", r"(?i:khối\s+lượng\s+mol|phân\s+tử\s+khối|nguyên\s+tử\s+khối)|\bM\s+của", "M"),
+    ("n", r"(?i:số\s+mol|bao\s+nhiêu\s+mol)", "n"),
+    ("m", r"(?i:khối\s+lượng(?!\s+(?:mol|riêng))|bao\s+nhiêu\s+(?:gam|g)\b)", "m"),
+    ("vol", r"(?i:thể\s+tích|bao\s+nhiêu\s+(?:lít|ml)\b)", "V"),
+    ("C_M", r"(?i:nồng\s+độ(?!\s+phần))", "C_?M"),
+)
+_TARGETS = tuple(
+    (name, re.compile(rf"{words}|(?i:tính)\s+{var}\b|\b{var}\s*=\s*\?")) for name, words, var in _TARGET_PATTERNS
+)
+# Câu hỏi cần suy luận theo phản ứng/hiệu suất/phần trăm: để Gemini giải
+_RE_NOT_SIMPLE = re.compile(
+    r"tác\s+dụng|phản\s+ứng|đốt|nung|nhiệt\s+phân|điện\s+phân|hiệu\s+suất|khối\s+lượng\s+riêng|không\s+khí|%|->|→"
+    r"|(?:thu\s+được|sinh\s+ra|tạo\s+thành|giải\s+phóng)\s+(?:\S+\s+){0,4}?(?:khí|kết\s+tủa|chất\s+rắn|muối)",
+    re.I,
+)
+_RE_SOLUTION = re.compile(r"dung\s+dịch|\bdd\b|pha\b", re.I)
+# Hỏi về ion / nguyên tử / phân tử trong một chất, hoặc có ion mang điện (Cl-, Fe3+, SO4^2-):
+# số mol hạt khác số mol chất (Cl- trong CaCl2 0,5M gấp đôi), để Gemini giải
+_RE_PARTICLE = re.compile(
+    r"(?i:\b(?:ion|anion|cation)\b|nguyên\s+tử(?!\s+khối)|phân\s+tử(?!\s+khối)[^.?!]*?\btrong\b)"
+    r"|(?<![^\W_])[A-Z][A-Za-z0-9()\[\]]*(?:\^\{?\d*[+\-]\}?|\d*[+\-]|[⁰¹²³⁴-⁹]*[⁺⁻])(?![^\W_])"
+)
+_RE_GAS = re.compile(r"\bkhí\b", re.I)
+
+
+def _single_substance(text: str) -> Optional[str]:
+    found = []
+    for m in _RE_SUBSTANCE.finditer(text):
+        token = m.group(0)
+        if token in _VARIABLE_LETTERS:
+            continue
+        try:
+            _parse(token)
+        except ValueError:
+            continue
+        if token not in found:
+            found.append(token)
+    return found[0] if len(found) == 1 else None
+
+
+def try_stoichiometry(question: str) -> Optional[str]:
+    """
+    Câu hỏi tính khối lượng mol / số mol / khối lượng / thể tích / nồng độ của MỘT chất
+    ("Tính số mol của 5,6 gam Fe", "Tính C_M khi hoà tan 5,85 g NaCl thành 200 ml dung dịch")
+    -> lời giải từng bước. None nếu không chắc (nhiều chất, có phản ứng, thiếu dữ kiện): để Gemini trả lời.
+    """
+    text = unicodedata.normalize("NFC", question).translate(_SUBSCRIPTS)
+    if _RE_NOT_SIMPLE.search(text) or _RE_PARTICLE.search(text):
+        return None
+    formula = _single_substance(text)
+    if formula is None:
+        return None
+    targets = [name for name, pattern in _TARGETS if pattern.search(text)]
+    given: Dict[str, float] = {}
+    for m in _RE_QUANTITY.finditer(text):
+        kind, scale = _UNITS[m.group(2)]
+        if kind in given:
+            return None
+        given[kind] = float(m.group(1).replace(",", ".")) * scale
+    # Thể tích là của dung dịch khi đề nói tới dung dịch / nồng độ, ngược lại là thể tích khí
+    solution = bool(_RE_SOLUTION.search(text)) or "C_M" in given or "C_M" in targets
+    volume = "V_dd" if solution else "V"
+    if "vol" in given:
+        given[volume] = given.pop("vol")
+    targets = [volume if t == "vol" else t for t in targets]
+    targets = [t for t in targets if t not in given]
+    if not targets:
+        return None
+    # Đổi V <-> n qua thể tích mol chỉ khi chất là khí ("9 gam nước H2O" không có thể tích khí)
+    if "V" in given or "V" in targets:
+        if formula not in GASES and not _RE_GAS.search(text):
+            return None
+    condition = "đktc" if re.search(r"đktc|điều\s+kiện\s+tiêu\s+chuẩn", text, re.I) else "đkc"
+    try:
+        result = solve_amount(formula, targets=targets, condition=condition, **given)
+    except (ValueError, ZeroDivisionError):
+        return None
+    answers = "; ".join(f"{QUANTITY_NAMES[t].lower()} {'V' if t == 'V_dd' else t} = "
+                        f"{_fmt(result.values[t], 6 if t == 'M' else 5)} {QUANTITY_UNITS[t]}" for t in targets)
+    steps = "\n".join(f"- {step}" for step in result.steps)
+    return f"**{formula}**\n\n{steps}\n\n**Đáp số:** {answers}"
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import re
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from src.config import (
+    HISTORY_ANSWER_TOKENS,
+    HISTORY_RECENT_TURNS,
+    HISTORY_SUMMARY_TOKENS,
+    HISTORY_TOKEN_BUDGET,
+)
+from src.core.text_utils import estimate_tokens
+
+# Dấu hiệu câu hỏi tiếp nối, phải đọc cùng các lượt trước mới hiểu được
+# ("còn câu 2 thì sao?", "vậy nó có tan không?", "giải thích ý b")
+_RE_FOLLOW_UP = re.compile(
+    r"^\s*(còn|vậy|thế|thì|nếu vậy|tiếp|rồi|và)\b"
+    r"|\b(nó|chúng|đó|này|kia|trên|vừa rồi|tương tự|như vậy|câu\s*\d+|ý\s*[a-d]|phần\s*\d+)\b",
+    re.IGNORECASE,
+)
+# Câu hỏi rất ngắn ("Tại sao?", "Ví dụ?", "Giải thích thêm") sau một lượt trước là câu tiếp nối,
+# trừ khi tự nêu chủ đề: có công thức hoá học hoặc dạng "X là gì?"
+_SHORT_QUESTION_WORDS = 3
+_RE_FORMULA = re.compile(r"\b(?:[A-Z][a-z]?\d*){2,}\b|\b[A-Z][a-z]?\d+\b")
+_RE_DEFINITION = re.compile(r"\S\s+là\s+(?:gì|chất gì|sao)\b", re.IGNORECASE)
+
+
+def clip_tokens(text: str, max_tokens: int) -> str:
+    """Cắt văn bản (theo từ) còn tối đa ~max_tokens token."""
+    text = " ".join(text.split())
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    kept: List[str] = []
+    used = 0
+    for word in text.split(" "):
+        cost = estimate_tokens(word)
+        if used + cost > max_tokens:
+            break
+        kept.append(word)
+        used += cost
+    return " ".join(kept) + " …"
+
+
+@dataclass
+class MemoryTurn:
+    question: str
+    answer: str
+    tokens: int
+
+
+class ConversationMemory:
+    """
+    Lịch sử hội thoại của một phiên, giữ kích thước cố định:
+    - mỗi câu trả lời chỉ lưu ~HISTORY_ANSWER_TOKENS token đầu;
+    - khi các lượt vượt HISTORY_TOKEN_BUDGET token, các lượt cũ (trừ `keep_recent` lượt
+      gần nhất) được gộp vào `summary` (RAGEngine tóm tắt bằng Gemini, xem `compact`).
+    An toàn giữa thread của app và event loop nền.
+    """
+
+    def __init__(self, budget: int = HISTORY_TOKEN_BUDGET, keep_recent: int = HISTORY_RECENT_TURNS,
+                 answer_tokens: int = HISTORY_ANSWER_TOKENS, summary_tokens: int = HISTORY_SUMMARY_TOKENS):
+        self.budget = budget
+        self.keep_recent = max(keep_recent, 1)
+        self.answer_tokens = answer_tokens
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        self.turns: List[MemoryTurn] = []
+        # Tăng mỗi khi lịch sử đổi; dùng làm khoá cho kết quả truy hồi đã prefetch
+        self.revision = 0
+        # Lần tóm tắt đang chạy nền (nếu có)
+        self.compaction: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def add(self, question: str, answer: str) -> None:
+        question = clip_tokens(question, self.answer_tokens)
+        answer = clip_tokens(answer, self.answer_tokens)
+        with self._lock:
+            self.turns.append(MemoryTurn(question, answer, estimate_tokens(question) + estimate_tokens(answer)))
+            self.revision += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.summary = ""
+            self.turns = []
+            self.revision += 1
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(t.tokens for t in self.turns)
+
+    def needs_compaction(self) -> bool:
+        return len(self.turns) > self.keep_recent and sum(t.tokens for t in self.turns) > self.budget
+
+    def compaction_input(self) -> Tuple[str, List[MemoryTurn]]:
+        """Tóm tắt hiện tại và các lượt cũ cần gộp vào (ảnh chụp, không sửa lịch sử)."""
+        with self._lock:
+            return self.summary, list(self.turns[:-self.keep_recent])
+
+    def apply_summary(self, summary: str, compacted: List[MemoryTurn]) -> None:
+        """Thay các lượt đã gộp bằng tóm tắt mới; lượt thêm vào trong lúc tóm tắt được giữ nguyên."""
+        with self._lock:
+            n = len(compacted)
+            if self.turns[:n] != compacted:
+                return
+            self.summary = clip_tokens(summary, self.summary_tokens)
+            self.turns = self.turns[n:]
+            self.revision += 1
+
+    def fallback_summary(self, compacted: List[MemoryTurn]) -> str:
+        """Tóm tắt không cần gọi API: giữ các câu hỏi đã hỏi (mới nhất ở cuối)."""
+        asked = "; ".join(t.question for t in compacted)
+        text = f"{self.summary} Học sinh đã hỏi: {asked}".strip()
+        words = text.split()
+        # Giữ phần cuối (các câu hỏi gần nhất) khi quá dài
+        while words and estimate_tokens(" ".join(words)) > self.summary_tokens:
+            words = words[len(words) // 4 + 1:]
+        return " ".join(words)
+
+    def is_follow_up(self, question: str) -> bool:
+        """Câu hỏi có cần ngữ cảnh các lượt trước để hiểu không (heuristic, không gọi API)."""
+        if not self.turns:
+            return False
+        if _RE_FOLLOW_UP.search(question):
+            return True
+        return (len(question.split()) <= _SHORT_QUESTION_WORDS
+                and not _RE_FORMULA.search(question) and not _RE_DEFINITION.search(question))
+
+    def render(self) -> str:
+        """Khối lịch sử chèn vào prompt: tóm tắt + các lượt gần đây."""
+        with self._lock:
+            summary, turns = self.summary, list(self.turns)
+        parts: List[str] = []
+        if summary:
+            parts.append(f"Tóm tắt các lượt trước: {summary}")
+        for t in turns:
+            parts.append(f"Học sinh: {t.question}\nChemA: {t.answer}")
+        return "\n\n".join(parts)
+
+
+def rewrite_prompt(question: str, memory: ConversationMemory) -> str:
+    """Prompt viết lại câu hỏi tiếp nối thành câu hỏi độc lập để truy hồi tài liệu."""
+    return f"""Dưới đây là hội thoại giữa học sinh và trợ lý Hoá học, rồi một câu hỏi tiếp nối.
+Viết lại câu hỏi tiếp nối thành MỘT câu hỏi độc lập, đầy đủ chủ đề/chất/số câu được nhắc tới,
+để tìm tài liệu mà không cần đọc hội thoại. Giữ nguyên công thức hoá học. Nếu câu hỏi đã độc lập
+thì giữ nguyên. Chỉ trả về câu hỏi, không giải thích.
+
+Hội thoại:
+{memory.render()}
+
+Câu hỏi tiếp nối: {question}
+Câu hỏi độc lập:"""
+
+
+def summary_prompt(summary: str, turns: List[MemoryTurn], max_tokens: int) -> str:
+    """Prompt gộp các lượt cũ vào tóm tắt đang có."""
+    dialogue = "\n\n".join(f"Học sinh: {t.question}\nChemA: {t.answer}" for t in turns)
+    return f"""Tóm tắt ngắn gọn (tối đa khoảng {max_tokens} token, tiếng Việt) cuộc hội thoại học Hoá dưới đây
+để trợ lý tiếp tục trả lời: các chủ đề, chất, bài tập đã hỏi, kết quả/đáp án chính và chỗ học sinh còn vướng.
+
+Tóm tắt trước đó: {summary or "(chưa có)"}
+
+Các lượt mới:
+{dialogue}
+
+Tóm tắt:"""
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+# Bộ đếm dùng chung trong process (hit/miss cache, số lần fallback, ...)
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+
+
+def incr(name: str, value: float = 1.0) -> None:
+    """Cộng dồn một bộ đếm."""
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name: str, value: float) -> None:
+    """Ghi giá trị hiện tại (vd. độ dài hàng chờ) và giữ mức cao nhất ở `<name>.max`."""
+    with _lock:
+        _counters[name] = value
+        _counters[f"{name}.max"] = max(_counters[f"{name}.max"], value)
+
+
+def observe(name: str, value: float) -> None:
+    """Ghi một lần đo (vd. thời gian chờ): `<name>.count`, `<name>.sum`, `<name>.max`."""
+    with _lock:
+        _counters[f"{name}.count"] += 1
+        _counters[f"{name}.sum"] += value
+        _counters[f"{name}.max"] = max(_counters[f"{name}.max"], value)
+
+
+def snapshot() -> Dict[str, float]:
+    """Bản sao các bộ đếm hiện tại, để log hoặc hiển thị giám sát."""
+    with _lock:
+        return dict(_counters)
+
+
+class StageTimer:
+    """
+    Đo thời gian từng giai đoạn của một lượt hỏi (ms), kể cả các giai đoạn chạy song song.
+    Mỗi lần đo cũng được ghi vào metrics dưới tên `stage.<giai đoạn>_ms`.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+
+    def _record(self, name: str, ms: float) -> None:
+        self.timings[name] = round(ms, 1)
+        observe(f"stage.{name}_ms", ms)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, (time.perf_counter() - start) * 1000)
+
+    def mark(self, name: str) -> None:
+        """Ghi thời điểm (tính từ lúc bắt đầu lượt), vd. lúc nhận token đầu tiên."""
+        self._record(name, (time.perf_counter() - self.started) * 1000)
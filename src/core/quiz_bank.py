@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import random
+import re
+import time
+from dataclasses import dataclass, fields, replace
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.config import QUIZ_SIZE
+from src.core import metrics
+from src.core.doc_meta import TOPICS, detect_topic
+from src.core.quiz_parser import KINDS, answer_text, question_text
+from src.core.text_utils import Question
+
+QUIZ_BANK_PATH = "data/processed/quiz_bank.jsonl"
+# Vector câu hỏi (cùng thứ tự dòng với quiz_bank.jsonl) và thông tin embedder đã dùng
+QUIZ_VECTORS_PATH = "indexes/quiz_bank.npy"
+QUIZ_INFO_PATH = "indexes/quiz_bank_info.json"
+
+QUESTION_FIELDS = tuple(f.name for f in fields(Question))
+# Các phần của đề lắp ráp, theo thứ tự đề THPT
+PAPER_PARTS = {
+    "mcq": "PHẦN I. Trắc nghiệm nhiều phương án lựa chọn",
+    "true_false": "PHẦN II. Trắc nghiệm đúng sai",
+    "short": "PHẦN III. Trắc nghiệm trả lời ngắn",
+    "essay": "PHẦN IV. Tự luận",
+}
+# Loại câu mặc định khi lắp đề: cần đáp án để tự chấm, nên bỏ tự luận
+DEFAULT_KINDS = ("mcq", "true_false", "short")
+MAX_QUIZ_SIZE = 40
+
+# Động từ xin/tạo đề + danh từ đề/quiz: "tạo quiz bảng tuần hoàn", "ra 5 câu trắc nghiệm đúng sai
+# lớp 10"; hoặc "đề N câu": "Cho mình đề 10 câu về liên kết ion". "cho" hay "N câu" đứng một mình
+# không đủ: "Cho 2 câu sau, câu nào đúng" là câu hỏi thường
+_RE_QUIZ_REQUEST = re.compile(
+    r"\b(?:tạo|ra|soạn|lấy|xin|gửi)\b.*?"
+    r"(?:(?<!vấn\s)(?<!chủ\s)\bđề\b(?!\s*(?:bài|cương|này|trên|sau))|\bquiz\b|bài\s+kiểm\s+tra|bộ\s+câu\s+hỏi|câu\s+(?:hỏi\s+)?trắc\s+nghiệm)"
+    r"|\bđề(?:\s+(?:thi|kiểm\s+tra|trắc\s+nghiệm|ôn\s+tập))?\s+\d{1,2}\s*câu",
+    re.I,
+)
+# Nhờ giải/chấm, hoặc dạng câu hỏi: "cho mình hỏi câu 3 trong đề ...", "câu nào đúng", "?"
+_RE_NOT_QUIZ = re.compile(
+    r"\b(?:giải|chấm|sửa|kiểm\s+tra\s+giúp|câu\s+nào|câu\s+sau|trong\s+đề)\b|(?<!câu\s)\bhỏi\b|\?", re.I)
+_RE_QUIZ_SIZE = re.compile(r"(\d{1,2})\s*câu", re.I)
+_RE_QUIZ_GRADE = re.compile(r"lớp\s*(10|11|12)\b", re.I)
+_RE_QUIZ_TOPIC = re.compile(r"\b(?:về|chủ\s+đề|chương|phần)\s+(.+)$", re.I)
+# "giải thích câu 3", "lời giải câu 3", "đáp án câu 3"
+_RE_EXPLAIN_REQUEST = re.compile(
+    r"^\s*(?:giải\s+thích|lời\s+giải|giải\s+chi\s+tiết|hướng\s+dẫn\s+giải|giải|đáp\s+án)\s+(?:cho\s+)?câu\s*(\d{1,2})\b", re.I)
+
+
+@dataclass
+class QuizRequest:
+    """Yêu cầu tạo đề nhận ra từ tin nhắn chat."""
+    size: int
+    topic: str = ""
+    query: str = ""          # chủ đề tự do không khớp TOPICS ("về axit sunfuric"), tìm theo embedding
+    grade: Optional[int] = None
+    kinds: Tuple[str, ...] = DEFAULT_KINDS
+
+
+def parse_quiz_request(text: str) -> Optional[QuizRequest]:
+    """Nhận ra câu xin đề/quiz (không gọi API); None nếu là câu hỏi thường."""
+    if not _RE_QUIZ_REQUEST.search(text) or _RE_NOT_QUIZ.search(text):
+        return None
+    m = _RE_QUIZ_SIZE.search(text)
+    size = min(int(m.group(1)), MAX_QUIZ_SIZE) if m else QUIZ_SIZE
+    m = _RE_QUIZ_GRADE.search(text)
+    grade = int(m.group(1)) if m else None
+    lowered = text.lower()
+    if "đúng sai" in lowered or "đúng/sai" in lowered:
+        kinds: Tuple[str, ...] = ("true_false",)
+    elif "trả lời ngắn" in lowered:
+        kinds = ("short",)
+    elif "nhiều lựa chọn" in lowered or "abcd" in lowered:
+        kinds = ("mcq",)
+    else:
+        kinds = DEFAULT_KINDS
+    topic = detect_topic(text)
+    m = _RE_QUIZ_TOPIC.search(text)
+    query = _RE_QUIZ_GRADE.sub("", m.group(1)).strip(" .?!") if m and not topic else ""
+    return QuizRequest(size=max(size, 1), topic=topic, query=query, grade=grade, kinds=kinds)
+
+
+def parse_explain_request(text: str) -> Optional[int]:
+    """Số câu trong "giải thích câu N" (hỏi về đề vừa tạo), None nếu không phải."""
+    m = _RE_EXPLAIN_REQUEST.match(text)
+    return int(m.group(1)) if m else None
+
+
+def bank_digest(ids: Iterable[str]) -> str:
+    """Dấu vân tay danh sách id câu hỏi, để vector cũ không bị ghép nhầm với ngân hàng mới."""
+    h = hashlib.sha1()
+    for i in ids:
+        h.update(i.encode("utf-8") + b"\n")
+    return h.hexdigest()
+
+
+def record_question(rec: dict) -> Question:
+    """Bản ghi quiz_bank.jsonl -> Question."""
+    return Question(**{k: rec[k] for k in QUESTION_FIELDS if k in rec})
+
+
+def embedding_text(q: Question) -> str:
+    """Văn bản đem nhúng cho một câu: đề + phương án, không kèm đáp án."""
+    return question_text(q, with_answer=False)
+
+
+def _dedupe_key(q: Question) -> str:
+    # Bộ đề có nhiều bản trùng (bản gốc và bản "OK" đã kiểm tra)
+    return " ".join(f"{q.stem} {' '.join(q.choices.values())}".lower().split())
+
+
+class QuizBank:
+    """
+    Ngân hàng câu hỏi do build_quiz_bank tạo, nạp một lần cho cả process.
+    Lọc theo lớp / chủ đề / loại câu bằng mảng numpy và lắp đề cân bằng ngay trên máy,
+    không gọi Gemini. Vector câu hỏi (nếu đã nhúng) dùng để chọn câu theo chủ đề tự do.
+    """
+
+    def __init__(self, path: str = QUIZ_BANK_PATH, vectors_path: str = QUIZ_VECTORS_PATH,
+                 info_path: str = QUIZ_INFO_PATH, embedder_name: Optional[str] = None):
+        self.questions: List[Question] = []
+        self.topic_names: List[str] = [name for name, _ in TOPICS] + [""]
+        grades: List[int] = []
+        topics: List[int] = []
+        rows: List[int] = []      # dòng tương ứng trong quiz_bank.jsonl (= hàng của vector)
+        ids: List[str] = []
+        seen: Dict[str, int] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for row, line in enumerate(f):
+                    rec = json.loads(line)
+                    ids.append(rec.get("id", ""))
+                    q = record_question(rec)
+                    key = _dedupe_key(q)
+                    pos = seen.get(key)
+                    if pos is not None:
+                        # Giữ bản có đáp án/lời giải
+                        old = self.questions[pos]
+                        if (bool(q.answer), bool(q.explanation)) > (bool(old.answer), bool(old.explanation)):
+                            self.questions[pos], rows[pos] = q, row
+                        continue
+                    topic = rec.get("topic") or detect_topic(rec.get("source", ""))
+                    if topic not in self.topic_names:
+                        self.topic_names.insert(-1, topic)
+                    seen[key] = len(self.questions)
+                    self.questions.append(q)
+                    grades.append(int(rec.get("grade") or 0))
+                    topics.append(self.topic_names.index(topic))
+                    rows.append(row)
+        except FileNotFoundError:
+            print(f"CẢNH BÁO: Chưa có ngân hàng câu hỏi {path}. Chạy python -m src.processing.build_quiz_bank.")
+        self.grade = np.array(grades, dtype=np.int16)
+        self.topic = np.array(topics, dtype=np.int16)
+        self.kind = np.array([KINDS.index(q.kind) if q.kind in KINDS else len(KINDS) for q in self.questions],
+                             dtype=np.int8)
+        self.answered = np.array([bool(q.answer) for q in self.questions], dtype=bool)
+        self.vectors: Optional[np.ndarray] = self._load_vectors(vectors_path, info_path, ids, rows, embedder_name)
+        if self.questions:
+            print(f"Ngân hàng câu hỏi: {len(self.questions)} câu ({len(ids) - len(self.questions)} câu trùng đã bỏ), "
+                  f"{'có' if self.vectors is not None else 'không có'} vector.")
+
+    @staticmethod
+    def _load_vectors(vectors_path: str, info_path: str, ids: List[str], rows: List[int],
+                      embedder_name: Optional[str]) -> Optional[np.ndarray]:
+        if not rows:
+            return None
+        try:
+            with open(info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            vectors = np.load(vectors_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        if info.get("digest") != bank_digest(ids) or len(vectors) != len(ids):
+            print("CẢNH BÁO: Vector ngân hàng câu hỏi không khớp quiz_bank.jsonl, chạy lại build_quiz_bank.")
+            return None
+        if embedder_name and info.get("embedder") != embedder_name:
+            print(f"CẢNH BÁO: Vector ngân hàng câu hỏi nhúng bằng {info.get('embedder')}, "
+                  f"khác {embedder_name}: bỏ qua tìm theo chủ đề tự do.")
+            return None
+        return np.ascontiguousarray(vectors[rows], dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def topics(self, grade: Optional[int] = None) -> List[str]:
+        """Các chủ đề có câu hỏi lắp đề được (theo thứ tự TOPICS)."""
+        mask = self._mask(grade, None, DEFAULT_KINDS)
+        present = set(self.topic[mask].tolist())
+        return [name for i, name in enumerate(self.topic_names) if name and i in present]
+
+    def _mask(self, grade: Optional[int], topics: Optional[Sequence[str]], kinds: Sequence[str]) -> np.ndarray:
+        mask = self.answered.copy()
+        if grade:
+            mask &= self.grade == grade
+        if topics:
+            codes = [self.topic_names.index(t) for t in topics if t in self.topic_names]
+            mask &= np.isin(self.topic, codes)
+        mask &= np.isin(self.kind, [KINDS.index(k) for k in kinds if k in KINDS])
+        return mask
+
+    def assemble(self, size: int = QUIZ_SIZE, grade: Optional[int] = None,
+                 topics: Optional[Sequence[str]] = None, kinds: Sequence[str] = DEFAULT_KINDS,
+                 query_vector: Optional[np.ndarray] = None, seed: Optional[int] = None,
+                 pool: int = 5) -> List[Question]:
+        """
+        Lắp một đề `size` câu có đáp án: chia đều giữa các loại câu, trong mỗi loại lần lượt
+        từng chủ đề, chọn ngẫu nhiên (cố định được bằng `seed`). Có `query_vector` thì chỉ chọn
+        trong `size * pool` câu gần chủ đề nhất. Câu được đánh số lại 1..size, xếp theo PAPER_PARTS.
+        """
+        start = time.perf_counter()
+        rows = np.flatnonzero(self._mask(grade, topics, kinds))
+        if query_vector is not None and self.vectors is not None and np.any(query_vector) and len(rows):
+            scores = self.vectors[rows] @ np.asarray(query_vector, dtype=np.float32)
+            keep = min(len(rows), max(size * pool, size))
+            rows = rows[np.argpartition(-scores, keep - 1)[:keep]]
+        rng = random.Random(seed)
+
+        # Mỗi loại câu: xen kẽ các chủ đề (mỗi chủ đề đã xáo trộn)
+        by_kind: Dict[int, Dict[int, List[int]]] = {}
+        for row in rows.tolist():
+            by_kind.setdefault(int(self.kind[row]), {}).setdefault(int(self.topic[row]), []).append(row)
+        queues: List[List[int]] = []
+        for kind in sorted(by_kind):
+            groups = list(by_kind[kind].values())
+            for g in groups:
+                rng.shuffle(g)
+            rng.shuffle(groups)
+            queues.append([g[i] for i in range(max(map(len, groups))) for g in groups if i < len(g)][::-1])
+
+        picked: List[int] = []
+        while len(picked) < size and any(queues):
+            for queue in queues:
+                if queue and len(picked) < size:
+                    picked.append(queue.pop())
+        picked.sort(key=lambda r: int(self.kind[r]))
+        paper = [replace(self.questions[r], index=i, section=PAPER_PARTS.get(self.questions[r].kind, ""))
+                 for i, r in enumerate(picked, 1)]
+        metrics.observe("quiz.assemble_ms", (time.perf_counter() - start) * 1000)
+        return paper
+
+
+def render_quiz(questions: Sequence[Question]) -> str:
+    """Đề dạng Markdown (không kèm đáp án), mỗi phần một tiêu đề."""
+    parts: List[str] = []
+    section = None
+    for q in questions:
+        if q.section != section:
+            section = q.section
+            parts.append(f"**{section}**")
+        parts.append(question_text(q, with_answer=False).replace("\n", "  \n"))
+    return "\n\n".join(parts)
+
+
+def render_answer_key(questions: Sequence[Question]) -> str:
+    """Bảng đáp án của đề đã lắp (Markdown)."""
+    lines = ["| Câu | Đáp án |", "| --- | --- |"]
+    lines += [f"| {q.index} | {answer_text(q) or '—'} |" for q in questions]
+    return "\n".join(lines)
+
+
+def explain_prompt(q: Question) -> str:
+    """Prompt nhờ Gemini giải một câu trong ngân hàng (đề không kèm lời giải), bám đúng đáp án."""
+    return f"""Giải thích ngắn gọn, từng bước, bằng tiếng Việt cho học sinh THPT vì sao câu hỏi Hoá học dưới đây
+có đáp án như đã cho. Với câu đúng/sai, giải thích từng ý. Viết công thức hoá học dạng thường (H2SO4), không dùng LaTeX.
+
+{question_text(q, with_answer=True)}
+
+Lời giải:"""
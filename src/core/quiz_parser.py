@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from src.core.text_utils import Question
+
+# Loại câu hỏi: trắc nghiệm 4 phương án, đúng/sai theo từng ý a-d, trả lời ngắn, tự luận
+KINDS = ("mcq", "true_false", "short", "essay")
+
+# Mỗi dòng chỉ được so với các regex neo ở đầu dòng dưới đây (không .*? với re.S),
+# nên thời gian phân tích tuyến tính theo độ dài văn bản.
+_RE_QUESTION = re.compile(r"Câu\s*(\d{1,3})\s*[.:)]?\s*(.*)", re.I)
+_RE_CHOICE = re.compile(r"([A-D])\s*[.)]\s*(.*)")
+_RE_STATEMENT = re.compile(r"([a-h])\s*[.)]\s*(.*)")
+# Mốc phương án nằm giữa dòng: "... A. Fe B. Cu C. Ag D. Au" (kể cả dính dấu câu: "Cu.C. Ag")
+_RE_INLINE_CHOICE = re.compile(r"(?<![^\s.,;)])([A-D])[.)]\s+")
+_RE_SECTION = re.compile(
+    r"(?:phần|phan)\s+(?:[IVX]+|\d+)\b.*"
+    r"|[IVX]+\.\s+[A-ZÀ-Ỹ].*"
+    r"|\d+\s+câu\s+(?:hỏi\s+)?(?:trắc\s+nghiệm|tự\s+luận).*"
+    r"|(?:trắc\s+nghiệm|tự\s+luận)\b.*",
+    re.I,
+)
+_RE_KEY_HEADING = re.compile(r"(?:bảng\s+)?đáp\s+án\b\s*[:.]?\s*(.*)", re.I)
+_RE_EXPLAIN_HEADING = re.compile(r"(?:giải\s+chi\s+tiết|hướng\s+dẫn\s+giải|lời\s+giải)\b\s*[:.]?\s*(.*)", re.I)
+# Đáp án ghi ngay dưới câu hỏi: "Đáp án: B", "Chọn B", "Chọn đáp án B."
+_RE_INLINE_ANSWER = re.compile(r"(?:đáp\s+án|chọn(?:\s+đáp\s+án)?)\s*[:.]?\s*([A-D])\s*[.]?\s*$", re.I)
+# Số phần: "phan ii" ở bất kỳ đâu, hoặc "ii." ở đầu tiêu đề (đã bỏ dấu, chữ thường)
+_RE_PART_NUMBER = re.compile(r"\bphan\s+([ivx]+|\d+)\b|^\s*([ivx]+)\s*\.")
+_ROMAN = {"i": 1, "v": 5, "x": 10}
+# Khoá dạng "1A 2B 3-C 4.D"
+_RE_KEY_PAIR = re.compile(r"(\d{1,3})\s*[-.:)]?\s*([A-D])\b")
+
+
+def _plain(text: str) -> str:
+    """Bỏ dấu, chữ thường."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    return "".join(ch for ch in unicodedata.normalize("NFD", text) if not unicodedata.combining(ch)).lower()
+
+
+def _fold(text: str) -> str:
+    """Bỏ dấu, chữ thường, gộp khoảng trắng (để so tiêu đề phần với tiêu đề đáp án)."""
+    return " ".join(re.sub(r"[^\w\s]", " ", _plain(text)).split())
+
+
+def _part_number(title: str) -> Optional[int]:
+    """Số thứ tự phần trong tiêu đề: 'PHẦN II. ...' / 'Đáp án phần 2' / 'II. TỰ LUẬN' -> 2."""
+    m = _RE_PART_NUMBER.search(_plain(title))
+    if not m:
+        return None
+    token = m.group(1) or m.group(2)
+    if token.isdigit():
+        return int(token)
+    value = 0
+    for ch, nxt in zip(token, token[1:] + " "):
+        n = _ROMAN[ch]
+        value += -n if _ROMAN.get(nxt, 0) > n else n
+    return value
+
+
+def _contains_words(text: str, words: str) -> bool:
+    """`words` nằm trong `text` theo nguyên từ ('phan i' không nằm trong 'phan ii ...')."""
+    return f" {words} " in f" {text} "
+
+
+def _true_false(cell: str) -> Optional[str]:
+    cell = cell.strip().upper()
+    if cell.startswith(("Đ", "D")):
+        return "Đ"
+    if cell.startswith("S"):
+        return "S"
+    return None
+
+
+@dataclass
+class _Section:
+    title: str
+    questions: List[Question] = field(default_factory=list)
+    by_index: Dict[int, Question] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.folded = _fold(self.title)
+        self.part = _part_number(self.title)
+
+    def add(self, q: Question) -> None:
+        self.questions.append(q)
+        self.by_index.setdefault(q.index, q)
+
+
+@dataclass
+class _Block:
+    """Một khối đáp án / lời giải, áp vào phần đề tương ứng khi đọc xong tài liệu."""
+    title: str
+    sections_before: int  # số phần đề đã đọc khi gặp khối (khối chỉ nói về các phần trước nó)
+    answers: Dict[int, str] = field(default_factory=dict)
+    true_false: Dict[int, Dict[str, str]] = field(default_factory=dict)
+    explanations: Dict[int, List[str]] = field(default_factory=dict)
+
+
+class QuizParser:
+    """
+    Tách đề trắc nghiệm theo từng dòng: "Câu N." mở câu mới, "A." ... "D." là phương án
+    (kể cả khi nằm chung dòng), "a." ... là các ý (đúng/sai; có phương án A-D theo sau thì
+    các ý thuộc về đề bài), dòng "PHẦN I", "I. ..." hay "10 Câu trắc nghiệm đúng sai" mở
+    phần mới. Khối "ĐÁP ÁN ..." (bảng | Câu | Đáp án |, bảng đúng/sai | Câu | Lệnh hỏi |
+    Đáp án (Đ/S) |, hoặc "1A 2B ...") và "GIẢI CHI TIẾT ..." được gán về phần có tiêu đề
+    khớp, không khớp thì theo thứ tự xuất hiện.
+    """
+
+    def __init__(self, source: str = ""):
+        self.source = source
+        self.sections: List[_Section] = []
+        self.blocks: List[_Block] = []
+        self._question: Optional[Question] = None
+        self._last_key: Optional[str] = None   # phương án/ý đang được nối thêm dòng
+        self._block: Optional[_Block] = None
+        self._mode = "questions"                # questions | key | explain
+        self._key_width = 0                     # số cột mỗi nhóm trong bảng đáp án
+        self._explaining: Optional[int] = None
+
+    # ---- đọc từng dòng ----
+    def feed(self, text: str) -> None:
+        for raw in text.splitlines():
+            line = raw.strip().lstrip("#").strip()
+            if line:
+                self._line(line)
+
+    def _line(self, line: str) -> None:
+        m = _RE_KEY_HEADING.match(line)
+        if m and not (self._mode == "questions" and _RE_INLINE_ANSWER.match(line) and self._question):
+            self._start_block(m.group(1), "key")
+            # "ĐÁP ÁN: 1A 2B 3C ..." (nhưng không đọc nhầm "ĐÁP ÁN 10 Câu ..." thành khoá)
+            if len(_RE_KEY_PAIR.findall(m.group(1))) > 1:
+                self._key_pairs(m.group(1))
+            return
+        m = _RE_EXPLAIN_HEADING.match(line)
+        if m:
+            self._start_block(m.group(1), "explain")
+            return
+        if self._mode != "questions" and not line.startswith("|") and _RE_SECTION.fullmatch(line):
+            # Đề có phần câu hỏi mới sau khối đáp án/lời giải
+            self._mode = "questions"
+        if self._mode == "key":
+            self._key_line(line)
+        elif self._mode == "explain":
+            self._explain_line(line)
+        else:
+            self._question_line(line)
+
+    def _start_block(self, title: str, mode: str) -> None:
+        self._mode = mode
+        self._block = _Block(title=title.strip(), sections_before=len(self.sections))
+        self.blocks.append(self._block)
+        self._question = None
+        self._key_width = 0
+        self._explaining = None
+
+    def _question_line(self, line: str) -> None:
+        m = _RE_QUESTION.match(line)
+        if m:
+            if not self.sections:
+                self.sections.append(_Section(title=""))
+            self._question = Question(index=int(m.group(1)), stem="", choices={},
+                                      section=self.sections[-1].title, source=self.source)
+            self.sections[-1].add(self._question)
+            self._last_key = None
+            self._stem_or_choices(m.group(2))
+            return
+        if _RE_SECTION.fullmatch(line) and not _RE_CHOICE.match(line):
+            self.sections.append(_Section(title=line.rstrip(" .:")))
+            self._question = None
+            return
+        q = self._question
+        if q is None:
+            return
+        m = _RE_INLINE_ANSWER.match(line)
+        if m:
+            q.answer = m.group(1)
+            return
+        m = _RE_STATEMENT.match(line)
+        if m and not any(k.isupper() for k in q.choices):
+            self._last_key = m.group(1)
+            q.choices[self._last_key] = m.group(2).strip()
+            return
+        self._stem_or_choices(line)
+
+    def _stem_or_choices(self, text: str) -> None:
+        """Tách các mốc "A." "B." ... liên tiếp (đúng thứ tự) khỏi phần còn lại của dòng."""
+        q = self._question
+        expected = chr(ord("A") + sum(1 for k in q.choices if k.isupper()))
+        cuts = []
+        for m in _RE_INLINE_CHOICE.finditer(text):
+            if m.group(1) == expected:
+                cuts.append(m)
+                expected = chr(ord(expected) + 1)
+        if not cuts:
+            if self._last_key is not None:
+                q.choices[self._last_key] = f"{q.choices[self._last_key]} {text}".strip()
+            else:
+                q.stem = f"{q.stem} {text}".strip()
+            return
+        if cuts[0].group(1) == "A":
+            self._fold_statements()
+        head = text[:cuts[0].start()].strip()
+        if head:
+            if self._last_key is not None:
+                q.choices[self._last_key] = f"{q.choices[self._last_key]} {head}".strip()
+            else:
+                q.stem = f"{q.stem} {head}".strip()
+        for i, m in enumerate(cuts):
+            end = cuts[i + 1].start() if i + 1 < len(cuts) else len(text)
+            q.choices[m.group(1)] = text[m.end():end].strip()
+            self._last_key = m.group(1)
+
+    def _fold_statements(self) -> None:
+        """
+        Phương án A. đến sau các ý a), b)...: đó là câu "Cho các phát biểu sau: a) ... b) ...
+        Số phát biểu đúng là", các ý (kèm các dòng đã nối vào ý cuối) thuộc về đề bài.
+        Câu trong phần đúng/sai giữ nguyên các ý.
+        """
+        q = self._question
+        statements = [k for k in q.choices if k.islower()]
+        if not statements or "dung sai" in _fold(q.section):
+            return
+        q.stem = " ".join([q.stem] + [f"{k}) {q.choices.pop(k)}" for k in statements]).strip()
+        self._last_key = None
+
+    def _key_pairs(self, text: str) -> None:
+        for m in _RE_KEY_PAIR.finditer(text):
+            self._block.answers[int(m.group(1))] = m.group(2)
+
+    def _key_line(self, line: str) -> None:
+        if line.startswith("|"):
+            cells = [c.strip() for c in line.strip("|").split("|")]
+            if all(set(c) <= set("-: ") for c in cells):
+                return
+            n_cau = sum(1 for c in cells if c.lower() in ("câu", "cau"))
+            if n_cau:
+                self._key_width = len(cells) // n_cau
+                return
+            width = self._key_width or 2
+            for i in range(0, len(cells) - width + 1, width):
+                group = cells[i:i + width]
+                if not group[0].isdigit() or not group[-1]:
+                    continue
+                index = int(group[0])
+                if width >= 3:
+                    verdict = _true_false(group[-1])
+                    if verdict and len(group[1]) == 1:
+                        self._block.true_false.setdefault(index, {})[group[1].lower()] = verdict
+                else:
+                    self._block.answers[index] = group[1]
+            return
+        m = _RE_QUESTION.match(line)
+        if m and m.group(2):
+            self._block.answers[int(m.group(1))] = m.group(2).strip().rstrip(".")
+            return
+        self._key_pairs(line)
+
+    def _explain_line(self, line: str) -> None:
+        m = _RE_QUESTION.match(line)
+        if m:
+            self._explaining = int(m.group(1))
+            self._block.explanations[self._explaining] = [m.group(2).strip()]
+        elif self._explaining is not None:
+            self._block.explanations[self._explaining].append(line)
+
+    # ---- kết thúc ----
+    def _target(self, block: _Block, order: int) -> Optional[_Section]:
+        """
+        Phần đề mà khối đáp án/lời giải nói tới: cùng số phần (PHẦN I ≠ PHẦN II) nếu cả hai
+        tiêu đề đều có số, không thì tiêu đề chứa nhau theo nguyên từ; không khớp thì theo thứ tự.
+        """
+        n = block.sections_before
+        if not n:
+            return None
+        title, part = _fold(block.title), _part_number(block.title)
+        if title:
+            for i in range(n - 1, -1, -1):
+                section = self.sections[i]
+                if part is not None and section.part is not None:
+                    if part == section.part:
+                        return section
+                elif section.folded and (_contains_words(section.folded, title)
+                                         or _contains_words(title, section.folded)):
+                    return section
+        return self.sections[min(order, n - 1)]
+
+    def questions(self) -> List[Question]:
+        """Danh sách câu hỏi đã gắn đáp án, lời giải và loại câu."""
+        order = {"key": 0, "explain": 0}
+        for block in self.blocks:
+            kind = "explain" if block.explanations else "key"
+            section = self._target(block, order[kind])
+            order[kind] += 1
+            if section is None:
+                continue
+            for index, answer in block.answers.items():
+                q = section.by_index.get(index)
+                if q is not None:
+                    q.answer = answer
+            for index, verdicts in block.true_false.items():
+                q = section.by_index.get(index)
+                if q is not None:
+                    q.answer = "".join(verdicts[k] for k in sorted(verdicts))
+            for index, lines in block.explanations.items():
+                q = section.by_index.get(index)
+                if q is not None:
+                    q.explanation = " ".join(s for s in lines if s)
+        out: List[Question] = []
+        for section in self.sections:
+            for q in section.questions:
+                q.kind = _infer_kind(q)
+                out.append(q)
+        return out
+
+
+def _infer_kind(q: Question) -> str:
+    section = _fold(q.section)
+    if "dung sai" in section or (q.answer and set(q.answer) <= {"Đ", "S"} and len(q.answer) > 1):
+        return "true_false"
+    if "tra loi ngan" in section:
+        return "short"
+    if any(k.isupper() for k in q.choices):
+        return "mcq"
+    if "tu luan" in section or not q.answer:
+        return "essay"
+    return "short"
+
+
+def parse_quiz(text: str, source: str = "") -> List[Question]:
+    """Tách một đề (văn bản/Markdown) thành danh sách Question có đáp án nếu đề kèm khoá."""
+    parser = QuizParser(source=source)
+    parser.feed(text)
+    return parser.questions()
+
+
+def answer_text(q: Question) -> str:
+    """Đáp án dạng đọc được: "B", câu đúng/sai "a) Đ b) S ...", "" nếu đề không kèm khoá."""
+    if not q.answer:
+        return ""
+    if q.kind == "true_false":
+        verdicts = " ".join(f"{k}) {v}" for k, v in zip(sorted(k for k in q.choices if k.islower()), q.answer))
+        return verdicts or q.answer
+    return q.answer
+
+
+def question_text(q: Question, with_answer: bool = True) -> str:
+    """Văn bản một câu hỏi (để index riêng từng câu hoặc hiển thị)."""
+    lines = [f"Câu {q.index}. {q.stem}".rstrip()]
+    lines += [f"{k}. {v}" for k, v in q.choices.items()]
+    if with_answer and q.answer:
+        lines.append(f"Đáp án: {answer_text(q)}")
+    if with_answer and q.explanation:
+        lines.append(f"Giải: {q.explanation}")
+    return "\n".join(lines)
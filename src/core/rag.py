@@ -1,6 +1,7 @@
-import json
-from dataclasses import dataclass
-from typing import List, Optional, Any, Generator, Dict
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Any, AsyncGenerator, AsyncIterator, Callable, Generator, Dict, Iterator, Sequence, Tuple, Union
 import numpy as np
 import faiss
 import google.generativeai as genai
@@ -9,32 +10,74 @@ import PIL.Image
 from google.generativeai.types import GenerationConfig, generation_types, HarmCategory, HarmBlockThreshold
 
 from src.config import (
-    EMBED_MODEL,
+    ANSWER_CACHE_ENABLED,
+    CONTEXT_TOKEN_BUDGET,
+    EMBED_CACHE_MAX_QUERIES,
+    FAISS_EF_SEARCH,
+    FAISS_NPROBE,
     GEMINI_API_KEY,
     GEMINI_MODEL,
+    GEMINI_PREWARM_IDLE,
+    HYBRID_CANDIDATES,
     MIN_SIMILARITY,
+    MMR_LAMBDA,
+    MODE_CONTEXT_BUDGETS,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    QUERY_REWRITE_ENABLED,
+    RERANK_CANDIDATES,
+    RERANK_ENABLED,
+    RRF_K,
     TOP_K,
 )
+from src.core import async_runtime, metrics
+from src.core.metrics import StageTimer
+from src.core.answer_cache import CachedAnswer, SemanticAnswerCache
+from src.core.cache import AsyncSingleFlight, LRUCache, SingleFlight
+from src.core.chunk_store import ChunkStore, open_chunk_store
+from src.core.context_packer import pack_context
+from src.core.embed_cache import EmbeddingCache
+from src.core.embedders import TASK_DOCUMENT, TASK_QUERY, check_index_compatible, get_embedder
 from src.core.instructions import SYSTEM_INSTRUCTION
-from src.core.text_utils import cleanup_response
+from src.core.memory import ConversationMemory, rewrite_prompt, summary_prompt
+from src.core.lexical_index import (
+    LexicalIndex,
+    is_formula_query,
+    keyword_scan,
+    open_lexical_index,
+    query_formulas,
+    reciprocal_rank_fusion,
+)
+from src.core.rate_limiter import QueueStatus, RateLimiter, estimate_request_tokens, get_rate_limiter, wait_with_updates
+from src.core.quiz_bank import explain_prompt
+from src.core.quiz_parser import question_text
+from src.core.text_utils import Question, StreamingCleaner, cleanup_response, estimate_tokens
+from src.core.rerank import get_cross_encoder, mmr, normalize_scores
+from src.core.vector_index import apply_search_params, load_index_info, search_subset
 
 INDEX_PATH = "indexes/faiss.index"
 META_PATH = "indexes/meta.jsonl"
 CHUNKS_PATH = "data/processed/chunks.jsonl"
 
 # Retry helper (dán lên đầu rag.py)
-import time, re
+import time, re, unicodedata
 from google.api_core import exceptions as gexc
 
-def _sleep_from_error(e, attempt):
+def _retry_delay(e, attempt) -> float:
     m = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(e))
     if m:
-        time.sleep(max(int(m.group(1)), 2))
-    else:
-        time.sleep(min(2 ** attempt, 30))  # exponential backoff
+        return max(int(m.group(1)), 2)
+    return min(2 ** attempt, 30)  # exponential backoff
+
+def _sleep_from_error(e, attempt):
+    time.sleep(_retry_delay(e, attempt))
 
-def gen_with_retry(model, contents, generation_config, safety_settings, max_tries=5):
+def gen_with_retry(model, contents, generation_config, safety_settings, max_tries=5,
+                   limiter: Optional[RateLimiter] = None):
+    tokens = estimate_request_tokens(contents)
     for attempt in range(max_tries):
+        if limiter is not None:
+            limiter.acquire(tokens)
         try:
             return model.generate_content(
                 contents,
@@ -43,10 +86,54 @@ def gen_with_retry(model, contents, generation_config, safety_settings, max_trie
                 stream=True
             )
         except (gexc.ResourceExhausted, gexc.TooManyRequests) as e:  # 429
-            _sleep_from_error(e, attempt)
+            if limiter is not None:
+                # Dừng cả hàng chờ thay vì mỗi phiên tự backoff rồi cùng gọi lại
+                limiter.pause(_retry_delay(e, attempt))
+            else:
+                _sleep_from_error(e, attempt)
             continue
     raise RuntimeError("Rate limit exceeded after retries")
 
+async def agen_with_retry(model, contents, generation_config, safety_settings, max_tries=5,
+                          limiter: Optional[RateLimiter] = None,
+                          on_wait: Optional[Callable[[int], Any]] = None):
+    """
+    Như gen_with_retry nhưng chờ quota/backoff bằng asyncio: phiên bị 429 không giữ thread nào.
+    `on_wait(vị trí)` được gọi khi vị trí trong hàng chờ của limiter thay đổi.
+    """
+    tokens = estimate_request_tokens(contents)
+    for attempt in range(max_tries):
+        if limiter is not None:
+            await limiter.aacquire(tokens, on_wait)
+        try:
+            return await model.generate_content_async(
+                contents,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+                stream=True
+            )
+        except (gexc.ResourceExhausted, gexc.TooManyRequests) as e:  # 429
+            if limiter is not None:
+                limiter.pause(_retry_delay(e, attempt))
+            else:
+                await asyncio.sleep(_retry_delay(e, attempt))
+            continue
+    raise RuntimeError("Rate limit exceeded after retries")
+
+GENERATION_CONFIG = GenerationConfig(
+    temperature=0.7,
+    top_p=0.95,
+    top_k=40,
+    max_output_tokens=4096,
+)
+
+def normalize_query(text: str) -> str:
+    """
+    Chuẩn hoá câu hỏi làm khoá cache: NFC + gộp khoảng trắng.
+    Không hạ chữ thường vì công thức phân biệt hoa/thường (Co ≠ CO).
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
 @dataclass
 class StreamOutput:
     """Class để chứa kết quả cuối cùng từ stream, bao gồm metadata."""
@@ -54,6 +141,23 @@ class StreamOutput:
     sources: List[dict]
     strategy: str
     top_score: float
+    # Số token tài liệu đã gửi cho mỗi nguồn (id chunk -> token)
+    source_tokens: Dict[str, int] = field(default_factory=dict)
+    # Thời gian từng giai đoạn của lượt hỏi (ms): lexical, embed, dense, pack, first_token, total...
+    timings: Dict[str, float] = field(default_factory=dict)
+
+@dataclass
+class _Prompt:
+    """Nội dung gửi Gemini cho một lượt hỏi, cùng metadata để dựng StreamOutput."""
+    contents: List[Any]
+    strategy: str
+    sources: List[dict] = field(default_factory=list)
+    top_score: float = 0.0
+    source_tokens: Dict[str, int] = field(default_factory=dict)
+    # Vector câu hỏi + phạm vi để lưu câu trả lời vào answer cache
+    question_vec: Optional[np.ndarray] = None
+    cache_scope: str = ""
+    error: str = ""
 
 class RAGEngine:
     def __init__(self):
@@ -65,6 +169,8 @@ class RAGEngine:
             GEMINI_MODEL,
             system_instruction=SYSTEM_INSTRUCTION
         )
+        # Model không kèm vai trò gia sư, cho các việc phụ: viết lại câu hỏi, tóm tắt hội thoại
+        self.utility_model = genai.GenerativeModel(GEMINI_MODEL)
 
         # Cấu hình an toàn - Sử dụng HarmCategory và HarmBlockThreshold đã import
         self.safety_settings = {
@@ -74,20 +180,51 @@ class RAGEngine:
             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
         }
 
+        # Embedder theo EMBED_BACKEND (Gemini hoặc model cục bộ), dùng chung với build_index
+        self.embedder = get_embedder()
+        # Quota Gemini dùng chung cho mọi phiên (embed + generate), hàng chờ FIFO
+        self.limiter = get_rate_limiter()
+        # Cache embedding câu hỏi trên đĩa: vùng riêng, có giới hạn, dùng chung giữa các process
+        self.embed_cache = EmbeddingCache(model=self.embedder.name, scope="queries",
+                                          max_rows=EMBED_CACHE_MAX_QUERIES)
+        # Cache câu hỏi trong RAM + gộp các lời gọi trùng đang chạy
+        self._query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL, name="query_embed")
+        self._embed_flight = SingleFlight(name="query_embed")
+        self._aembed_flight = AsyncSingleFlight(name="query_embed")
+        # Các giai đoạn độc lập của một lượt (nhúng câu hỏi || BM25) chạy song song
+        self._stage_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-stage")
+        # Truy hồi bắt đầu sớm qua `prefetch`, khoá theo (câu hỏi, bộ lọc)
+        self._prefetched = LRUCache(64, ttl=60, name="prefetch")
+        self._last_gemini_call = 0.0
+        # Lời giải Gemini cho câu trong ngân hàng câu hỏi (đề không kèm lời giải), dùng chung mọi phiên
+        self._explanations = LRUCache(512, name="quiz_explain")
+        # Cache câu trả lời theo ngữ nghĩa (tuỳ chọn)
+        self.answer_cache = SemanticAnswerCache() if ANSWER_CACHE_ENABLED else None
+
         # Khởi tạo RAG
         self.index = None
-        self.metas = []
-        self._id2text = {}
+        self.store: Optional[ChunkStore] = None
+        self.lexical: Optional[LexicalIndex] = None
+        # Manifest do build_index ghi: embedder, số chiều, kiểu index
+        self.index_info: Optional[dict] = load_index_info()
+        self.dim: Optional[int] = (self.index_info or {}).get("dim")
         try:
-            self.index = faiss.read_index(INDEX_PATH)
-            with open(META_PATH, "r", encoding="utf-8") as f:
-                self.metas = [json.loads(line) for line in f]
-
-            with open(CHUNKS_PATH, "r", encoding="utf-8") as f:
-                for line in f:
-                    rec = json.loads(line)
-                    self._id2text[rec["id"]] = rec["text"]
-            print("RAG Engine initialized successfully with FAISS index and metadata.")
+            index = faiss.read_index(INDEX_PATH)
+            # Text + metadata được memory-map, chỉ đọc các hàng được truy hồi
+            self.store = open_chunk_store(CHUNKS_PATH, META_PATH)
+            # BM25 cho khớp chính xác công thức/tên bài, cùng số hàng với store
+            self.lexical = open_lexical_index(self.store)
+            try:
+                # Từ chối index build bằng embedder/số chiều khác cấu hình hiện tại
+                check_index_compatible(self.index_info, self.embedder, index.d)
+                # nprobe (IVF) / efSearch (HNSW); bị bỏ qua với index phẳng
+                apply_search_params(index, FAISS_NPROBE, FAISS_EF_SEARCH)
+                self.index = index
+                self.dim = index.d
+                print("RAG Engine initialized successfully with FAISS index, chunk store and BM25 index.")
+            except ValueError as e:
+                metrics.incr("rag.index_rejected")
+                print(f"CẢNH BÁO: {e} Tạm thời chỉ tìm kiếm theo từ khoá.")
         except FileNotFoundError:
             print("CẢNH BÁO: Không tìm thấy file index/meta/chunks. Chế độ RAG (tìm kiếm tài liệu) sẽ bị tắt.")
         except Exception as e:
@@ -95,174 +232,834 @@ class RAGEngine:
             import traceback
             traceback.print_exc()
 
+    def _embed_uncached(self, text: str, task: str) -> np.ndarray:
+        """Tra cache trên đĩa, hết mới gọi API."""
+        cached = self.embed_cache.get(text, task)
+        if cached is not None:
+            return cached
+        if self.embedder.backend == "gemini":
+            self.limiter.acquire(estimate_tokens(text))
+        return self._store_embedding(text, task, self.embedder.embed([text], task)[0])
+
+    async def _aembed_uncached(self, text: str, task: str) -> np.ndarray:
+        cached = self.embed_cache.get(text, task)
+        if cached is not None:
+            return cached
+        if self.embedder.backend == "gemini":
+            await self.limiter.aacquire(estimate_tokens(text))
+        return self._store_embedding(text, task, (await self.embedder.aembed([text], task))[0])
+
+    def _store_embedding(self, text: str, task: str, vec: np.ndarray) -> np.ndarray:
+        """Chuẩn hoá L2 rồi ghi cache trên đĩa."""
+        norm = np.linalg.norm(vec)
+        if norm == 0: return vec
+        vec /= norm
+        try:
+            self.embed_cache.put(text, task, vec)
+        except Exception as e:
+            print(f"Không ghi được cache embedding: {e}")
+        return vec
+
     def embed(self, text: str) -> np.ndarray:
-        """Nhúng văn bản (câu hỏi hoặc tài liệu)."""
+        """
+        Nhúng văn bản (câu hỏi hoặc tài liệu).
+        Thứ tự tra: LRU trong RAM → cache trên đĩa → API. Các phiên hỏi cùng một câu
+        cùng lúc chỉ tạo một lời gọi API (single-flight).
+        """
         try:
-            task = "RETRIEVAL_DOCUMENT" if len(text) > 256 else "RETRIEVAL_QUERY"
-            resp = genai.embed_content(
-                model=EMBED_MODEL,
-                content=text,
-                task_type=task
-            )
-            vec = np.array(resp["embedding"], dtype=np.float32)
-            norm = np.linalg.norm(vec)
-            if norm == 0: return vec
-            vec /= norm
+            task, text = key = self._embed_key(text)
+            vec = self._query_cache.get(key)
+            if vec is not None:
+                return vec
+            vec = self._embed_flight.do(key, lambda: self._embed_uncached(text, task))
+            if np.any(vec):
+                self._query_cache.put(key, vec)
+            return vec
+        except Exception as e:
+            return self._embed_failed(e)
+
+    async def aembed(self, text: str) -> np.ndarray:
+        """Bản async của `embed`: chờ API không giữ thread, gộp lời gọi trùng trên event loop."""
+        try:
+            task, text = key = self._embed_key(text)
+            vec = self._query_cache.get(key)
+            if vec is not None:
+                return vec
+            vec = await self._aembed_flight.do(key, lambda: self._aembed_uncached(text, task))
+            if np.any(vec):
+                self._query_cache.put(key, vec)
             return vec
         except Exception as e:
-            print(f"Lỗi khi nhúng văn bản: {e}")
-            return np.zeros(768, dtype=np.float32) # Kích thước của text-embedding-004
+            return self._embed_failed(e)
+
+    @staticmethod
+    def _embed_key(text: str) -> Tuple[str, str]:
+        text = normalize_query(text)
+        return (TASK_DOCUMENT if len(text) > 256 else TASK_QUERY), text
+
+    def _embed_failed(self, e: Exception) -> np.ndarray:
+        metrics.incr("embed.error")
+        print(f"Lỗi khi nhúng văn bản: {e}")
+        # Vector 0 = "không nhúng được"; retrieve sẽ chuyển sang tìm theo từ khoá
+        return np.zeros(self.dim or self.embedder.dim or 768, dtype=np.float32)
+
+    def stats(self) -> Dict[str, float]:
+        """Bộ đếm giám sát (hit/miss cache, số lời gọi được gộp, hàng chờ quota, ...)."""
+        snap = metrics.snapshot()
+        snap["query_embed.size"] = len(self._query_cache)
+        snap["ratelimit.queue_depth"] = len(self.limiter)
+        return snap
+
+    def _result(self, row: int, score: float) -> Dict:
+        meta = self.store.meta(row)
+        return {
+            **meta,
+            "score": score,
+            "text": self.store.text(row).strip()
+        }
+
+    def _dense_search(self, query_vector: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> Dict[int, float]:
+        """
+        Tìm trong FAISS. Trả về {hàng: cosine} theo thứ tự điểm giảm dần, đã lọc MIN_SIMILARITY.
+        Có `mask` thì chỉ tìm trong các hàng được chọn (ID selector), không lọc sau khi tìm.
+        """
+        if mask is None:
+            distances, indices = self.index.search(query_vector, k)
+        else:
+            distances, indices = search_subset(self.index, query_vector, k,
+                                               np.asarray(self.store.vids)[mask], FAISS_NPROBE)
+        hits: Dict[int, float] = {}
+        if indices.size > 0:
+            # FAISS trả về vid (IndexIDMap2) hoặc số thứ tự (index cũ); store đổi cả hai sang hàng
+            rows = self.store.rows_for_vids(indices[0])
+            for row, dist in zip(rows, distances[0]):
+                if row >= 0 and float(dist) >= MIN_SIMILARITY:
+                    hits.setdefault(int(row), float(dist))
+        return hits
+
+    def _lexical_search(self, query: str, k: int, mask: Optional[np.ndarray] = None) -> Dict[int, float]:
+        """Tìm trong chỉ mục BM25. Trả về {hàng: điểm BM25} theo thứ tự điểm giảm dần."""
+        if self.lexical is None:
+            return {}
+        rows, scores = self.lexical.search(query, k, mask=mask)
+        return {int(r): float(s) for r, s in zip(rows, scores)}
+
+    def _vectors(self, rows: Sequence[int]) -> np.ndarray:
+        """Lấy lại vector (đã chuẩn hoá) của các hàng từ FAISS; hàng không lấy được là vector 0."""
+        vids = np.asarray([self.store.vids[r] for r in rows], dtype=np.int64)
+        try:
+            return np.asarray(self.index.reconstruct_batch(vids), dtype=np.float32)
+        except Exception:
+            vecs = np.zeros((len(rows), self.index.d), dtype=np.float32)
+            for i, vid in enumerate(vids):
+                try:
+                    vecs[i] = self.index.reconstruct(int(vid))
+                except Exception:
+                    pass
+            return vecs
+
+    def _select(self, query: str, rows: List[int], relevance: Sequence[float], top_k: int) -> List[int]:
+        """
+        Re-rank tập ứng viên đã over-fetch: (tuỳ chọn) cross-encoder chấm lại độ liên quan,
+        rồi MMR trên vector lấy lại từ index để bỏ các chunk gần trùng nhau.
+        """
+        if not RERANK_ENABLED or len(rows) <= top_k:
+            return rows[:top_k]
+        rel = normalize_scores(relevance)
+        cross_encoder = get_cross_encoder()
+        if cross_encoder is not None:
+            try:
+                rel = normalize_scores(cross_encoder.score(query, [self.store.text(r) for r in rows]))
+                metrics.incr("rerank.cross_encoder")
+            except Exception as e:
+                print(f"Lỗi cross-encoder, giữ thứ hạng cũ: {e}")
+        if self.index is None:
+            return [rows[i] for i in np.argsort(-rel, kind="stable")[:top_k]]
+        order = mmr(rel, self._vectors(rows), top_k, MMR_LAMBDA)
+        metrics.incr("rerank.mmr")
+        return [rows[i] for i in order]
 
-    def retrieve(self, query: str, top_k: int = TOP_K) -> List[Dict]:
-        """Tìm kiếm văn bản trong FAISS (RAG)."""
-        if not self.index:
+    def _lexical_results(self, query: str, lexical: Dict[int, float], top_k: int) -> List[Dict]:
+        """Kết quả chỉ từ BM25; điểm chuẩn hoá theo hàng đứng đầu (1.0)."""
+        best = max(lexical.values())
+        pool = list(lexical.items())[:max(top_k, RERANK_CANDIDATES)]
+        rows = self._select(query, [r for r, _ in pool], [s for _, s in pool], top_k)
+        return [self._result(row, lexical[row] / best) for row in rows]
+
+    def _keyword_fallback(self, query: str, lexical: Dict[int, float], top_k: int, reason: str,
+                          mask: Optional[np.ndarray] = None) -> List[Dict]:
+        """
+        Tìm theo từ khoá khi không dùng được nhánh vector (nhúng lỗi, index bị từ chối,
+        lệch số chiều): BM25 nếu có, không thì quét tuần tự text các chunk.
+        """
+        metrics.incr("retrieve.keyword_fallback")
+        metrics.incr(f"retrieve.keyword_fallback.{reason}")
+        print(f"Retrieve fallback ({reason}): tìm theo từ khoá.")
+        if not lexical and self.lexical is None:
+            rows = range(len(self.store)) if mask is None else np.flatnonzero(mask)
+            lexical = dict(keyword_scan(((int(r), self.store.text(r)) for r in rows), query, top_k))
+        return self._lexical_results(query, lexical, top_k) if lexical else []
+
+    def _retrieve_lexical(self, query: str, top_k: int,
+                          filters: Optional[dict]) -> Tuple[Optional[List[Dict]], Optional[np.ndarray], Dict[int, float]]:
+        """
+        Phần truy hồi không cần embedding: bộ lọc, BM25, các trường hợp trả lời ngay
+        (câu hỏi chỉ gồm công thức, không có index vector).
+        Trả về (kết quả nếu đã xong, mask bộ lọc, điểm BM25).
+        """
+        if self.store is None:
             print("RAG retrieve skipped: Index not loaded.")
-            return []
-        query_vector = self.embed(query).reshape(1, -1)
+            return [], None, {}
+        try:
+            mask = self.store.filter_mask(filters)
+        except ValueError as e:
+            print(f"Bỏ qua bộ lọc không hợp lệ: {e}")
+            mask = None
+        if mask is not None and not mask.any():
+            print(f"Không có tài liệu nào thoả bộ lọc {filters}.")
+            return [], mask, {}
+        n_candidates = max(top_k, RERANK_CANDIDATES, HYBRID_CANDIDATES)
+        try:
+            lexical = self._lexical_search(query, n_candidates, mask)
+        except Exception as e:
+            print(f"Lỗi khi tìm kiếm BM25: {e}")
+            lexical = {}
+        if lexical and is_formula_query(query):
+            metrics.incr("retrieve.lexical_only")
+            return self._lexical_results(query, lexical, top_k), mask, lexical
+
+        if self.index is None:
+            return self._keyword_fallback(query, lexical, top_k, "no_index", mask), mask, lexical
+        return None, mask, lexical
+
+    def _retrieve_hybrid(self, query: str, query_vector: np.ndarray, lexical: Dict[int, float],
+                         mask: Optional[np.ndarray], top_k: int) -> List[Dict]:
+        """Phần truy hồi sau khi đã có vector câu hỏi: FAISS, gộp RRF với BM25, re-rank."""
+        query_vector = query_vector.reshape(1, -1)
         if np.all(query_vector == 0):
-            print("RAG retrieve skipped: Query embedding failed.")
-            return []
+            return self._keyword_fallback(query, lexical, top_k, "embed_failed", mask)
+        if query_vector.shape[1] != self.index.d:
+            print(f"Vector câu hỏi {query_vector.shape[1]}-D không khớp index {self.index.d}-D.")
+            return self._keyword_fallback(query, lexical, top_k, "dim_mismatch", mask)
+        n_pool = max(top_k, RERANK_CANDIDATES)
         try:
-            distances, indices = self.index.search(query_vector, top_k)
-            results = []
-            if indices.size > 0:
-                for i, dist in zip(indices[0], distances[0]):
-                    if 0 <= i < len(self.metas):
-                        score = float(dist)
-                        if score >= MIN_SIMILARITY:
-                            meta = self.metas[i]
-                            results.append({
-                                "id": meta.get("id", ""),
-                                "source": meta.get("source", ""),
-                                "section": meta.get("section", ""),
-                                "score": score,
-                                "text": self._id2text.get(meta.get("id", ""), "").strip()
-                            })
-            return results
+            dense = self._dense_search(query_vector, max(n_pool, HYBRID_CANDIDATES), mask)
         except Exception as e:
             print(f"Lỗi khi tìm kiếm FAISS: {e}")
-            return []
+            return self._keyword_fallback(query, lexical, top_k, "search_error", mask)
 
-    def answer_stream(self, question: str,
-                      uploaded_file: Optional[Any] = None,
-                      mode: str = "Bình thường") -> Generator[str, None, StreamOutput]:
+        # Hàng chỉ có trong nhánh BM25 được giữ nếu chứa công thức của câu hỏi,
+        # hoặc đủ gần về ngữ nghĩa; tránh kéo vào chunk chỉ trùng vài từ phổ biến.
+        exact_rows = set()
+        for formula in query_formulas(query) if self.lexical is not None else []:
+            exact_rows.update(int(r) for r in self.lexical.postings(formula))
+        scores = dict(dense)
+        extra = [row for row in lexical if row not in scores]
+        if extra:
+            for row, cos in zip(extra, self._vectors(extra) @ query_vector[0]):
+                if row in exact_rows or cos >= MIN_SIMILARITY:
+                    scores[row] = float(cos)
+        lexical_ranking = [row for row in lexical if row in scores]
+
+        fused = reciprocal_rank_fusion([list(dense), lexical_ranking], k=RRF_K)[:n_pool]
+        rows = self._select(query, [r for r, _ in fused], [f for _, f in fused], top_k)
+        return [self._result(row, scores[row]) for row in rows]
+
+    def retrieve(self, query: str, top_k: int = TOP_K, filters: Optional[dict] = None,
+                 timer: Optional[StageTimer] = None) -> List[Dict]:
         """
-        Tạo phản hồi stream từ Gemini, tích hợp RAG hoặc đa phương thức.
-        Yields các chunk văn bản đã làm sạch.
-        Returns StreamOutput chứa kết quả cuối cùng và metadata khi kết thúc.
+        Truy hồi lai: BM25 (khớp chính xác công thức, tên bài) + FAISS (ngữ nghĩa),
+        gộp bằng reciprocal rank fusion, rồi re-rank (MMR / cross-encoder) để lấy
+        top-k đa dạng. Câu hỏi chỉ gồm công thức dùng riêng BM25, không tốn lời gọi API embedding.
+        `filters` giới hạn theo metadata, vd. {"grade": 12} hoặc {"grade": [10, 11], "doc_type": "quiz"};
+        cả hai nhánh chỉ tìm trong các chunk thoả bộ lọc.
+        `timer` (tuỳ chọn) nhận thời gian từng giai đoạn: lexical, embed, dense.
         """
-        contents = []
-        strategy = ""
-        sources = []
-        top_score = 0.0
-        mode_instruction = f"\n[CHẾ ĐỘ HIỆN TẠI: {mode.upper().split('(')[0].strip()}]"
-        final_response_text = ""
+        timer = timer or StageTimer()
+        # Nhúng câu hỏi song song với BM25 thay vì nối tiếp
+        embedding = self._stage_pool.submit(self._timed_embed, query, timer) if self._needs_embedding(query) else None
+        done, mask, lexical = self._timed_lexical(query, top_k, filters, timer)
+        if done is not None:
+            return done
+        query_vector = embedding.result() if embedding is not None else self._timed_embed(query, timer)
+        with timer.stage("dense"):
+            return self._retrieve_hybrid(query, query_vector, lexical, mask, top_k)
 
-        # Xử lý Ảnh
-        if uploaded_file:
-            strategy = "multimodal_vision"
-            try:
-                img = PIL.Image.open(uploaded_file)
-                img.thumbnail((1024, 1024))
-                contents.append(img)
-                prompt_text = f"{mode_instruction}\n\nYêu cầu của học sinh: \"{question}\"\nHãy phân tích hình ảnh này dựa trên vai trò và hướng dẫn hệ thống của bạn."
-                contents.append(prompt_text)
-                print(f"Processing image with prompt: {prompt_text}")
-            except Exception as e:
-                error_msg = f"Lỗi: Không thể xử lý file ảnh. Chi tiết: {e}"
-                print(error_msg)
-                yield error_msg
-                return StreamOutput(final_text=error_msg, sources=[], strategy="error", top_score=0.0)
+    async def aretrieve(self, query: str, top_k: int = TOP_K, filters: Optional[dict] = None,
+                        timer: Optional[StageTimer] = None) -> List[Dict]:
+        """
+        Bản async của `retrieve`: chờ embedding không giữ thread; phần tìm kiếm trên
+        FAISS/BM25 (CPU) chạy trong thread pool để không chặn event loop.
+        """
+        timer = timer or StageTimer()
+        embedding = asyncio.ensure_future(self._atimed_embed(query, timer)) if self._needs_embedding(query) else None
+        try:
+            done, mask, lexical = await asyncio.to_thread(self._timed_lexical, query, top_k, filters, timer)
+            if done is not None:
+                return done
+            query_vector = await embedding if embedding is not None else await self._atimed_embed(query, timer)
+        finally:
+            if embedding is not None and not embedding.done():
+                embedding.cancel()
+        with timer.stage("dense"):
+            return await asyncio.to_thread(self._retrieve_hybrid, query, query_vector, lexical, mask, top_k)
 
-        # Xử lý Văn bản (RAG hoặc Model Only)
-        else:
-            contexts = self.retrieve(question, top_k=TOP_K)
-            if contexts:
-                strategy = "rag"
-                sources = contexts
-                top_score = contexts[0].get("score", 0.0) if contexts else 0.0
-                context_block = "\n\n---\n\n".join([
-                    f"Nguồn {idx+1} (score: {c.get('score', 0.0):.2f}):\n{c.get('text', '')}"
-                    for idx, c in enumerate(contexts)
-                ])
-                prompt_text = f"""{mode_instruction}
+    def _needs_embedding(self, query: str) -> bool:
+        # Câu chỉ gồm công thức thường được BM25 trả lời luôn; nhúng sau nếu BM25 không có gì
+        return self.index is not None and not is_formula_query(query)
 
+    def _timed_lexical(self, query: str, top_k: int, filters: Optional[dict], timer: StageTimer):
+        with timer.stage("lexical"):
+            return self._retrieve_lexical(query, top_k, filters)
+
+    def _timed_embed(self, query: str, timer: StageTimer) -> np.ndarray:
+        with timer.stage("embed"):
+            return self.embed(query)
+
+    async def _atimed_embed(self, query: str, timer: StageTimer) -> np.ndarray:
+        with timer.stage("embed"):
+            return await self.aembed(query)
+
+    @staticmethod
+    def _prefetch_key(question: str, filters: Optional[dict],
+                      memory: Optional[ConversationMemory]) -> Tuple[str, str, int, int]:
+        # Câu tiếp nối được hiểu theo lịch sử, nên khoá gồm cả phiên bản lịch sử
+        history = (id(memory), memory.revision) if memory is not None else (0, 0)
+        return (normalize_query(question), str(sorted((filters or {}).items()))) + history
+
+    def prefetch(self, question: str, filters: Optional[dict] = None,
+                 memory: Optional[ConversationMemory] = None) -> None:
+        """
+        Bắt đầu truy hồi (viết lại câu tiếp nối, nhúng + BM25 + FAISS) chạy nền ngay khi nhận
+        câu hỏi, trong lúc app còn làm việc khác (vd. thử cân bằng phương trình).
+        `aanswer_stream` cho cùng câu hỏi, bộ lọc và lịch sử dùng lại kết quả thay vì truy hồi lại.
+        """
+        if self.store is None:
+            return
+        self.prewarm()
+        timer = StageTimer()
+        future = asyncio.run_coroutine_threadsafe(
+            self._aretrieve_turn(question, filters, memory, timer), async_runtime.get_loop())
+        self._prefetched.put(self._prefetch_key(question, filters, memory), (future, timer))
+
+    async def _aretrieve_turn(self, question: str, filters: Optional[dict],
+                              memory: Optional[ConversationMemory], timer: StageTimer) -> Tuple[str, List[Dict]]:
+        """Truy hồi cho một lượt hỏi: (câu dùng để tìm, tài liệu)."""
+        search_query = question
+        if memory is not None and memory.is_follow_up(question):
+            with timer.stage("rewrite"):
+                search_query = await self.arewrite_query(question, memory)
+        return search_query, await self.aretrieve(search_query, top_k=TOP_K, filters=filters, timer=timer)
+
+    def _start_retrieval(self, question: str, filters: Optional[dict],
+                         memory: Optional[ConversationMemory], timer: StageTimer):
+        """Future truy hồi cho lượt hỏi: lấy từ `prefetch` nếu có, không thì bắt đầu ngay."""
+        entry = self._prefetched.get(self._prefetch_key(question, filters, memory))
+        if entry is not None:
+            future, prefetch_timer = entry
+            return asyncio.wrap_future(future), prefetch_timer
+        return asyncio.ensure_future(self._aretrieve_turn(question, filters, memory, timer)), timer
+
+    def _utility_config(self, max_tokens: int) -> GenerationConfig:
+        return GenerationConfig(temperature=0.2, max_output_tokens=max_tokens)
+
+    def _generate_text(self, prompt: str, max_tokens: int) -> str:
+        """Gọi Gemini (không stream) cho việc phụ, qua cùng hàng chờ quota."""
+        self.limiter.acquire(estimate_tokens(prompt))
+        try:
+            response = self.utility_model.generate_content(prompt, generation_config=self._utility_config(max_tokens))
+        except (gexc.ResourceExhausted, gexc.TooManyRequests) as e:
+            self.limiter.pause(_retry_delay(e, 0))
+            raise
+        return response.text.strip()
+
+    async def _agenerate_text(self, prompt: str, max_tokens: int) -> str:
+        await self.limiter.aacquire(estimate_tokens(prompt))
+        try:
+            response = await self.utility_model.generate_content_async(
+                prompt, generation_config=self._utility_config(max_tokens))
+        except (gexc.ResourceExhausted, gexc.TooManyRequests) as e:
+            self.limiter.pause(_retry_delay(e, 0))
+            raise
+        return response.text.strip()
+
+    @staticmethod
+    def _rewritten(question: str, text: str) -> str:
+        # Chỉ lấy dòng đầu, bỏ ngoặc kép model hay thêm vào
+        line = text.strip().splitlines()[0].strip().strip('"“”') if text.strip() else ""
+        if not line:
+            return question
+        metrics.incr("memory.rewrite")
+        if line != question:
+            print(f"Câu hỏi tiếp nối \"{question}\" -> \"{line}\"")
+        return line
+
+    @staticmethod
+    def _rewrite_fallback(question: str, memory: ConversationMemory, e: Exception) -> str:
+        metrics.incr("memory.rewrite_error")
+        print(f"Không viết lại được câu hỏi tiếp nối, ghép với câu hỏi trước: {e}")
+        # Ghép câu hỏi trước để truy hồi vẫn có chủ đề
+        return f"{memory.turns[-1].question} {question}" if memory.turns else question
+
+    def rewrite_query(self, question: str, memory: ConversationMemory) -> str:
+        """
+        Viết lại câu hỏi tiếp nối ("còn câu 2 thì sao?") thành câu độc lập theo các lượt gần đây
+        để truy hồi đúng tài liệu. Câu đã độc lập (heuristic) được giữ nguyên, không gọi API.
+        """
+        if not QUERY_REWRITE_ENABLED or not memory.is_follow_up(question):
+            return question
+        try:
+            return self._rewritten(question, self._generate_text(rewrite_prompt(question, memory), 128))
+        except Exception as e:
+            return self._rewrite_fallback(question, memory, e)
+
+    async def arewrite_query(self, question: str, memory: ConversationMemory) -> str:
+        """Bản async của `rewrite_query`."""
+        if not QUERY_REWRITE_ENABLED or not memory.is_follow_up(question):
+            return question
+        try:
+            text = await self._agenerate_text(rewrite_prompt(question, memory), 128)
+            return self._rewritten(question, text)
+        except Exception as e:
+            return self._rewrite_fallback(question, memory, e)
+
+    def compact(self, memory: ConversationMemory) -> None:
+        """Gộp các lượt cũ vào tóm tắt khi lịch sử vượt ngân sách token (gọi Gemini, lỗi thì tóm tắt thô)."""
+        if not memory.needs_compaction():
+            return
+        summary, turns = memory.compaction_input()
+        try:
+            new_summary = self._generate_text(summary_prompt(summary, turns, memory.summary_tokens), memory.summary_tokens * 2)
+        except Exception as e:
+            print(f"Không tóm tắt được hội thoại, giữ lại các câu hỏi: {e}")
+            new_summary = memory.fallback_summary(turns)
+        memory.apply_summary(new_summary, turns)
+        metrics.incr("memory.compacted")
+
+    async def acompact(self, memory: ConversationMemory) -> None:
+        """Bản async của `compact`."""
+        if not memory.needs_compaction():
+            return
+        summary, turns = memory.compaction_input()
+        try:
+            new_summary = await self._agenerate_text(
+                summary_prompt(summary, turns, memory.summary_tokens), memory.summary_tokens * 2)
+        except Exception as e:
+            print(f"Không tóm tắt được hội thoại, giữ lại các câu hỏi: {e}")
+            new_summary = memory.fallback_summary(turns)
+        memory.apply_summary(new_summary, turns)
+        metrics.incr("memory.compacted")
+
+    def _explanation(self, q: Question) -> Tuple[str, Optional[str]]:
+        """(khoá cache, lời giải có sẵn hoặc đã sinh) của một câu trong ngân hàng."""
+        key = question_text(q)
+        if q.explanation:
+            metrics.incr("quiz.explain_bank")
+            return key, q.explanation
+        return key, self._explanations.get(key)
+
+    def explain_question(self, q: Question) -> str:
+        """
+        Lời giải một câu của đề lắp từ ngân hàng: dùng lời giải kèm trong đề nếu có,
+        chỉ gọi Gemini (một lần cho mỗi câu, cache trong process) khi đề không có.
+        """
+        key, text = self._explanation(q)
+        if text:
+            return text
+        text = cleanup_response(self._generate_text(explain_prompt(q), 1024))
+        self._explanations.put(key, text)
+        metrics.incr("quiz.explain_generated")
+        return text
+
+    async def aexplain_question(self, q: Question) -> str:
+        """Bản async của `explain_question`."""
+        key, text = self._explanation(q)
+        if text:
+            return text
+        text = cleanup_response(await self._agenerate_text(explain_prompt(q), 1024))
+        self._explanations.put(key, text)
+        metrics.incr("quiz.explain_generated")
+        return text
+
+    def _remember(self, memory: Optional[ConversationMemory], question: str, output: StreamOutput,
+                  background: bool = True) -> None:
+        """Ghi lượt vừa xong vào lịch sử; tóm tắt (nếu cần) chạy nền, lượt sau chờ nếu chưa xong."""
+        if memory is None or output.strategy == "error" or not output.final_text:
+            return
+        memory.add(question, output.final_text)
+        if not memory.needs_compaction():
+            return
+        if not background:
+            self.compact(memory)
+        elif memory.compaction is None or memory.compaction.done():
+            memory.compaction = asyncio.run_coroutine_threadsafe(self.acompact(memory), async_runtime.get_loop())
+
+    @staticmethod
+    async def _await_compaction(memory: Optional[ConversationMemory]) -> None:
+        if memory is not None and memory.compaction is not None and not memory.compaction.done():
+            await asyncio.wrap_future(memory.compaction)
+
+    def prewarm(self) -> None:
+        """
+        Mở sẵn kết nối gRPC async tới Gemini (count_tokens, không tốn quota sinh) nếu đã lâu
+        không gọi, để lời gọi sinh câu trả lời không phải chờ bắt tay TLS. Chạy nền, không chờ.
+        """
+        now = time.monotonic()
+        if GEMINI_PREWARM_IDLE <= 0 or now - self._last_gemini_call < GEMINI_PREWARM_IDLE:
+            return
+        self._last_gemini_call = now
+        asyncio.run_coroutine_threadsafe(self._ping_gemini(), async_runtime.get_loop())
+
+    async def _ping_gemini(self) -> None:
+        try:
+            await self.model.count_tokens_async("ping")
+            metrics.incr("gemini.prewarm")
+        except Exception as e:
+            print(f"Không pre-warm được kết nối Gemini: {e}")
+
+    def _replay(self, cached: CachedAnswer, piece: int = 256) -> Generator[str, None, StreamOutput]:
+        """Phát lại câu trả lời đã cache qua cùng giao diện generator như khi gọi Gemini."""
+        for i in range(0, len(cached.text), piece):
+            yield cached.text[i:i + piece]
+        return StreamOutput(final_text=cached.text, sources=cached.sources,
+                            strategy="cache", top_score=cached.top_score)
+
+    @staticmethod
+    def _mode_instruction(mode: str) -> str:
+        return f"\n[CHẾ ĐỘ HIỆN TẠI: {mode.upper().split('(')[0].strip()}]"
+
+    @staticmethod
+    def _cache_scope(mode: str, filters: Optional[dict]) -> str:
+        # Câu trả lời cache chỉ dùng lại cho cùng chế độ và cùng bộ lọc tài liệu
+        return f"{mode}|{sorted((filters or {}).items())}" if filters else mode
+
+    def _use_answer_cache(self, question: str, memory: Optional[ConversationMemory] = None) -> bool:
+        # Câu hỏi chỉ gồm công thức đi thẳng vào BM25, không nhúng để tra cache;
+        # câu tiếp nối phụ thuộc lịch sử nên không dùng lại câu trả lời của phiên khác
+        if memory is not None and memory.is_follow_up(question):
+            return False
+        return self.answer_cache is not None and not is_formula_query(question)
+
+    def _lookup_answer(self, question: str, scope: str, question_vec: np.ndarray) -> Optional[CachedAnswer]:
+        cached = self.answer_cache.lookup(scope, question_vec) if np.any(question_vec) else None
+        if cached is not None:
+            print(f"Answer cache hit: \"{question}\" ~ \"{cached.question}\"")
+        return cached
+
+    @staticmethod
+    def _history_section(memory: Optional[ConversationMemory]) -> str:
+        history = memory.render() if memory is not None else ""
+        if not history:
+            return ""
+        return f"\nHội thoại trước đó (dùng để hiểu câu hỏi tiếp nối):\n---\n{history}\n---\n"
+
+    def _image_prompt(self, question: str, uploaded_file: Any, mode: str,
+                      memory: Optional[ConversationMemory] = None) -> _Prompt:
+        """Prompt đa phương thức: ảnh (thu nhỏ) + yêu cầu của học sinh."""
+        try:
+            img = PIL.Image.open(uploaded_file)
+            img.thumbnail((1024, 1024))
+            prompt_text = f"{self._mode_instruction(mode)}\n{self._history_section(memory)}\nYêu cầu của học sinh: \"{question}\"\nHãy phân tích hình ảnh này dựa trên vai trò và hướng dẫn hệ thống của bạn."
+            print(f"Processing image with prompt: {prompt_text}")
+            return _Prompt(contents=[img, prompt_text], strategy="multimodal_vision")
+        except Exception as e:
+            error_msg = f"Lỗi: Không thể xử lý file ảnh. Chi tiết: {e}"
+            print(error_msg)
+            return _Prompt(contents=[], strategy="error", error=error_msg)
+
+    def _text_prompt(self, question: str, contexts: List[Dict], mode: str,
+                     memory: Optional[ConversationMemory] = None, search_query: Optional[str] = None) -> _Prompt:
+        """
+        Prompt văn bản: có tài liệu (RAG) thì kèm khối tham khảo, không thì hỏi thẳng model.
+        Có `memory` thì kèm lịch sử (tóm tắt + lượt gần đây); `search_query` là câu tiếp nối đã viết lại.
+        """
+        mode_instruction = self._mode_instruction(mode)
+        history_section = self._history_section(memory)
+        search_query = search_query or question
+        question_line = f'Câu hỏi: "{question}"'
+        if search_query != question:
+            question_line += f'\n(Hiểu theo ngữ cảnh: "{search_query}")'
+        # Cắt tài liệu theo ngân sách token của chế độ học: giữ đoạn sát câu hỏi, bỏ trùng lặp
+        packed = pack_context(search_query, contexts, MODE_CONTEXT_BUDGETS.get(mode, CONTEXT_TOKEN_BUDGET))
+        if packed.sources:
+            prompt_text = f"""{mode_instruction}
+{history_section}
 Thông tin tham khảo từ tài liệu:
 ---
-{context_block}
+{packed.block}
 ---
 Dựa vào thông tin trên và kiến thức của bạn, hãy trả lời câu hỏi sau một cách tự nhiên, sâu sắc, không đề cập đến "nguồn" hay "trích dẫn".
 
-Câu hỏi: "{question}"
+{question_line}
 """
-                contents.append(prompt_text)
-                print(f"Processing text with RAG. Found {len(contexts)} relevant contexts.")
-            else:
-                strategy = "model_only"
-                prompt_text = f"""{mode_instruction}
+            print(f"Processing text with RAG. Found {len(contexts)} relevant contexts, "
+                  f"sent {len(packed.sources)} ({packed.total_tokens} tokens).")
+            return _Prompt(contents=[prompt_text], strategy="rag", sources=packed.sources,
+                           top_score=packed.sources[0].get("score", 0.0),
+                           source_tokens=packed.source_tokens)
 
+        prompt_text = f"""{mode_instruction}
+{history_section}
 (Không tìm thấy thông tin trực tiếp trong tài liệu tham khảo)
 Dựa vào kiến thức hóa học phổ thông của bạn, hãy trả lời câu hỏi sau.
 
-Câu hỏi: "{question}"
+{question_line}
 """
-                contents.append(prompt_text)
-                print("Processing text using model's general knowledge (no RAG hits).")
+        print("Processing text using model's general knowledge (no RAG hits).")
+        return _Prompt(contents=[prompt_text], strategy="model_only")
 
-        # Gọi Gemini (Streaming)
+    @staticmethod
+    def _chunk_piece(chunk: Any, cleaner: StreamingCleaner) -> Tuple[str, bool]:
+        """
+        Phần văn bản đã làm sạch xong sau một chunk Gemini (cleaner giữ lại đuôi chưa an toàn
+        để làm sạch), hoặc cảnh báo (bị chặn / kết thúc bất thường) sau phần văn bản còn giữ.
+        """
+        if chunk.text:
+            return cleaner.feed(chunk.text), False
+        finish_reason = None
+        block_reason = None
         try:
-            generation_config = GenerationConfig(
-                temperature=0.7,
-                top_p=0.95,
-                top_k=40,
-                max_output_tokens=4096,
-            )
+            if chunk._result.candidates and chunk._result.candidates[0].finish_reason != generation_types.FinishReason.STOP:
+                finish_reason = chunk._result.candidates[0].finish_reason.name
+        except (IndexError, AttributeError): pass
+
+        try:
+            if chunk._result.prompt_feedback and chunk._result.prompt_feedback.block_reason:
+                block_reason = chunk._result.prompt_feedback.block_reason.name
+        except AttributeError: pass
+
+        if block_reason:
+            warning_msg = f"\n\n⚠️ Bị chặn vì: {block_reason}"
+        elif finish_reason and finish_reason not in ['STOP', 'FINISH_REASON_UNSPECIFIED']:
+            warning_msg = f"\n\n⚠️ Kết thúc bất thường: {finish_reason}"
+        else:
+            return "", False
+        print(warning_msg)
+        return cleaner.flush() + warning_msg, True
+
+    def _finish(self, question: str, prompt: _Prompt, text: str, had_warning: bool,
+                timer: StageTimer) -> StreamOutput:
+        timer.mark("total")
+        print(f"Stream finished. Strategy: {prompt.strategy}, Top Score: {prompt.top_score}, timings (ms): {timer.timings}")
+        # Chỉ lưu câu trả lời trọn vẹn (không bị chặn/cắt ngang) vào cache
+        if prompt.question_vec is not None and np.any(prompt.question_vec) and text and not had_warning:
+            self.answer_cache.store(prompt.cache_scope, prompt.question_vec, CachedAnswer(
+                question=question, text=text, sources=prompt.sources,
+                strategy=prompt.strategy, top_score=prompt.top_score,
+            ))
+        return StreamOutput(final_text=text, sources=prompt.sources, strategy=prompt.strategy,
+                            top_score=prompt.top_score, source_tokens=prompt.source_tokens,
+                            timings=timer.timings)
+
+    @staticmethod
+    def _error_output(e: Exception) -> StreamOutput:
+        error_msg = f"Đã xảy ra lỗi khi giao tiếp với AI: {e}"
+        print(error_msg)
+        import traceback
+        traceback.print_exc()
+        return StreamOutput(final_text=error_msg, sources=[], strategy="error", top_score=0.0)
+
+    def answer_stream(self, question: str,
+                      uploaded_file: Optional[Any] = None,
+                      mode: str = "Bình thường",
+                      filters: Optional[dict] = None,
+                      memory: Optional[ConversationMemory] = None) -> Generator[str, None, StreamOutput]:
+        """
+        Tạo phản hồi stream từ Gemini, tích hợp RAG hoặc đa phương thức.
+        `filters` (vd. {"grade": 12}) giới hạn tài liệu tham khảo, xem `retrieve`.
+        `memory` (lịch sử của phiên) được gửi kèm prompt, dùng để viết lại câu hỏi tiếp nối
+        trước khi truy hồi, và được cập nhật khi trả lời xong.
+        Yields các chunk văn bản đã làm sạch.
+        Returns StreamOutput chứa kết quả cuối cùng và metadata khi kết thúc.
+        Bản đồng bộ, chặn thread khi chờ mạng/backoff; app dùng `answer_stream_sync`.
+        """
+        timer = StageTimer()
+        if uploaded_file:
+            prompt = self._image_prompt(question, uploaded_file, mode, memory)
+            if prompt.error:
+                yield prompt.error
+                return StreamOutput(final_text=prompt.error, sources=[], strategy="error", top_score=0.0)
+        else:
+            scope = self._cache_scope(mode, filters)
+            question_vec = None
+            if self._use_answer_cache(question, memory):
+                question_vec = self.embed(question)
+                cached = self._lookup_answer(question, scope, question_vec)
+                if cached is not None:
+                    output = yield from self._replay(cached)
+                    self._remember(memory, question, output, background=False)
+                    return output
+            search_query = question
+            if memory is not None:
+                with timer.stage("rewrite"):
+                    search_query = self.rewrite_query(question, memory)
+            contexts = self.retrieve(search_query, top_k=TOP_K, filters=filters, timer=timer)
+            with timer.stage("pack"):
+                prompt = self._text_prompt(question, contexts, mode, memory, search_query)
+            prompt.question_vec, prompt.cache_scope = question_vec, scope
 
+        # Gọi Gemini (Streaming)
+        try:
             stream = gen_with_retry(
-                self.model, contents,
-                generation_config=generation_config,
+                self.model, prompt.contents,
+                generation_config=GENERATION_CONFIG,
                 safety_settings=self.safety_settings,
+                limiter=self.limiter,
             )
-
-            # Xử lý stream
+            final_response_text = ""
+            had_warning = False
+            cleaner = StreamingCleaner(do_exam_layout=True)
             for chunk in stream:
-                 if chunk.text:
-                    # cleaned_chunk = cleanup_response(chunk.text)
-                    cleaned_chunk = cleanup_response(chunk.text, do_exam_layout=True)
-                    final_response_text += cleaned_chunk
-                    yield cleaned_chunk
-                 else:
-                    finish_reason = None
-                    block_reason = None
-                    try:
-                        if chunk._result.candidates and chunk._result.candidates[0].finish_reason != generation_types.FinishReason.STOP:
-                             finish_reason = chunk._result.candidates[0].finish_reason.name
-                    except (IndexError, AttributeError): pass
-
-                    try:
-                        if chunk._result.prompt_feedback and chunk._result.prompt_feedback.block_reason:
-                            block_reason = chunk._result.prompt_feedback.block_reason.name
-                    except AttributeError: pass
-
-                    if block_reason:
-                        warning_msg = f"\n\n⚠️ Bị chặn vì: {block_reason}"
-                        print(warning_msg)
-                        final_response_text += warning_msg
-                        yield warning_msg
-                    elif finish_reason and finish_reason not in ['STOP', 'FINISH_REASON_UNSPECIFIED']:
-                         warning_msg = f"\n\n⚠️ Kết thúc bất thường: {finish_reason}"
-                         print(warning_msg)
-                         final_response_text += warning_msg
-                         yield warning_msg
-
-            print(f"Stream finished. Strategy: {strategy}, Top Score: {top_score}")
-            # Đảm bảo trả về StreamOutput ngay cả khi không có lỗi hay cảnh báo
-            return StreamOutput(final_text=final_response_text, sources=sources, strategy=strategy, top_score=top_score)
+                piece, warning = self._chunk_piece(chunk, cleaner)
+                had_warning = had_warning or warning
+                if piece:
+                    if not final_response_text:
+                        timer.mark("first_token")
+                    final_response_text += piece
+                    yield piece
+            piece = cleaner.flush()
+            if piece:
+                if not final_response_text:
+                    timer.mark("first_token")
+                final_response_text += piece
+                yield piece
+            output = self._finish(question, prompt, final_response_text, had_warning, timer)
+            self._remember(memory, question, output, background=False)
+            return output
+        except Exception as e:
+            output = self._error_output(e)
+            yield output.final_text
+            return output
 
+    async def aanswer_stream(self, question: str,
+                             uploaded_file: Optional[Any] = None,
+                             mode: str = "Bình thường",
+                             filters: Optional[dict] = None,
+                             memory: Optional[ConversationMemory] = None) -> AsyncGenerator[Union[str, QueueStatus, StreamOutput], None]:
+        """
+        Bản async của `answer_stream`: embedding, truy hồi và Gemini đều được await,
+        backoff 429 bằng asyncio.sleep, nên một process phục vụ nhiều phiên cùng lúc trên
+        một event loop. Async generator không có giá trị trả về: các chunk văn bản được
+        yield trước, phần tử cuối cùng luôn là StreamOutput. Khi phải chờ quota Gemini,
+        QueueStatus (vị trí trong hàng chờ, 0 = tới lượt) được yield trước văn bản.
+        Truy hồi (nhúng || BM25, rồi FAISS) chạy song song với tra answer cache, và kết nối
+        Gemini được mở sẵn trong lúc đó; StreamOutput.timings ghi thời gian từng giai đoạn.
+        """
+        timer = StageTimer()
+        self.prewarm()
+        if uploaded_file:
+            await self._await_compaction(memory)
+            prompt = await asyncio.to_thread(self._image_prompt, question, uploaded_file, mode, memory)
+            if prompt.error:
+                yield prompt.error
+                yield StreamOutput(final_text=prompt.error, sources=[], strategy="error", top_score=0.0)
+                return
+        else:
+            scope = self._cache_scope(mode, filters)
+            question_vec = None
+            retrieval, retrieval_timer = self._start_retrieval(question, filters, memory, timer)
+            if self._use_answer_cache(question, memory):
+                # Cùng khoá với lời nhúng trong truy hồi: single-flight gộp thành một lời gọi
+                question_vec = await self.aembed(question)
+                cached = self._lookup_answer(question, scope, question_vec)
+                if cached is not None:
+                    if retrieval_timer is timer:
+                        retrieval.cancel()
+                    replay = self._replay(cached)
+                    while True:
+                        try:
+                            yield next(replay)
+                        except StopIteration as stop:
+                            self._remember(memory, question, stop.value)
+                            yield stop.value
+                            return
+            search_query, contexts = await retrieval
+            if retrieval_timer is not timer:
+                timer.timings.update(retrieval_timer.timings)
+                metrics.incr("retrieve.prefetched")
+            timer.mark("retrieve")
+            await self._await_compaction(memory)
+            with timer.stage("pack"):
+                prompt = self._text_prompt(question, contexts, mode, memory, search_query)
+            prompt.question_vec, prompt.cache_scope = question_vec, scope
+
+        try:
+            # Chờ tới lượt trong hàng chờ quota, báo vị trí ra UI trong lúc chờ
+            updates: "asyncio.Queue[int]" = asyncio.Queue()
+            call = asyncio.ensure_future(agen_with_retry(
+                self.model, prompt.contents,
+                generation_config=GENERATION_CONFIG,
+                safety_settings=self.safety_settings,
+                limiter=self.limiter,
+                on_wait=updates.put_nowait,
+            ))
+            try:
+                with timer.stage("gemini_wait"):
+                    async for status in wait_with_updates(call, updates):
+                        yield status
+            finally:
+                if not call.done():
+                    call.cancel()
+            stream = call.result()
+            self._last_gemini_call = time.monotonic()
+            final_response_text = ""
+            had_warning = False
+            cleaner = StreamingCleaner(do_exam_layout=True)
+            async for chunk in stream:
+                piece, warning = self._chunk_piece(chunk, cleaner)
+                had_warning = had_warning or warning
+                if piece:
+                    if not final_response_text:
+                        timer.mark("first_token")
+                    final_response_text += piece
+                    yield piece
+            piece = cleaner.flush()
+            if piece:
+                if not final_response_text:
+                    timer.mark("first_token")
+                final_response_text += piece
+                yield piece
+            output = self._finish(question, prompt, final_response_text, had_warning, timer)
+            self._remember(memory, question, output)
         except Exception as e:
-            error_msg = f"Đã xảy ra lỗi khi giao tiếp với AI: {e}"
-            print(error_msg)
-            import traceback
-            traceback.print_exc()
-            yield error_msg
-            return StreamOutput(final_text=error_msg, sources=[], strategy="error", top_score=0.0)
\ No newline at end of file
+            output = self._error_output(e)
+            yield output.final_text
+        yield output
+
+    def answer_stream_sync(self, question: str,
+                           uploaded_file: Optional[Any] = None,
+                           mode: str = "Bình thường",
+                           filters: Optional[dict] = None,
+                           memory: Optional[ConversationMemory] = None,
+                           on_queue: Optional[Callable[[int], Any]] = None) -> "AnswerStream":
+        """
+        Chạy `aanswer_stream` trên event loop nền dùng chung, trả về iterator đồng bộ
+        cho `st.write_stream`; StreamOutput nằm ở `.output` khi stream kết thúc.
+        `on_queue(vị trí)` được gọi (trên thread đang đọc stream) khi lượt hỏi phải xếp hàng.
+        """
+        return AnswerStream(self.aanswer_stream(question, uploaded_file=uploaded_file, mode=mode,
+                                                filters=filters, memory=memory),
+                            on_queue=on_queue)
+
+
+class AnswerStream:
+    """
+    Iterator đồng bộ bọc `aanswer_stream`: chỉ yield văn bản (st.write_stream không giữ
+    giá trị trả về của generator), StreamOutput cuối cùng được giữ ở `.output`.
+    """
+
+    def __init__(self, agen: AsyncIterator[Union[str, QueueStatus, StreamOutput]],
+                 on_queue: Optional[Callable[[int], Any]] = None):
+        self._agen = agen
+        self._on_queue = on_queue
+        self.output: Optional[StreamOutput] = None
+
+    def __iter__(self) -> Iterator[str]:
+        for item in async_runtime.iterate(self._agen):
+            if isinstance(item, StreamOutput):
+                self.output = item
+            elif isinstance(item, QueueStatus):
+                if self._on_queue is not None:
+                    self._on_queue(item.position)
+            else:
+                yield item
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Deque, Optional, Sequence
+
+from src.config import GEMINI_RPM, GEMINI_TPM
+from src.core import metrics
+from src.core.text_utils import estimate_tokens
+
+# Số token tính cho một ảnh trong prompt (Gemini quy đổi ảnh ≤ 384px thành 258 token)
+IMAGE_TOKENS = 258
+
+
+def estimate_request_tokens(contents: Sequence[Any]) -> int:
+    """Ước lượng token đầu vào của một request (văn bản + ảnh) để trừ quota tpm."""
+    return sum(estimate_tokens(part) if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+
+
+@dataclass
+class QueueStatus:
+    """Vị trí của lượt hỏi trong hàng chờ gọi Gemini (0 = đã được gọi)."""
+    position: int
+
+
+@dataclass(eq=False)
+class _Ticket:
+    tokens: int
+    wake: Callable[[], None]
+    enqueued: float = field(default_factory=time.monotonic)
+
+
+class RateLimiter:
+    """
+    Token bucket theo cả số request/phút (rpm) và token/phút (tpm), dùng chung trong process
+    cho mọi lời gọi Gemini (embed + generate), từ thread đồng bộ lẫn coroutine.
+    Hàng chờ FIFO: chỉ vé đứng đầu được lấy quota, vé sau chờ tới lượt, nên lượt hỏi
+    đến trước được gọi trước và không phiên nào "chen" được khi quota vừa hồi.
+    rpm/tpm = 0 thì bỏ giới hạn tương ứng.
+    """
+
+    def __init__(self, rpm: float = GEMINI_RPM, tpm: float = GEMINI_TPM, name: str = "ratelimit"):
+        self.rpm = float(rpm)
+        self.tpm = float(tpm)
+        self.name = name
+        self._requests = self.rpm
+        self._tokens = self.tpm
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queue: Deque[_Ticket] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm > 0:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm > 0:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def _enqueue(self, tokens: int, wake: Callable[[], None]) -> _Ticket:
+        ticket = _Ticket(tokens=max(int(tokens), 0), wake=wake)
+        with self._lock:
+            self._queue.append(ticket)
+            metrics.gauge(f"{self.name}.queue_depth", len(self._queue))
+        return ticket
+
+    def _wake_all(self) -> None:
+        # Hàng chờ dịch lên: vé mới đứng đầu đi lấy quota, các vé khác cập nhật vị trí cho UI
+        for ticket in self._queue:
+            ticket.wake()
+
+    def _try_admit(self, ticket: _Ticket) -> float:
+        """
+        Lấy quota cho vé nếu đã tới lượt. Trả về 0 khi được đi, số giây cần chờ nếu vé
+        đứng đầu nhưng chưa đủ quota, inf nếu còn vé khác đứng trước.
+        """
+        with self._lock:
+            if not self._queue or self._queue[0] is not ticket:
+                return math.inf
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._paused_until - now
+            if self.rpm > 0 and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+            # Một lời gọi lớn hơn cả quota/phút vẫn được đi khi bucket đầy
+            need = min(ticket.tokens, self.tpm)
+            if self.tpm > 0 and self._tokens < need:
+                wait = max(wait, (need - self._tokens) * 60.0 / self.tpm)
+            if wait > 0:
+                return wait
+            if self.rpm > 0:
+                self._requests -= 1
+            if self.tpm > 0:
+                self._tokens -= need
+            self._queue.popleft()
+            metrics.gauge(f"{self.name}.queue_depth", len(self._queue))
+            self._wake_all()
+        waited = now - ticket.enqueued
+        metrics.incr(f"{self.name}.admitted")
+        metrics.observe(f"{self.name}.wait_s", waited)
+        return 0.0
+
+    def _cancel(self, ticket: _Ticket) -> None:
+        """Bỏ vé khi người chờ bị huỷ/lỗi."""
+        with self._lock:
+            try:
+                self._queue.remove(ticket)
+            except ValueError:
+                return
+            metrics.gauge(f"{self.name}.queue_depth", len(self._queue))
+            self._wake_all()
+
+    def position(self, ticket: _Ticket) -> int:
+        with self._lock:
+            try:
+                return self._queue.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    def pause(self, seconds: float) -> None:
+        """
+        API vẫn trả 429 (quota bị chia với process khác): dừng cấp quota cho cả hàng chờ
+        trong `seconds` giây, thay vì để từng phiên tự backoff rồi cùng gọi lại.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        metrics.incr(f"{self.name}.throttled")
+
+    def acquire(self, tokens: int = 0, on_wait: Optional[Callable[[int], Any]] = None) -> None:
+        """Chờ (chặn thread) tới lượt và đủ quota cho một request ước lượng `tokens` token."""
+        if not self.enabled:
+            return
+        event = threading.Event()
+        ticket = self._enqueue(tokens, event.set)
+        reported = 0
+        try:
+            while True:
+                delay = self._try_admit(ticket)
+                if delay == 0:
+                    break
+                position = self.position(ticket)
+                if on_wait is not None and position != reported:
+                    on_wait(position)
+                    reported = position
+                # Vé sau chờ được đánh thức; vé đầu chờ đúng thời gian hồi quota
+                event.wait(None if math.isinf(delay) else delay)
+                event.clear()
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        if on_wait is not None and reported:
+            on_wait(0)
+
+    async def aacquire(self, tokens: int = 0, on_wait: Optional[Callable[[int], Any]] = None) -> None:
+        """Bản async của `acquire`: chờ bằng asyncio, không giữ thread."""
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        ticket = self._enqueue(tokens, lambda: loop.call_soon_threadsafe(event.set))
+        reported = 0
+        try:
+            while True:
+                delay = self._try_admit(ticket)
+                if delay == 0:
+                    break
+                position = self.position(ticket)
+                if on_wait is not None and position != reported:
+                    on_wait(position)
+                    reported = position
+                try:
+                    await asyncio.wait_for(event.wait(), None if math.isinf(delay) else delay)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        if on_wait is not None and reported:
+            on_wait(0)
+
+
+async def wait_with_updates(task: "asyncio.Future[Any]", updates: "asyncio.Queue[int]") -> AsyncIterator[QueueStatus]:
+    """
+    Chờ `task` xong, đồng thời yield QueueStatus mỗi khi `updates` nhận vị trí mới
+    (để async generator báo vị trí hàng chờ ra UI trong lúc chờ quota).
+    """
+    while True:
+        getter = asyncio.ensure_future(updates.get())
+        try:
+            done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not getter.done():
+                getter.cancel()
+        if getter in done:
+            yield QueueStatus(position=getter.result())
+            continue
+        while not updates.empty():
+            yield QueueStatus(position=updates.get_nowait())
+        return
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Bộ giới hạn dùng chung trong process theo GEMINI_RPM / GEMINI_TPM."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
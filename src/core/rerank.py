@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import threading
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from src.config import RERANK_CROSS_ENCODER
+
+
+def mmr(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_: float = 0.7,
+        duplicate_threshold: float = 0.95) -> List[int]:
+    """
+    Maximal Marginal Relevance: lần lượt chọn ứng viên có
+    λ·relevance − (1−λ)·max(cosine với các ứng viên đã chọn) lớn nhất.
+    Ứng viên gần như trùng một ứng viên đã chọn (cosine ≥ duplicate_threshold) chỉ được
+    lấy khi không còn ứng viên nào khác.
+    `relevance` đã chuẩn hoá về [0, 1], `vectors` đã chuẩn hoá L2 (hàng 0 = không có vector).
+    Trả về vị trí các ứng viên được chọn theo thứ tự chọn.
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    sims = vectors @ vectors.T
+    redundancy = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected: List[int] = []
+    for _ in range(k):
+        # Chưa chọn gì thì chỉ xét độ liên quan
+        penalty = np.where(np.isfinite(redundancy), redundancy, 0.0)
+        score = lambda_ * relevance - (1.0 - lambda_) * penalty
+        score[~available] = -np.inf
+        duplicate = available & (redundancy >= duplicate_threshold)
+        if duplicate.any() and (available & ~duplicate).any():
+            score[duplicate] = -np.inf
+        best = int(np.argmax(score))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, sims[best])
+    return selected
+
+
+def normalize_scores(scores: Sequence[float]) -> np.ndarray:
+    """Đưa điểm về [0, 1] theo min-max (tất cả bằng nhau -> 1)."""
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.size == 0:
+        return scores
+    lo, hi = float(scores.min()), float(scores.max())
+    if hi - lo < 1e-9:
+        return np.ones_like(scores)
+    return (scores - lo) / (hi - lo)
+
+
+class CrossEncoderReranker:
+    """
+    Cross-encoder cục bộ (sentence-transformers) chấm điểm từng cặp (câu hỏi, chunk).
+    Chính xác hơn cosine nhưng tốn một lần suy luận cho mỗi ứng viên, nên chỉ dùng
+    trên tập ứng viên đã over-fetch. Cần `pip install sentence-transformers`.
+    """
+
+    def __init__(self, model: str = RERANK_CROSS_ENCODER, device: str = "cpu"):
+        self.model_name = model
+        self.device = device
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+
+                    print(f"Đang nạp cross-encoder {self.model_name}...")
+                    self._model = CrossEncoder(self.model_name, device=self.device)
+        return self._model
+
+    def score(self, query: str, texts: Sequence[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros(0, dtype=np.float32)
+        scores = self._load().predict([(query, t) for t in texts], show_progress_bar=False)
+        return np.asarray(scores, dtype=np.float32)
+
+
+_cross_encoder: Optional[CrossEncoderReranker] = None
+_cross_encoder_lock = threading.Lock()
+
+
+def get_cross_encoder() -> Optional[CrossEncoderReranker]:
+    """Cross-encoder dùng chung trong process; None nếu không cấu hình RERANK_CROSS_ENCODER."""
+    global _cross_encoder
+    if not RERANK_CROSS_ENCODER:
+        return None
+    with _cross_encoder_lock:
+        if _cross_encoder is None:
+            _cross_encoder = CrossEncoderReranker()
+        return _cross_encoder
@@ -43,6 +43,11 @@ _LATEX_SYMBOLS: Dict[str, str] = {
     r"\\omega": "ω",
     r"\\Omega": "Ω",
 }
+# Một regex cho mọi ký hiệu: nhóm thứ i khớp mẫu thứ i, thay bằng ký hiệu thứ i. Các mẫu
+# đều là "\tên" nên hai lần khớp không chồng nhau; cùng vị trí thì mẫu đứng trước thắng,
+# giống như thay lần lượt theo thứ tự của _LATEX_SYMBOLS.
+_RE_LATEX_SYMBOLS = re.compile("|".join(f"({pattern})" for pattern in _LATEX_SYMBOLS))
+_LATEX_REPLACEMENTS = tuple(_LATEX_SYMBOLS.values())
 
 # Chỉ số trên/dưới
 _SUPERS = str.maketrans("0123456789+-()", "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁽⁾")
@@ -54,66 +59,102 @@ _RE_SUPER_SIMPLE = re.compile(r"\^([0-9+\-\(\)])")
 _RE_SUB_CURLY = re.compile(r"_\{([^}]*)\}")
 _RE_SUB_SIMPLE = re.compile(r"_([0-9\(\)])")
 
-# Vá lỗi dính dấu/không xuống dòng
+# Vá lỗi dính dấu/không xuống dòng. Sau lượt này mọi "." dính chữ đều đã được chèn
+# khoảng trắng, nên không cần thêm lượt riêng cho "chữ.Chữ hoa".
 _RE_AFTER_PUNCT = re.compile(r"([.,:;?!])([^\s\n])")
-_RE_DOT_CAP = re.compile(r"([^\s])\.([A-ZÀ-Ỹ])")
 
 # Dàn trang đề thi
 _RE_SECTION_HEAD = re.compile(r"(?<!^)\s*(?=(?:[IVXLC]+\.)(?:\s|$))", re.M)  
 _RE_QUESTION = re.compile(r"\s*(?=(Câu\s*\d+\s*:))", re.I)                   
 _RE_CHOICES = re.compile(r"\s(?=([A-D])\.\s)")                              
+# Hai regex trên thử khớp ở mọi vị trí; tìm trước nhãn mục/câu (rẻ hơn nhiều) để bỏ qua
+# cả lượt khi văn bản không có
+_RE_HAS_SECTION = re.compile(r"[IVXLC]+\.(?:\s|$)", re.M)
+_RE_HAS_QUESTION = re.compile(r"Câu\s*\d+\s*:", re.I)
+
+# Mũi tên phản ứng dính chữ/số ở bên trái hoặc bên phải
+_RE_ARROW = re.compile(r"(?<=[A-Za-z0-9₀-₉⁰-⁹\)])→|→(?=[A-Za-z0-9₀-₉⁰-⁹\(\)])")
+
+# ** hoặc * đơn độc (không ôm chữ)
+_RE_LONE_STARS = re.compile(r"(?<!\S)\*{1,2}(?!\S)")
 
 # Khoảng trắng thừa trước xuống dòng
 _RE_WS_BEFORE_NL = re.compile(r"[ \t]+\n")
 _RE_MULTI_NL = re.compile(r"\n{3,}")
 
+# Ước lượng token: mỗi từ/âm tiết hoặc dấu câu ~ 1 token
+_RE_TOKEN = re.compile(r"\w+|[^\w\s]")
+
 # 2) Các hàm hạt nhân
+def estimate_tokens(text: str) -> int:
+    """Ước lượng nhanh số token (không gọi API), đủ dùng để chia chunk và cắt ngữ cảnh."""
+    return len(_RE_TOKEN.findall(text))
+
 def replace_latex_symbols(text: str) -> str:
-    """Thay LaTeX về ký hiệu Unicode thân thiện."""
-    for pattern, repl in _LATEX_SYMBOLS.items():
-        text = re.sub(pattern, repl, text)
-    return text
+    """Thay LaTeX về ký hiệu Unicode thân thiện (một lượt quét cho mọi ký hiệu)."""
+    if "\\" not in text:
+        return text
+    return _RE_LATEX_SYMBOLS.sub(lambda m: _LATEX_REPLACEMENTS[m.lastindex - 1], text)
+
+def _super(m: re.Match) -> str:
+    return m.group(1).translate(_SUPERS)
+
+def _sub(m: re.Match) -> str:
+    return m.group(1).translate(_SUBS)
 
 def convert_supersubs(text: str) -> str:
     """Chuyển ^{...}, ^x, _{...}, _x về chữ số trên/dưới."""
     # Superscript
-    text = _RE_SUPER_CURLY.sub(lambda m: m.group(1).translate(_SUPERS), text)
-    text = _RE_SUPER_SIMPLE.sub(lambda m: m.group(1).translate(_SUPERS), text)
+    if "^" in text:
+        text = _RE_SUPER_CURLY.sub(_super, text)
+        text = _RE_SUPER_SIMPLE.sub(_super, text)
     # Subscript
-    text = _RE_SUB_CURLY.sub(lambda m: m.group(1).translate(_SUBS), text)
-    text = _RE_SUB_SIMPLE.sub(lambda m: m.group(1).translate(_SUBS), text)
+    if "_" in text:
+        text = _RE_SUB_CURLY.sub(_sub, text)
+        text = _RE_SUB_SIMPLE.sub(_sub, text)
     return text
 
 def sanitize_markdown(text: str) -> str:
     """Làm sạch markdown rác: <br>, ```lang, ** trôi nổi, \\text{..}, dấu $."""
-    text = _RE_BR.sub("\n", text)
-    text = _RE_TEX_TEXT.sub(r"\1", text)
+    # Mỗi lượt chỉ chạy khi có ký tự kích hoạt; thứ tự các lượt giữ nguyên
+    if "<" in text:
+        text = _RE_BR.sub("\n", text)
+    if "\\text{" in text:
+        text = _RE_TEX_TEXT.sub(r"\1", text)
     text = text.replace("$", "")
-    text = _RE_CODE_LANG.sub("```\n", text)
+    if "```" in text:
+        text = _RE_CODE_LANG.sub("```\n", text)
     # Xoá **/* đơn độc (không ôm chữ)
-    text = re.sub(r"(?<!\S)\*{1,2}(?!\S)", "", text)
+    if "*" in text:
+        text = _RE_LONE_STARS.sub("", text)
     return text
 
 def fix_spacing(text: str) -> str:
     """Vá lỗi dính dấu câu & chữ hoa sau dấu chấm."""
-    text = _RE_AFTER_PUNCT.sub(r"\1 \2", text)
-    text = _RE_DOT_CAP.sub(r"\1. \2", text)
+    return _RE_AFTER_PUNCT.sub(r"\1 \2", text)
+
+def _exam_layout_body(text: str) -> str:
+    if _RE_HAS_SECTION.search(text):
+        text = _RE_SECTION_HEAD.sub("\n\n", text)
+    if _RE_HAS_QUESTION.search(text):
+        text = _RE_QUESTION.sub(r"\n\n\1 ", text)
+    if "." in text:
+        text = _RE_CHOICES.sub(r"\n\1. ", text)
+    if "\n" in text:
+        text = _RE_WS_BEFORE_NL.sub("\n", text)
+        if "\n\n\n" in text:
+            text = _RE_MULTI_NL.sub("\n\n", text)
     return text
 
 def apply_exam_layout(text: str) -> str:
     """Dàn trang đề thi: tách mục, câu hỏi, phương án; làm sạch dòng trống."""
-    text = _RE_SECTION_HEAD.sub("\n\n", text.strip())
-    text = _RE_QUESTION.sub(r"\n\n\1 ", text)
-    text = _RE_CHOICES.sub(r"\n\1. ", text)
-    text = _RE_WS_BEFORE_NL.sub("\n", text)
-    text = _RE_MULTI_NL.sub("\n\n", text)
-    return text
+    return _exam_layout_body(text.strip())
 
 def normalize_arrows(text: str) -> str:
     """Thêm khoảng trắng quanh mũi tên phản ứng để dễ đọc."""
-    text = re.sub(r"([A-Za-z0-9₀-₉⁰-⁹\)])→", r"\1 → ", text)
-    text = re.sub(r"→([A-Za-z0-9₀-₉⁰-⁹\()])", r" → \1", text)
-    return text
+    if "→" not in text:
+        return text
+    return _RE_ARROW.sub(" → ", text)
 
 # -----------------------------
 # 3) Hàm tổng hợp cho UI
@@ -131,8 +172,15 @@ def cleanup_response(
 ) -> str:
     """
     Làm sạch + chuẩn hoá văn bản cho ChemA.
-    Lưu ý: KHÔNG strip toàn chuỗi để không phá streaming.
+    Dàn trang đề thi strip hai đầu chuỗi; khi stream, dùng StreamingCleaner thay vì
+    gọi hàm này cho từng mảnh.
     """
+    return _cleanup(text, do_symbols, do_supersubs, do_sanitize_md, do_fix_spacing,
+                    do_exam_layout, do_arrow_space)
+
+def _cleanup(text: str, do_symbols: bool, do_supersubs: bool, do_sanitize_md: bool,
+             do_fix_spacing: bool, do_exam_layout: bool, do_arrow_space: bool,
+             lstrip: bool = True, rstrip: bool = True) -> str:
     if not text:
         return text
 
@@ -145,13 +193,235 @@ def cleanup_response(
     if do_fix_spacing:
         text = fix_spacing(text)
     if do_exam_layout:
-        text = apply_exam_layout(text)
+        # strip() của apply_exam_layout chỉ áp cho đầu/cuối của cả văn bản
+        if lstrip:
+            text = text.lstrip()
+        if rstrip:
+            text = text.rstrip()
+        text = _exam_layout_body(text)
     if do_arrow_space:
         text = normalize_arrows(text)
 
     # Chuẩn hoá tab -> space, giữ nguyên newline để stream đẹp
     return text.replace("\t", " ")
 
+# Ký tự có thể mở đầu một mẫu dàn trang (La Mã "IV.", "Câu", phương án "A.")
+_LAYOUT_STARTERS = frozenset("IVXLCABDc")
+# Ký tự mở đầu đoạn an toàn ngoài chữ/số: gạch đầu dòng, tiêu đề và trích dẫn markdown, ngoặc
+_SAFE_MARKS = frozenset("-#>(")
+
+# Điểm cắt giữa dòng: sau dấu kết câu và khoảng trắng
+_RE_SENTENCE_CUT = re.compile(r"[.!?;:][ \t]+(?=\S)")
+
+# Những gì bước làm sạch xoá hoặc biến thành khoảng trắng ở cuối dòng ($ đã bỏ trước)
+_RE_LABEL_JUNK = re.compile(r"(?:\s|[*}]|<br\s*/?>)+$", re.I)
+
+def _label_tail(line: str) -> str:
+    """Dòng như sau khi làm sạch, chỉ xét phần cuối: bỏ $, **, }, <br> và khoảng trắng ở đuôi."""
+    return _RE_LABEL_JUNK.sub("", line.replace("$", ""))
+
+def _ends_with_question_label(tail: str) -> bool:
+    """`tail` (từ _label_tail) kết thúc bằng "Câu" / "Câu 3": dấu ":" có thể ở dòng sau."""
+    end = len(tail)
+    while end and tail[end - 1].isdecimal():
+        end -= 1
+    if end < len(tail):
+        tail = _RE_LABEL_JUNK.sub("", tail[:end])
+    return tail[-3:].lower() == "câu"
+
+def _layout_prefix(head: str) -> Optional[bool]:
+    """
+    `head` có phải đầu "Câu", "A." hay "IV." không (sau "." fix_spacing luôn chèn khoảng
+    trắng nên không xét tiếp); None nếu còn phải xem thêm ký tự.
+    """
+    low = head.lower()
+    if low == "câu":
+        return True
+    if head[0] in "ABCD" and head[1:2] == ".":
+        return True
+    roman = len(head) - len(head.lstrip("IVXLC"))
+    if roman and head[roman:roman + 1] == ".":
+        return True
+    if "câu".startswith(low) or (len(head) == 1 and head in "ABCD") or roman == len(head):
+        return None
+    return False
+
+def _opens_layout(text: str, i: int) -> Optional[bool]:
+    """text[i:] mở đầu mẫu dàn trang không; None nếu cần thêm ký tự mới biết."""
+    head = ""
+    for ch in text[i:i + 16]:
+        if ch == "$":  # $ bị xoá trước khi dàn trang: "A$." cũng thành "A."
+            continue
+        head += ch
+        opens = _layout_prefix(head)
+        if opens is not None:
+            return opens
+    # Chuỗi La Mã / $ quá dài: coi như mở đầu mẫu (không cắt) thay vì chờ mãi
+    return True if len(text) > i + 16 else None
+
+def _cut_ok(text: str, i: int) -> Optional[bool]:
+    """
+    Có thể bắt đầu đoạn làm sạch mới tại i (ký tự trước đó là khoảng trắng) không:
+    đoạn sau phải mở đầu bằng ký tự không bị xoá hay đổi thành khoảng trắng và không
+    mở đầu mẫu dàn trang. None nếu cần thêm ký tự mới biết.
+    """
+    ch = text[i]
+    if ch in _LAYOUT_STARTERS:
+        opens = _opens_layout(text, i)
+        return None if opens is None else not opens
+    if ch.isalnum() or ch in _SAFE_MARKS:
+        return True
+    if ch == "*":
+        stars = 0
+        for j in range(i, len(text)):
+            ch = text[j]
+            if ch == "*":
+                stars += 1
+            elif ch != "$":
+                break
+        else:
+            return None
+        if stars > 2 or not (ch.isspace() or ch == "<"):
+            return True
+        # "* " / "** " đơn độc (gạch đầu dòng markdown) bị xoá: an toàn khi phần sau an toàn
+        while j < len(text) and text[j] in " \t$":
+            j += 1
+        if j == len(text):
+            return None
+        return not text[j].isspace() and text[j] != "<" and _cut_ok(text, j)
+    return False
+
+class StreamingCleaner:
+    """
+    cleanup_response cho văn bản đến từng mảnh (stream Gemini), cho kết quả ghép lại
+    giống hệt cleanup_response trên toàn văn bản.
+
+    Văn bản chỉ được cắt ra làm sạch tại điểm an toàn: ngay sau "\n" (dòng không trống
+    trước đó không kết thúc bằng "Câu N") hoặc sau dấu kết câu + khoảng trắng giữa dòng,
+    khi ngoặc { } đã đóng hết (để ^{...}, _{...} không bị cắt đôi) và ký tự kế tiếp là
+    chữ/số, gạch đầu dòng hay tiêu đề markdown không mở đầu mẫu dàn trang nào ("Câu",
+    "A. ", "IV."; xét thêm vài ký tự để biết). Mọi regex của pipeline đều không khớp vắt
+    qua một điểm như vậy, nên chỉ phần đuôi sau điểm an toàn cuối cùng (thường là câu
+    đang viết dở) bị giữ lại. `python -m benchmarks.fuzz_text` kiểm tra cả hai điều này.
+    Mỗi ký tự được làm sạch một lần.
+
+        cleaner = StreamingCleaner(do_exam_layout=True)
+        for chunk in stream:
+            yield cleaner.feed(chunk)
+        yield cleaner.flush()
+    """
+
+    def __init__(self, **options: bool):
+        self._options = (
+            options.get("do_symbols", True),
+            options.get("do_supersubs", True),
+            options.get("do_sanitize_md", True),
+            options.get("do_fix_spacing", True),
+            options.get("do_exam_layout", True),
+            options.get("do_arrow_space", True),
+        )
+        self._pending = ""
+        self._scanned = 0       # số ký tự của _pending đã quét
+        self._line_start = 0    # đầu dòng hiện tại trong _pending
+        self._depth = 0         # số ngoặc { chưa đóng
+        self._line_end_ok = False  # ký tự vừa quét là "\n" kết thúc một dòng cho phép cắt sau nó
+        self._after_label = False  # dòng không trống gần nhất kết thúc bằng "Câu N"
+        self._safe = 0          # điểm cắt an toàn cuối cùng trong _pending
+        self._started = False   # đã làm sạch đoạn đầu tiên (chỉ đoạn đầu được lstrip)
+
+    def _scan(self) -> None:
+        text = self._pending
+        i, n = self._scanned, len(text)
+        while i < n:
+            if self._line_end_ok:
+                ok = _cut_ok(text, i)
+                if ok is None:
+                    break  # chờ mảnh sau rồi xét lại đầu dòng này
+                if ok:
+                    self._safe = i
+                self._line_end_ok = False
+            nl = text.find("\n", i)
+            if nl < 0:
+                i = self._scan_line(text, i, n, complete=False)
+                break
+            i = self._scan_line(text, i, nl, complete=True)
+            if i < nl:
+                break
+            tail = _label_tail(text[self._line_start:nl])
+            if tail:
+                self._after_label = _ends_with_question_label(tail)
+            # Dòng trống sau "Câu N" không đóng nhãn: \s* của mẫu câu hỏi khớp qua nhiều dòng
+            self._line_end_ok = self._depth == 0 and not self._after_label
+            self._line_start = i = nl + 1
+        self._scanned = i
+
+    def _scan_line(self, text: str, i: int, end: int, complete: bool) -> int:
+        """
+        Quét text[i:end] (phần dòng chưa quét): đếm ngoặc, ghi nhận điểm cắt sau dấu kết câu.
+        Trả về vị trí đã quét tới; nhỏ hơn `end` khi phải chờ mảnh sau để xét một điểm cắt.
+        """
+        braces = "{" in text[i:end] or "}" in text[i:end]
+        pos = i
+        for m in _RE_SENTENCE_CUT.finditer(text, i, end):
+            if braces:
+                self._count_braces(text, pos, m.start())
+                pos = m.start()
+            if self._depth:
+                continue
+            ok = _cut_ok(text, m.end())
+            if ok is None:
+                return m.start()
+            if ok:
+                self._safe = m.end()
+        if braces:
+            self._count_braces(text, pos, end)
+        if not complete:
+            # Dấu kết câu (và khoảng trắng) ở cuối phần đã nhận: xét lại khi có ký tự tiếp theo
+            k = len(text[i:end].rstrip(" \t")) + i
+            if k and text[k - 1] in ".!?;:":
+                return k - 1
+        return end
+
+    def _count_braces(self, text: str, start: int, end: int) -> None:
+        for ch in text[start:end]:
+            if ch == "{":
+                self._depth += 1
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+
+    @property
+    def held(self) -> int:
+        """Số ký tự đang giữ lại chờ điểm cắt an toàn."""
+        return len(self._pending)
+
+    def _clean(self, segment: str, last: bool) -> str:
+        out = _cleanup(segment, *self._options, lstrip=not self._started, rstrip=last)
+        # Đoạn đầu sạch thành rỗng (chỉ có khoảng trắng): đoạn sau vẫn là đầu văn bản
+        self._started = self._started or bool(out)
+        return out
+
+    def feed(self, chunk: str) -> str:
+        """Nhận thêm một mảnh; trả về phần văn bản đã làm sạch xong (có thể rỗng)."""
+        if not chunk:
+            return ""
+        self._pending += chunk
+        self._scan()
+        if not self._safe:
+            return ""
+        segment, self._pending = self._pending[:self._safe], self._pending[self._safe:]
+        self._scanned -= self._safe
+        # Điểm cắt giữa dòng: phần dòng còn lại bắt đầu ngay đầu _pending
+        self._line_start = max(0, self._line_start - self._safe)
+        self._safe = 0
+        return self._clean(segment, last=False)
+
+    def flush(self) -> str:
+        """Kết thúc stream: làm sạch phần còn giữ lại."""
+        segment, self._pending = self._pending, ""
+        self._scanned = self._line_start = self._safe = self._depth = 0
+        self._line_end_ok = self._after_label = False
+        return self._clean(segment, last=True)
+
 # -----------------------------
 # 4) Tách câu hỏi trắc nghiệm
 # -----------------------------
@@ -160,30 +430,20 @@ def cleanup_response(
 class Question:
     index: int
     stem: str
-    choices: Dict[str, str]  # {"A": "...", "B": "...", ...}
-
-_RE_SPLIT_Q = re.compile(r"(?:^|\n)Câu\s*(\d+)\s*:\s*(.*?)(?=\nCâu\s*\d+\s*:|\Z)", re.I | re.S)
-_RE_SPLIT_CHOICES = re.compile(r"\n([A-D])\.\s+(.*?)(?=\n[A-D]\.\s+|\Z)", re.S)
+    choices: Dict[str, str]  # {"A": "...", "B": "...", ...}; câu đúng/sai: {"a": "...", "b": "...", ...}
+    answer: Optional[str] = None  # "B"; câu đúng/sai: "ĐSĐS" theo thứ tự ý a, b, c, d; trả lời ngắn: "7"
+    section: str = ""             # tiêu đề phần chứa câu hỏi ("PHẦN I", "10 Câu trắc nghiệm đúng sai"...)
+    kind: str = "mcq"             # mcq | true_false | short | essay
+    source: str = ""
+    explanation: str = ""
 
 def split_questions(text: str) -> List[Question]:
     """
-    Từ khối văn bản (đã cleanup_layout), tách thành danh sách Question.
-    Phù hợp để render UI Radio cho từng câu trong Streamlit.
+    Từ khối văn bản (đề hoặc câu trả lời đã cleanup), tách thành danh sách Question.
+    Phù hợp để render UI Radio cho từng câu trong Streamlit. Xem src/core/quiz_parser.py.
     """
-    qs: List[Question] = []
-    for m in _RE_SPLIT_Q.finditer(text):
-        idx = int(m.group(1))
-        block = m.group(2).strip()
-        # stem: phần trước lựa chọn đầu tiên
-        parts = _RE_SPLIT_CHOICES.split("\n" + block)
-        stem = parts[0].strip()
-        choices: Dict[str, str] = {}
-        for i in range(1, len(parts), 3):
-            letter = parts[i].strip()
-            content = parts[i + 1].strip()
-            choices[letter] = content
-        qs.append(Question(index=idx, stem=stem, choices=choices))
-    return qs
+    from src.core.quiz_parser import parse_quiz
+    return parse_quiz(text)
 
 # để test thôi
 # if __name__ == "__main__":
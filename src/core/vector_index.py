@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import json
+import re
+from typing import Optional, Tuple
+
+import faiss
+import numpy as np
+
+INDEX_INFO_PATH = "indexes/index_info.json"
+
+# Các kiểu index hỗ trợ (cú pháp index_factory của FAISS), đều dùng inner product
+# trên vector đã chuẩn hoá: Flat, IVF<nlist>,Flat, HNSW<M>, IVF<nlist>,PQ<m>
+_RE_SPEC = re.compile(r"^(?:Flat|HNSW(?P<M>\d+)|IVF(?P<nlist>\d+),(?:Flat|PQ(?P<m>\d+)))$")
+
+
+def parse_spec(spec: str) -> re.Match:
+    m = _RE_SPEC.match(spec.strip())
+    if m is None:
+        raise ValueError(f"Index spec không hỗ trợ: {spec!r}. Dùng Flat, IVF<nlist>,Flat, HNSW<M> hoặc IVF<nlist>,PQ<m>.")
+    return m
+
+
+def make_index(spec: str, d: int) -> faiss.Index:
+    """
+    Tạo index rỗng theo spec. IVF tự lưu id trong inverted list nên dùng trực tiếp;
+    Flat/HNSW được bọc IndexIDMap2 để nhận id ổn định (vid) của chunk.
+    """
+    m = parse_spec(spec)
+    if m.group("m") and d % int(m.group("m")) != 0:
+        raise ValueError(f"PQ{m.group('m')} cần số chiều chia hết cho {m.group('m')} (d={d}).")
+    if m.group("nlist"):
+        return faiss.index_factory(d, spec, faiss.METRIC_INNER_PRODUCT)
+    return faiss.index_factory(d, f"IDMap2,{spec}", faiss.METRIC_INNER_PRODUCT)
+
+
+def train_size(spec: str) -> int:
+    """Số vector nên gom trước khi train (FAISS khuyên ~39 điểm cho mỗi centroid)."""
+    m = parse_spec(spec)
+    if not m.group("nlist"):
+        return 0
+    centroids = int(m.group("nlist"))
+    if m.group("m"):
+        centroids = max(centroids, 256)
+    return 39 * centroids
+
+
+def train(index: faiss.Index, spec: str, vectors: np.ndarray, seed: int = 0) -> None:
+    """Train trên một mẫu ngẫu nhiên của `vectors` rồi bật direct map cho IVF."""
+    m = parse_spec(spec)
+    need = int(m.group("nlist") or 0)
+    if m.group("m"):
+        need = max(need, 256)
+    if len(vectors) < need:
+        raise ValueError(f"{spec} cần ít nhất {need} vector để train, hiện chỉ có {len(vectors)}. Hãy giảm nlist/PQ.")
+    sample_size = max(train_size(spec), need)
+    if len(vectors) > sample_size:
+        rng = np.random.default_rng(seed)
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # Hashtable cho phép reconstruct theo id và remove_ids sau khi đã thêm
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def supports_remove(spec: str) -> bool:
+    return not spec.startswith("HNSW")
+
+
+def remove_ids(index: faiss.Index, ids: np.ndarray) -> int:
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    return index.remove_ids(faiss.IDSelectorArray(ids.size, faiss.swig_ptr(ids)))
+
+
+def apply_search_params(index: faiss.Index, nprobe: int, ef_search: int) -> None:
+    """Đặt tham số lúc tìm kiếm; tham số nào không áp dụng cho kiểu index thì bỏ qua."""
+    ps = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        try:
+            ps.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+
+def _is_hnsw(index: faiss.Index) -> bool:
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return isinstance(index, faiss.IndexHNSW)
+
+
+def search_subset(index: faiss.Index, queries: np.ndarray, k: int, ids: np.ndarray,
+                  nprobe: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tìm k láng giềng chỉ trong tập id cho trước (lọc trước khi tìm, không lọc sau).
+    Flat/IVF dùng ID selector của FAISS; HNSW bỏ qua nút ngoài selector nên dễ trả về
+    thiếu kết quả khi tập lọc nhỏ, vì vậy tính chính xác trên các vector lấy lại theo id.
+    """
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    nq = len(queries)
+    if ids.size == 0:
+        return np.full((nq, k), -np.inf, dtype=np.float32), np.full((nq, k), -1, dtype=np.int64)
+    if _is_hnsw(index):
+        vectors = index.reconstruct_batch(ids)
+        scores = queries @ vectors.T
+        kk = min(k, ids.size)
+        top = np.argsort(-scores, axis=1, kind="stable")[:, :kk]
+        D = np.full((nq, k), -np.inf, dtype=np.float32)
+        I = np.full((nq, k), -1, dtype=np.int64)
+        D[:, :kk] = np.take_along_axis(scores, top, axis=1)
+        I[:, :kk] = ids[top]
+        return D, I
+    sel = faiss.IDSelectorBatch(ids.size, faiss.swig_ptr(ids))
+    if faiss.try_extract_index_ivf(index) is not None:
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    return index.search(queries, k, params=params)
+
+
+def load_index_info(path: str = INDEX_INFO_PATH) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_index_info(info: dict, path: str = INDEX_INFO_PATH) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=1)
@@ -1,23 +1,72 @@
 import os
 import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import faiss
 from tqdm import tqdm
 import google.generativeai as genai
-from typing import List  # <<<--- THÊM DÒNG NÀY ĐỂ FIX LỖI
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence  # <<<--- THÊM DÒNG NÀY ĐỂ FIX LỖI
 
 # Import config từ thư mục src (giữ nguyên)
 try:
-    from src.config import GEMINI_API_KEY, EMBED_MODEL
+    from src.config import (
+        GEMINI_API_KEY,
+        EMBED_MODEL,
+        EMBED_BATCH_SIZE,
+        EMBED_WORKERS,
+        EMBED_MAX_RETRIES,
+        INDEX_STREAM_BATCH,
+        INDEX_SPEC,
+        EMBED_BACKEND,
+    )
+    from src.core.embed_cache import EmbeddingCache
+    from src.core.embedders import TASK_DOCUMENT, get_embedder
+    from src.core.chunk_store import CHUNK_STORE_DIR, ChunkStoreWriter
+    from src.core.lexical_index import LexicalIndexWriter
+    from src.core.vector_index import (
+        load_index_info,
+        make_index,
+        remove_ids,
+        save_index_info,
+        supports_remove,
+        train,
+        train_size,
+    )
 except ImportError:
     print("Cảnh báo: Không thể import config. Sử dụng giá trị mặc định.")
     # Cần cung cấp các giá trị này trong file .env
     GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
     EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-004")
+    EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 100))
+    EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 4))
+    EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 5))
+    INDEX_STREAM_BATCH = int(os.getenv("INDEX_STREAM_BATCH", 1000))
+    INDEX_SPEC = os.getenv("INDEX_SPEC", "Flat")
+    EMBED_BACKEND = os.getenv("EMBED_BACKEND", "gemini")
+    EmbeddingCache = None
 
 CHUNKS_PATH = "data/processed/chunks.jsonl"
 INDEX_PATH = "indexes/faiss.index"
 META_PATH = "indexes/meta.jsonl"
+CHECKPOINT_DIR = "indexes/.embed_checkpoint"
+
+# Hàm nhúng một batch: nhận list text, trả về list vector (mỗi vector là list float)
+EmbedFn = Callable[[List[str]], Sequence[Sequence[float]]]
+
+@dataclass
+class EmbedStats:
+    """Thống kê một lần chạy embed_texts (dùng cho log và kiểm thử với embedder giả)."""
+    total_batches: int = 0
+    embedded_batches: int = 0
+    resumed_batches: int = 0
+    retries: int = 0
+    cached: int = 0
 
 def load_chunks():
     """Tải các chunk từ file chunks.jsonl."""
@@ -29,84 +78,332 @@ def load_chunks():
         print(f"Lỗi: Không tìm thấy file {CHUNKS_PATH}. Hãy chạy script ingest.py trước.")
         return []
 
-def embed_texts(texts: List[str]) -> np.ndarray:
-    """Nhúng tài liệu theo batch sử dụng task_type phù hợp."""
+def _default_embed_batch(texts: List[str]) -> Sequence[Sequence[float]]:
+    """Nhúng một batch bằng embedder cấu hình (EMBED_BACKEND). Quan trọng: task là 'RETRIEVAL_DOCUMENT'."""
+    return get_embedder(EMBED_BACKEND).embed(texts, TASK_DOCUMENT)
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff có jitter, tối đa 30s."""
+    return min(2 ** attempt, 30) + random.uniform(0, 1)
+
+def _embed_batch_with_retry(embed_fn: EmbedFn, texts: List[str], max_retries: int):
+    """Nhúng một batch, thử lại khi lỗi. Trả về (vectors, số lần retry)."""
+    retries = 0
+    while True:
+        try:
+            vectors = np.asarray(embed_fn(texts), dtype="float32")
+            if vectors.ndim != 2 or vectors.shape[0] != len(texts):
+                raise ValueError(f"Embedder trả về shape {vectors.shape}, cần ({len(texts)}, d)")
+            return vectors, retries
+        except Exception as e:
+            if retries >= max_retries:
+                raise
+            delay = _backoff_delay(retries)
+            print(f"Batch lỗi ({e}). Thử lại sau {delay:.1f}s...")
+            time.sleep(delay)
+            retries += 1
+
+def _fingerprint(texts: List[str], batch_size: int) -> str:
+    """Dấu vân tay của tập text + cách chia batch, để checkpoint cũ không bị dùng nhầm."""
+    h = hashlib.sha1(f"{get_embedder(EMBED_BACKEND).name}|{batch_size}|{len(texts)}".encode("utf-8"))
+    for t in texts:
+        h.update(hashlib.sha1(t.encode("utf-8")).digest())
+    return h.hexdigest()
+
+def _prepare_checkpoint(checkpoint_dir: str, fingerprint: str) -> None:
+    """Giữ checkpoint nếu cùng fingerprint, ngược lại xoá và tạo mới."""
+    state_path = os.path.join(checkpoint_dir, "state.json")
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            if json.load(f).get("fingerprint") == fingerprint:
+                return
+    except (FileNotFoundError, ValueError):
+        pass
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint}, f)
+
+def _batch_path(checkpoint_dir: str, b: int) -> str:
+    return os.path.join(checkpoint_dir, f"batch_{b:05d}.npy")
+
+def _save_batch(checkpoint_dir: str, b: int, vectors: np.ndarray) -> None:
+    """Ghi batch theo kiểu atomic để một lần chạy bị ngắt không để lại file hỏng."""
+    tmp_path = os.path.join(checkpoint_dir, f"batch_{b:05d}.tmp.npy")
+    np.save(tmp_path, vectors)
+    os.replace(tmp_path, _batch_path(checkpoint_dir, b))
+
+def embed_texts(texts: List[str],
+                batch_size: int = EMBED_BATCH_SIZE,
+                workers: int = EMBED_WORKERS,
+                max_retries: int = EMBED_MAX_RETRIES,
+                embed_fn: Optional[EmbedFn] = None,
+                checkpoint_dir: Optional[str] = CHECKPOINT_DIR,
+                stats: Optional[EmbedStats] = None,
+                cache: Optional["EmbeddingCache"] = None) -> np.ndarray:
+    """
+    Nhúng tài liệu theo batch, chạy song song tối đa `workers` batch cùng lúc.
+    Nếu có `cache`, các text đã từng nhúng được lấy từ cache, chỉ phần còn thiếu mới gọi API.
+    Mỗi batch được retry/backoff độc lập và lưu vào `checkpoint_dir` ngay khi xong,
+    nên lần chạy sau (cùng dữ liệu) sẽ tiếp tục từ các batch còn thiếu.
+    `embed_fn` cho phép thay embedder cấu hình bằng embedder giả khi kiểm thử.
+    """
     print(f"Bắt đầu nhúng {len(texts)} chunks...")
     if not texts:
         return np.array([])
-        
-    try:
-        # Quan trọng: Chỉ định task_type là 'RETRIEVAL_DOCUMENT'
-        result = genai.embed_content(
-            model=EMBED_MODEL,
-            content=texts,
-            task_type="RETRIEVAL_DOCUMENT"
-        )
-        
-        embeddings = np.array(result['embedding'], dtype="float32")
-        
-        # Chuẩn hóa (normalize) các vector
-        norms = np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
-        embeddings = embeddings / norms
-        
-        print(f"Hoàn thành nhúng. Shape của embeddings: {embeddings.shape}")
-        return embeddings
 
+    stats = stats if stats is not None else EmbedStats()
+    if cache is not None:
+        cached, positions = cache.get_many(texts, "RETRIEVAL_DOCUMENT")
+        stats.cached = len(positions)
+        if positions:
+            print(f"Lấy {len(positions)}/{len(texts)} embedding từ cache.")
+            missing = sorted(set(range(len(texts))) - set(positions))
+            fresh = np.empty((0, cached.shape[1]), dtype="float32")
+            if missing:
+                missing_texts = [texts[i] for i in missing]
+                fresh = embed_texts(missing_texts, batch_size, workers, max_retries,
+                                    embed_fn, checkpoint_dir, stats)
+                cache.put_many(missing_texts, "RETRIEVAL_DOCUMENT", fresh)
+            embeddings = np.empty((len(texts), cached.shape[1]), dtype="float32")
+            embeddings[positions] = cached
+            embeddings[missing] = fresh
+            return embeddings
+
+    embed_fn = embed_fn or _default_embed_batch
+    batch_size = max(1, batch_size)
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    stats.total_batches = len(batches)
+
+    results: List[Optional[np.ndarray]] = [None] * len(batches)
+    if checkpoint_dir:
+        _prepare_checkpoint(checkpoint_dir, _fingerprint(texts, batch_size))
+        for b in range(len(batches)):
+            try:
+                results[b] = np.load(_batch_path(checkpoint_dir, b))
+                stats.resumed_batches += 1
+            except (FileNotFoundError, ValueError):
+                pass
+        if stats.resumed_batches:
+            print(f"Tiếp tục từ checkpoint: đã có {stats.resumed_batches}/{len(batches)} batch.")
+
+    def _run(b: int):
+        vectors, retries = _embed_batch_with_retry(embed_fn, batches[b], max_retries)
+        # Lưu ngay trong worker để batch xong vẫn được giữ dù batch khác lỗi
+        if checkpoint_dir:
+            _save_batch(checkpoint_dir, b, vectors)
+        return vectors, retries
+
+    pending = [b for b, r in enumerate(results) if r is None]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_run, b): b for b in pending}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc="Embedding batches"):
+                b = futures[fut]
+                vectors, retries = fut.result()
+                stats.retries += retries
+                stats.embedded_batches += 1
+                results[b] = vectors
     except Exception as e:
         print(f"Lỗi trong quá trình embedding: {e}")
+        if checkpoint_dir:
+            print(f"Các batch đã xong được giữ ở {checkpoint_dir}, chạy lại để tiếp tục.")
         raise e
 
-def main():
-    """Hàm chính để thực thi việc tạo index."""
-    if not GEMINI_API_KEY:
-        print("Lỗi: GOOGLE_API_KEY (hoặc GEMINI_API_KEY) chưa được thiết lập trong file .env")
-        return
-        
-    genai.configure(api_key=GEMINI_API_KEY)
+    embeddings = np.vstack(results).astype("float32")
+
+    # Chuẩn hóa (normalize) các vector
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+    embeddings = embeddings / norms
+    if cache is not None:
+        cache.put_many(texts, "RETRIEVAL_DOCUMENT", embeddings)
+
+    print(f"Hoàn thành nhúng. Shape của embeddings: {embeddings.shape} "
+          f"({stats.embedded_batches} batch mới, {stats.resumed_batches} từ checkpoint, {stats.retries} lần retry)")
+    return embeddings
+
+def iter_batches(records: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    """Gom một luồng bản ghi thành các batch kích thước cố định."""
+    batch: List[dict] = []
+    for rec in records:
+        batch.append(rec)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def chunk_vid(chunk_id: str) -> int:
+    """Id số (int64 không âm) ổn định của chunk, dùng làm id trong IndexIDMap2."""
+    digest = hashlib.sha1(chunk_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+def _load_incremental_base(spec: str, embedder_name: str):
+    """Đọc index + meta cũ nếu dùng được cho incremental, ngược lại trả về (None, None)."""
+    try:
+        index = faiss.read_index(INDEX_PATH)
+        with open(META_PATH, "r", encoding="utf-8") as f:
+            old_metas = [json.loads(line) for line in f]
+    except (FileNotFoundError, RuntimeError):
+        return None, None
+    if any("vid" not in m for m in old_metas):
+        print("Index cũ không có id ổn định (vid), sẽ build lại toàn bộ.")
+        return None, None
+    # Index IDMap2 phẳng build trước khi có index_info.json được coi là "Flat" + Gemini EMBED_MODEL
+    info = load_index_info() or {}
+    old_spec = info.get("spec", "Flat")
+    if old_spec != spec:
+        print(f"Index cũ là {old_spec}, khác {spec}: sẽ build lại toàn bộ.")
+        return None, None
+    old_embedder = info.get("embedder") or info.get("embed_model") or EMBED_MODEL
+    if old_embedder != embedder_name:
+        print(f"Index cũ nhúng bằng {old_embedder}, khác {embedder_name}: sẽ build lại toàn bộ.")
+        return None, None
+    return index, old_metas
+
+def main(argv=None):
+    """
+    Hàm chính để thực thi việc tạo index.
+    Chunks được đọc dạng luồng và xử lý theo từng đợt `--stream-batch` bản ghi,
+    nên RAM chỉ giữ text của một đợt (ngoài bản thân index).
+    """
+    parser = argparse.ArgumentParser(description="Nhúng chunks và tạo FAISS index.")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Số chunk mỗi lần gọi API")
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS, help="Số batch chạy song song")
+    parser.add_argument("--stream-batch", type=int, default=INDEX_STREAM_BATCH,
+                        help="Số chunk đọc vào RAM mỗi đợt")
+    parser.add_argument("--fresh", action="store_true", help="Bỏ checkpoint cũ và nhúng lại từ đầu")
+    parser.add_argument("--no-cache", action="store_true", help="Không dùng cache embedding trên đĩa")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Chỉ thêm chunk mới và xoá chunk cũ khỏi index hiện có thay vì build lại")
+    parser.add_argument("--index-spec", default=INDEX_SPEC,
+                        help="Kiểu index: Flat, IVF<nlist>,Flat, HNSW<M>, IVF<nlist>,PQ<m>")
+    args = parser.parse_args(argv)
+
+    embedder = get_embedder(EMBED_BACKEND)
+    if embedder.backend == "gemini":
+        if not GEMINI_API_KEY:
+            print("Lỗi: GOOGLE_API_KEY (hoặc GEMINI_API_KEY) chưa được thiết lập trong file .env")
+            return
+        genai.configure(api_key=GEMINI_API_KEY)
+    workers = min(args.workers, embedder.max_workers or args.workers)
+    print(f"Embedder: {embedder.name}")
 
     os.makedirs("indexes", exist_ok=True)
-    metas = []
-    texts = []
-    
+    if args.fresh:
+        shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+
+    spec = args.index_spec
+    index, old_metas = _load_incremental_base(spec, embedder.name) if args.incremental else (None, None)
+    old_vids = {m["vid"] for m in old_metas} if index is not None else set()
+    old_metas = None
+    seen_vids = set()
+    cache = None if (args.no_cache or EmbeddingCache is None) else EmbeddingCache(model=embedder.name)
+    n_total = n_added = 0
+    # IVF/PQ cần train trước khi add: gom vector tới khi đủ mẫu train
+    pending_X: List[np.ndarray] = []
+    pending_ids: List[np.ndarray] = []
+
+    def _flush_pending():
+        X_all = np.vstack(pending_X)
+        print(f"Train index {spec} ({len(X_all)} vector đã gom)...")
+        train(index, spec, X_all)
+        index.add_with_ids(X_all, np.concatenate(pending_ids))
+        pending_X.clear()
+        pending_ids.clear()
+
     print("Loading chunks...")
-    chunks_generator = load_chunks()
-    if not chunks_generator:
-        return
-
-    for rec in tqdm(chunks_generator):
-        texts.append(rec["text"])
-        metas.append({
-            "id": rec["id"],
-            "source": rec["source"],
-            # Lấy section an toàn hơn với .get()
-            "section": rec.get("section", ""),
+    tmp_meta_path = META_PATH + ".tmp"
+    store = ChunkStoreWriter(CHUNK_STORE_DIR)
+    # Chỉ mục BM25 dựng lại toàn bộ mỗi lần (không gọi API), cùng thứ tự hàng với store
+    lexical = LexicalIndexWriter()
+    committed = False
+    try:
+        with open(tmp_meta_path, "w", encoding="utf-8") as wf:
+            for part, batch in enumerate(iter_batches(tqdm(load_chunks(), desc="Chunks"), args.stream_batch)):
+                metas = [{
+                    "id": rec["id"],
+                    "vid": chunk_vid(rec["id"]),
+                    "source": rec["source"],
+                    # Lấy section an toàn hơn với .get()
+                    "section": rec.get("section", ""),
+                    **{k: rec[k] for k in ("grade", "lesson", "doc_type") if k in rec},
+                } for rec in batch]
+                for rec, m in zip(batch, metas):
+                    wf.write(json.dumps(m, ensure_ascii=False) + "\n")
+                    store.add(rec, m["vid"])
+                    lexical.add(rec.get("text", ""))
+                    seen_vids.add(m["vid"])
+                n_total += len(batch)
+
+                add_rows = [i for i, m in enumerate(metas) if m["vid"] not in old_vids]
+                if not add_rows:
+                    continue
+                # Mỗi đợt có checkpoint riêng để build bị ngắt tiếp tục đúng đợt đang dở
+                X = embed_texts([batch[i]["text"] for i in add_rows], batch_size=args.batch_size,
+                                workers=workers, cache=cache,
+                                checkpoint_dir=os.path.join(CHECKPOINT_DIR, f"part_{part:05d}"))
+                if X.size == 0:
+                    print("Embedding thất bại, không tạo index.")
+                    return
+
+                if index is None:
+                    # Index luôn nhận id ổn định (vid), cần cho chế độ --incremental
+                    index = make_index(spec, X.shape[1])
+                ids = np.array([metas[i]["vid"] for i in add_rows], dtype="int64")
+                if index.is_trained:
+                    index.add_with_ids(X, ids)
+                else:
+                    pending_X.append(X)
+                    pending_ids.append(ids)
+                    if sum(len(x) for x in pending_X) >= train_size(spec):
+                        _flush_pending()
+                n_added += len(add_rows)
+
+        if n_total == 0 or index is None:
+            print("Không có text để embed. Dừng lại.")
+            return
+        if pending_X:
+            _flush_pending()
+
+        stale = np.array(sorted(old_vids - seen_vids), dtype="int64")
+        if stale.size:
+            if supports_remove(spec):
+                remove_ids(index, stale)
+            else:
+                print(f"Cảnh báo: {spec} không hỗ trợ xoá, {stale.size} vector cũ vẫn nằm trong index "
+                      f"(bị bỏ qua khi truy hồi). Chạy lại không có --incremental để dọn.")
+        if args.incremental:
+            print(f"Incremental: xoá {stale.size} chunk cũ, thêm {n_added} chunk mới.")
+
+        print(f"Đang ghi index vào {INDEX_PATH}...")
+        faiss.write_index(index, INDEX_PATH)
+        save_index_info({
+            "spec": spec,
+            "dim": index.d,
+            "ntotal": index.ntotal,
+            "metric": "inner_product",
+            "backend": embedder.backend,
+            "embedder": embedder.name,
         })
 
-    # --- CÁC DÒNG CODE NÀY ĐÃ ĐƯỢC CHUYỂN VÀO BÊN TRONG HÀM MAIN ---
-    if not texts:
-        print("Không có text để embed. Dừng lại.")
-        return
-
-    print("Embedding...")
-    X = embed_texts(texts)
-    
-    if X.size == 0:
-        print("Embedding thất bại, không tạo index.")
-        return
-        
-    d = X.shape[1]
-    index = faiss.IndexFlatIP(d)
-    index.add(X)
-
-    print(f"Đang ghi index vào {INDEX_PATH}...")
-    faiss.write_index(index, INDEX_PATH)
-    
-    print(f"Đang ghi metadata vào {META_PATH}...")
-    with open(META_PATH, "w", encoding="utf-8") as wf:
-        for m in metas:
-            wf.write(json.dumps(m, ensure_ascii=False) + "\n")
-            
-    print(f"Đã lưu index vào {INDEX_PATH} và metadata vào {META_PATH}")
+        print(f"Đang ghi metadata vào {META_PATH} và chunk store vào {CHUNK_STORE_DIR}...")
+        os.replace(tmp_meta_path, META_PATH)
+        store.close()
+        lexical.close()
+        committed = True
+    finally:
+        if not committed:
+            # Dừng giữa chừng (lỗi embed, không có chunk, exception): đóng file, xoá thư mục tạm
+            store.abort()
+            lexical.abort()
+            if os.path.exists(tmp_meta_path):
+                os.remove(tmp_meta_path)
+
+    # Index đã ghi xong, checkpoint không còn cần thiết
+    shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+
+    print(f"Đã lưu index ({index.ntotal} vectors) vào {INDEX_PATH} và metadata vào {META_PATH}")
 
 if __name__ == "__main__":
     main()
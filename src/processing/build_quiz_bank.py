@@ -0,0 +1,160 @@
+"""
+Tách toàn bộ đề trong data/raw/quizz (hoặc thư mục khác) thành ngân hàng câu hỏi có cấu trúc:
+mỗi dòng jsonl là một câu (đề, phương án, đáp án, lời giải, phần, nguồn, lớp/bài, chủ đề),
+rồi nhúng từng câu vào indexes/quiz_bank.npy để app lắp đề theo chủ đề mà không gọi Gemini.
+
+Chạy:
+    python -m src.processing.build_quiz_bank
+    python -m src.processing.build_quiz_bank --workers 4 --parquet data/processed/quiz_bank.parquet
+    python -m src.processing.build_quiz_bank --no-embed     # chỉ lọc theo lớp/chủ đề, không cần API
+"""
+import argparse
+import json
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from docx import Document as DocxDocument
+from tqdm import tqdm
+
+from src.config import EMBED_BACKEND, GEMINI_API_KEY
+from src.core.doc_meta import detect_topic, source_metadata
+from src.core.quiz_bank import (
+    QUIZ_BANK_PATH,
+    QUIZ_INFO_PATH,
+    QUIZ_VECTORS_PATH,
+    bank_digest,
+    embedding_text,
+    record_question,
+)
+from src.core.quiz_parser import parse_quiz
+from src.processing.ingest import _relative_source, docx_to_markdown_text
+
+QUIZ_DIRS = [Path("data/raw/quizz")]
+OUT_PATH = Path(QUIZ_BANK_PATH)
+
+
+def question_records(fp: Path) -> Tuple[str, List[dict], str]:
+    """Đọc một đề .docx → (source, bản ghi câu hỏi, lỗi). Chạy được trong process worker."""
+    source = _relative_source(fp)
+    try:
+        text = docx_to_markdown_text(DocxDocument(fp))
+    except Exception as e:
+        return source, [], f"{e}\n{traceback.format_exc()}"
+    doc_meta = source_metadata(source)
+    doc_meta["topic"] = detect_topic(fp.stem)
+    records = []
+    for n, q in enumerate(parse_quiz(text, source=source)):
+        rec = asdict(q)
+        rec["id"] = f"{source}:q{n}"
+        rec.update(doc_meta)
+        records.append(rec)
+    return source, records, ""
+
+
+def _iter_files(paths: List[Path], workers: int) -> Iterator[Tuple[str, List[dict], str]]:
+    if workers <= 1 or len(paths) <= 1:
+        for fp in paths:
+            yield question_records(fp)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map giữ đúng thứ tự file
+        yield from pool.map(question_records, paths, chunksize=4)
+
+
+def embed_bank(records: List[dict], vectors_path: Path = Path(QUIZ_VECTORS_PATH),
+               info_path: Path = Path(QUIZ_INFO_PATH)) -> None:
+    """Nhúng đề + phương án từng câu (cùng embedder, cache với build_index), ghi .npy theo thứ tự dòng."""
+    from src.core.embed_cache import EmbeddingCache
+    from src.core.embedders import get_embedder
+    from src.processing.build_index import embed_texts
+
+    embedder = get_embedder(EMBED_BACKEND)
+    if embedder.backend == "gemini":
+        if not GEMINI_API_KEY:
+            print("Bỏ qua bước nhúng: GOOGLE_API_KEY chưa được thiết lập (app vẫn lắp đề theo lớp/chủ đề).")
+            return
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+    texts = [embedding_text(record_question(r)) for r in records]
+    vectors = embed_texts(texts, workers=embedder.max_workers or 4, checkpoint_dir=None,
+                          cache=EmbeddingCache(model=embedder.name))
+    vectors_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(vectors_path, vectors)
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "embedder": embedder.name,
+            "dim": int(vectors.shape[1]),
+            "count": len(records),
+            "digest": bank_digest(r["id"] for r in records),
+        }, f, ensure_ascii=False, indent=2)
+    print(f"Đã ghi vector: {vectors_path} ({vectors.shape[0]} x {vectors.shape[1]})")
+
+
+def write_parquet(records: List[dict], path: Path) -> None:
+    """Ghi Parquet (cần pyarrow hoặc fastparquet); choices lưu dạng chuỗi JSON."""
+    import pandas as pd
+
+    rows = [{**r, "choices": json.dumps(r["choices"], ensure_ascii=False)} for r in records]
+    try:
+        pd.DataFrame(rows).to_parquet(path, index=False)
+    except ImportError as e:
+        print(f"Không ghi được Parquet ({e}). Cài thêm: pip install pyarrow")
+        return
+    print(f"Đã ghi Parquet: {path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tách đề .docx thành ngân hàng câu hỏi (jsonl/Parquet).")
+    parser.add_argument("--input", nargs="*", type=Path, default=QUIZ_DIRS, help="Thư mục chứa đề .docx")
+    parser.add_argument("--out", type=Path, default=OUT_PATH)
+    parser.add_argument("--parquet", type=Path, help="Ghi thêm file Parquet")
+    parser.add_argument("--workers", type=int, default=1, help="Số process đọc đề song song")
+    parser.add_argument("--no-embed", action="store_true", help="Không nhúng câu hỏi (bỏ tìm theo chủ đề tự do)")
+    args = parser.parse_args(argv)
+
+    paths: List[Path] = []
+    for folder in args.input:
+        if not folder.is_dir():
+            print(f"Cảnh báo: Thư mục {folder} không tồn tại.")
+            continue
+        paths.extend(sorted(folder.rglob("*.docx")))
+    if not paths:
+        print("Không tìm thấy đề .docx nào.")
+        return
+
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    records: List[dict] = []
+    failed = []
+    t0 = time.perf_counter()
+    for source, recs, error in tqdm(_iter_files(paths, args.workers), total=len(paths), desc="Quiz bank"):
+        if error:
+            failed.append((source, error))
+        records.extend(recs)
+    with open(args.out, "w", encoding="utf-8") as wf:
+        for rec in records:
+            wf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    kinds = Counter(r["kind"] for r in records)
+    answered = sum(1 for r in records if r["answer"])
+    print(f"\n{len(paths)} đề, {len(records)} câu hỏi ({answered} có đáp án) trong {time.perf_counter() - t0:.1f}s")
+    print("Theo loại: " + ", ".join(f"{k} {n}" for k, n in kinds.most_common()))
+    for source, error in failed:
+        print(f"--- Lỗi {source}\n{error}")
+    print(f"Đã ghi: {args.out}")
+    if args.parquet:
+        write_parquet(records, args.parquet)
+    if records and not args.no_embed:
+        try:
+            embed_bank(records)
+        except Exception as e:
+            print(f"Lỗi khi nhúng câu hỏi ({e}). Ngân hàng vẫn dùng được, chỉ thiếu tìm theo chủ đề tự do.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
 import json
 import re
+import hashlib
+import time
+import argparse
+import traceback
+from dataclasses import dataclass, field
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Deque, Dict, Iterator, List, Optional
 import os
 
 from tqdm import tqdm
@@ -10,9 +17,13 @@ from docx.document import Document as _Document
 from docx.table import Table
 from docx.text.paragraph import Paragraph
 
-from langchain_text_splitters import MarkdownHeaderTextSplitter
+from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 
+from src.core.doc_meta import source_metadata
+from src.core.quiz_parser import parse_quiz, question_text
+from src.core.text_utils import estimate_tokens
+
 try:
     from src.config import CHUNK_OVERLAP, CHUNK_SIZE
 except ImportError:
@@ -22,6 +33,8 @@ except ImportError:
 
 RAW_DIRS = [Path("data/raw/lop10"), Path("data/raw/lop11"), Path("data/raw/lop12"), Path("data/raw/quizz")]
 OUT_PATH = Path("data/processed/chunks.jsonl")
+MANIFEST_PATH = Path("data/processed/manifest.json")
+RAW_BASE_PATH = Path("data/raw")
 
 def docx_to_markdown_text(doc: _Document) -> str:
     """
@@ -61,18 +74,261 @@ def docx_to_markdown_text(doc: _Document) -> str:
     
     return "\n\n".join(md_lines)
 
-def main():
-    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+def _relative_source(fp: Path) -> str:
+    try:
+        return str(fp.relative_to(RAW_BASE_PATH))
+    except ValueError:
+        return fp.name
+
+def _file_sha1(fp: Path) -> str:
+    h = hashlib.sha1()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _load_manifest() -> Dict[str, dict]:
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _index_existing_chunks() -> Dict[str, List[int]]:
+    """
+    Vị trí byte của từng dòng trong OUT_PATH, nhóm theo source.
+    Chỉ giữ offset để chế độ incremental không phải nạp toàn bộ chunk cũ vào RAM.
+    """
+    by_source: Dict[str, List[int]] = {}
+    try:
+        with open(OUT_PATH, "rb") as f:
+            offset = 0
+            for line in f:
+                rec = json.loads(line)
+                by_source.setdefault(rec["source"], []).append(offset)
+                offset += len(line)
+    except FileNotFoundError:
+        pass
+    return by_source
+
+def _read_lines_at(path: Path, offsets: List[int]) -> Iterator[str]:
+    with open(path, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            yield f.readline().decode("utf-8").rstrip("\n")
+
+def chunks_to_records(chunks: List[Document], relative_source: str) -> List[dict]:
+    """
+    Chuyển chunk của splitter thành bản ghi jsonl.
+    id = "<source>:<sha1(text)[:12]>" nên không đổi khi thêm/bớt file khác,
+    và chỉ đổi khi chính nội dung chunk đổi.
+    """
+    records = []
+    seen: Dict[str, int] = {}
+    # Lớp, số bài, loại tài liệu (dùng để lọc khi truy hồi)
+    doc_meta = source_metadata(relative_source)
+    for chunk in chunks:
+        metadata = chunk.metadata
+        section_parts = []
+        for i in range(1, 5):
+            header_key = f"Header {i}"
+            if header_key in metadata:
+                section_parts.append(metadata[header_key])
+        section_str = " > ".join(section_parts)
+
+        # Giữ lại tiêu đề trong nội dung chunk để có ngữ cảnh tốt hơn
+        # Splitter đã làm việc này với strip_headers=False
+        page_content = chunk.page_content.strip()
+
+        digest = hashlib.sha1(page_content.encode("utf-8")).hexdigest()[:12]
+        # Hai chunk giống hệt nhau trong cùng file: thêm hậu tố để id vẫn duy nhất
+        seen[digest] = seen.get(digest, 0) + 1
+        chunk_id = f"{relative_source}:{digest}"
+        if seen[digest] > 1:
+            chunk_id += f"-{seen[digest]}"
+
+        records.append({
+            "id": chunk_id,
+            "text": page_content,
+            "source": relative_source,
+            "section": section_str,
+            **doc_meta,
+        })
+    return records
+
+HEADERS_TO_SPLIT_ON = [
+    ("#", "Header 1"),
+    ("##", "Header 2"),
+    ("###", "Header 3"),
+    ("####", "Header 4"),
+]
+
+# Thứ tự ưu tiên điểm cắt khi chunk vượt CHUNK_SIZE: đoạn → dòng → câu → từ
+SECONDARY_SEPARATORS = ["\n\n", "\n", ". ", "; ", ", ", " ", ""]
+
+# Mỗi process worker tạo splitter một lần
+_markdown_splitter: Optional[MarkdownHeaderTextSplitter] = None
+
+def _get_splitter() -> MarkdownHeaderTextSplitter:
+    global _markdown_splitter
+    if _markdown_splitter is None:
+        _markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=HEADERS_TO_SPLIT_ON, strip_headers=False)
+    return _markdown_splitter
+
+def _header_prefix(metadata: dict) -> str:
+    """Dựng lại các dòng tiêu đề Markdown từ metadata của MarkdownHeaderTextSplitter."""
+    return "\n".join(
+        f"{'#' * i} {metadata[f'Header {i}']}" for i in range(1, 5) if f"Header {i}" in metadata
+    )
+
+def split_sized(chunks: List[Document],
+                chunk_size: int = CHUNK_SIZE,
+                chunk_overlap: int = CHUNK_OVERLAP) -> List[Document]:
+    """
+    Tách tiếp các chunk dài hơn `chunk_size` token (ước lượng bằng estimate_tokens),
+    chồng lấn `chunk_overlap` token. Mỗi phần con sau phần đầu được gắn lại tiêu đề
+    của mục để vẫn đủ ngữ cảnh khi được truy hồi riêng lẻ.
+    """
+    out: List[Document] = []
+    for chunk in chunks:
+        if estimate_tokens(chunk.page_content) <= chunk_size:
+            out.append(chunk)
+            continue
+        header = _header_prefix(chunk.metadata)
+        # Chừa chỗ cho tiêu đề gắn thêm để phần con vẫn nằm trong chunk_size
+        budget = max(chunk_size - estimate_tokens(header), chunk_size // 2)
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=budget,
+            chunk_overlap=min(chunk_overlap, budget // 2),
+            length_function=estimate_tokens,
+            separators=SECONDARY_SEPARATORS,
+        )
+        for k, piece in enumerate(splitter.split_text(chunk.page_content)):
+            if k > 0 and header:
+                piece = f"{header}\n{piece}"
+            out.append(Document(page_content=piece, metadata=dict(chunk.metadata)))
+    return out
 
-    headers_to_split_on = [
-        ("#", "Header 1"),
-        ("##", "Header 2"),
-        ("###", "Header 3"),
-        ("####", "Header 4"),
+@dataclass
+class FileResult:
+    """Kết quả xử lý một file .docx (trả về từ process worker)."""
+    source: str
+    records: List[dict] = field(default_factory=list)
+    n_chunks: int = 0
+    seconds: float = 0.0         # thời gian thực (wall time) xử lý file trong worker
+    error: Optional[str] = None
+    # Độ dài (token ước lượng) của chunk trước/sau bước tách theo CHUNK_SIZE
+    tokens_before: List[int] = field(default_factory=list)
+    tokens_after: List[int] = field(default_factory=list)
+
+def question_chunks(md_text: str, source: str) -> List[Document]:
+    """Mỗi câu hỏi của đề (kèm đáp án, lời giải nếu có) thành một chunk riêng."""
+    return [
+        Document(page_content=question_text(q), metadata={"Header 1": q.section} if q.section else {})
+        for q in parse_quiz(md_text, source=source)
     ]
-    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on, strip_headers=False)
 
-    all_chunks: List[Document] = []
+def process_file(fp: Path, quiz_questions: bool = False) -> FileResult:
+    """
+    Đọc một file .docx → Markdown → chunks. Chạy được trong process worker.
+    quiz_questions: đề (doc_type quiz) được tách theo từng câu hỏi thay vì theo tiêu đề.
+    """
+    result = FileResult(source=_relative_source(fp))
+    t0 = time.perf_counter()
+    try:
+        # Đọc file .docx bằng python-docx
+        doc = DocxDocument(fp)
+
+        # Chuyển sang văn bản Markdown
+        md_text = docx_to_markdown_text(doc)
+        questions = []
+        if quiz_questions and md_text.strip() and source_metadata(result.source)["doc_type"] == "quiz":
+            questions = question_chunks(md_text, result.source)
+        if questions:
+            result.tokens_before = [estimate_tokens(c.page_content) for c in questions]
+            result.records = chunks_to_records(questions, result.source)
+            result.tokens_after = [estimate_tokens(r["text"]) for r in result.records]
+            result.n_chunks = len(result.records)
+        elif md_text.strip():
+            # Tách theo cấu trúc tiêu đề, rồi giới hạn kích thước theo CHUNK_SIZE/CHUNK_OVERLAP
+            chunks = _get_splitter().split_text(md_text)
+            result.tokens_before = [estimate_tokens(c.page_content) for c in chunks]
+            chunks = split_sized(chunks)
+            result.records = chunks_to_records(chunks, result.source)
+            result.tokens_after = [estimate_tokens(r["text"]) for r in result.records]
+            result.n_chunks = len(result.records)
+    except Exception as e:
+        result.error = f"{e}\n{traceback.format_exc()}"
+    result.seconds = time.perf_counter() - t0
+    return result
+
+def _length_report(label: str, lengths: List[int]) -> str:
+    if not lengths:
+        return f"  {label}: không có chunk"
+    xs = sorted(lengths)
+    pct = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+    return (f"  {label}: {len(xs)} chunks, trung bình {sum(xs) / len(xs):.0f}, "
+            f"p50 {pct(0.5)}, p90 {pct(0.9)}, max {xs[-1]} token")
+
+def _print_summary(results: List[FileResult], wall: float, slowest: int = 5) -> None:
+    """Tóm tắt thời gian và lỗi sau khi xử lý, thay cho traceback in xen kẽ."""
+    if not results:
+        return
+    total = sum(r.seconds for r in results)
+    print(f"\nĐã xử lý {len(results)} file trong {wall:.1f}s (cộng thời gian thực của từng file {total:.1f}s).")
+    print(f"{slowest} file chậm nhất:")
+    for r in sorted(results, key=lambda r: r.seconds, reverse=True)[:slowest]:
+        print(f"  {r.seconds:6.2f}s  {r.source} ({r.n_chunks} chunks)")
+    print(f"Phân bố độ dài chunk (CHUNK_SIZE={CHUNK_SIZE}, CHUNK_OVERLAP={CHUNK_OVERLAP}):")
+    print(_length_report("trước", [n for r in results for n in r.tokens_before]))
+    print(_length_report("sau  ", [n for r in results for n in r.tokens_after]))
+    failed = [r for r in results if r.error]
+    if failed:
+        print(f"\n{len(failed)} file bị lỗi:")
+        for r in failed:
+            print(f"--- {r.source}\n{r.error}")
+
+def _iter_results(to_parse: List[Path], workers: int, quiz_questions: bool = False) -> Iterator[FileResult]:
+    """
+    Xử lý file theo thứ tự, trả kết quả ngay khi có.
+    Với nhiều worker, chỉ giữ tối đa 2×workers file đang chạy để RAM không phình theo corpus.
+    """
+    if workers <= 1 or len(to_parse) <= 1:
+        for fp in to_parse:
+            yield process_file(fp, quiz_questions)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window: Deque = deque()
+        pending = iter(to_parse)
+        for fp in pending:
+            window.append(pool.submit(process_file, fp, quiz_questions))
+            if len(window) >= 2 * workers:
+                break
+        while window:
+            result = window.popleft().result()
+            nxt = next(pending, None)
+            if nxt is not None:
+                window.append(pool.submit(process_file, nxt, quiz_questions))
+            yield result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đọc .docx trong data/raw và tách thành chunks.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Chỉ xử lý lại các file mới/đã thay đổi so với manifest")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Số process đọc/tách file song song (1 = tuần tự)")
+    parser.add_argument("--quiz-questions", action="store_true",
+                        help="Tách đề (quizz/, file kiểm tra/ôn tập) thành một chunk cho mỗi câu hỏi")
+    args = parser.parse_args(argv)
+
+    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+    old_manifest = _load_manifest() if args.incremental else {}
+    existing = _index_existing_chunks() if args.incremental else {}
+    manifest: Dict[str, dict] = {}
+    # Danh sách theo đúng thứ tự file; phần tử là offset các dòng dùng lại hoặc Path cần xử lý
+    plan: List[object] = []
+    n_reused = 0
 
     for folder in RAW_DIRS:
         print(f"Đang xử lý thư mục: {folder.name}")
@@ -80,73 +336,62 @@ def main():
             print(f"Cảnh báo: Thư mục {folder} không tồn tại.")
             continue
 
-        file_paths = list(folder.rglob("*.docx"))
+        file_paths = sorted(folder.rglob("*.docx"))
         if not file_paths:
             print(f"Không tìm thấy file .docx nào trong {folder}")
             continue
 
-        for fp in tqdm(file_paths, desc=f"Loading files từ {folder.name}"):
-            try:
-                # Đọc file .docx bằng python-docx
-                doc = DocxDocument(fp)
-                
-                # Chuyển sang văn bản Markdown
-                md_text = docx_to_markdown_text(doc)
-                if not md_text.strip():
-                    continue
-
-                # Tách theo cấu trúc tiêu đề
-                chunks = markdown_splitter.split_text(md_text)
-                
-                # Thêm source file vào metadata cho mỗi chunk
-                for chunk in chunks:
-                    chunk.metadata['source'] = str(fp)
-                
-                all_chunks.extend(chunks)
-
-            except Exception as e:
-                print(f"Lỗi khi xử lý file {fp}: {e}")
-                import traceback
-                traceback.print_exc()
-
-    # Ghi tất cả các chunk vào file jsonl
-    print(f"\nTổng cộng {len(all_chunks)} chunks. Đang ghi vào {OUT_PATH}...")
-    with open(OUT_PATH, "w", encoding="utf-8") as wf:
-        raw_base_path = Path('data/raw')
-        for idx, chunk in enumerate(tqdm(all_chunks, desc="Ghi chunks")):
-            
-            metadata = chunk.metadata
-            source_path_str = metadata.get("source", "unknown_source")
-            source_path = Path(source_path_str)
-            
-            try:
-                relative_source = source_path.relative_to(raw_base_path)
-            except ValueError:
-                relative_source = source_path.name
-                
-            section_parts = []
-            for i in range(1, 5):
-                header_key = f"Header {i}"
-                if header_key in metadata:
-                    section_parts.append(metadata[header_key])
-            section_str = " > ".join(section_parts)
-
-            chunk_id = f"{relative_source}:{idx}"
-            
-            # Giữ lại tiêu đề trong nội dung chunk để có ngữ cảnh tốt hơn
-            # Splitter đã làm việc này với strip_headers=False
-            page_content = chunk.page_content.strip()
+        for fp in file_paths:
+            relative_source = _relative_source(fp)
+            mtime = fp.stat().st_mtime
+            old = old_manifest.get(relative_source)
+            # mtime khớp thì tin luôn; mtime đổi thì so thêm hash nội dung
+            if old and old.get("mtime") == mtime:
+                digest = old["sha1"]
+            else:
+                digest = _file_sha1(fp)
+            manifest[relative_source] = {"mtime": mtime, "sha1": digest, "quiz_questions": args.quiz_questions}
+            # Đổi cách tách đề (--quiz-questions) thì phải tách lại dù file không đổi
+            same_mode = old is not None and old.get("quiz_questions", False) == args.quiz_questions
+            if old and same_mode and relative_source in existing and digest == old["sha1"]:
+                plan.append(existing[relative_source])
+                n_reused += 1
+            else:
+                plan.append(fp)
+
+    to_parse = [item for item in plan if isinstance(item, Path)]
+    summaries: List[FileResult] = []
+    n_chunks = 0
+    # Ghi ra file tạm rồi đổi tên: file cũ vẫn đọc được (incremental) cho tới khi ghi xong
+    tmp_path = OUT_PATH.with_suffix(".jsonl.tmp")
+    t0 = time.perf_counter()
+    with open(tmp_path, "w", encoding="utf-8") as wf:
+        results = _iter_results(to_parse, args.workers, args.quiz_questions)
+        for item in tqdm(plan, desc=f"Ingest ({args.workers} workers)"):
+            if isinstance(item, list):
+                for line in _read_lines_at(OUT_PATH, item):
+                    wf.write(line + "\n")
+                    n_chunks += 1
+                continue
+            result = next(results)
+            for rec in result.records:
+                wf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            n_chunks += result.n_chunks
+            # Chỉ giữ số liệu tóm tắt, bỏ nội dung chunk đã ghi
+            result.records = []
+            summaries.append(result)
+    os.replace(tmp_path, OUT_PATH)
+    wall = time.perf_counter() - t0
 
-            rec = {
-                "id": chunk_id,
-                "text": page_content,
-                "source": str(relative_source),
-                "section": section_str,
-            }
-            wf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    if args.incremental:
+        removed = set(old_manifest) - set(manifest)
+        print(f"Incremental: dùng lại {n_reused} file, xử lý {len(to_parse)} file, bỏ {len(removed)} file đã xoá.")
+    _print_summary(summaries, wall)
 
-    print(f"Đã ghi tất cả chunks vào: {OUT_PATH}")
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as wf:
+        json.dump(manifest, wf, ensure_ascii=False, indent=1)
+
+    print(f"\nĐã ghi {n_chunks} chunks vào: {OUT_PATH}")
 
 if __name__ == "__main__":
     main()
-